@@ -4,13 +4,14 @@ from typing import Annotated, Optional
 
 from fastapi import APIRouter
 from fastapi import Response
+from starlette.responses import JSONResponse, StreamingResponse
 from fastapi.params import Path, Body, Query
 
-from core.database import db
 from . import RESP_OK
-from app.model.syncer_model import Registration, RegistrationType, RegistrationStatus, DiscoveryInstance
+from app.model.syncer_model import Registration, RegistrationType, RegistrationStatus
 from app.service.discovery.discovery import Discovery
 from app.service.gateway.gateway import Gateway
+from app.service.health.store import health_store
 from core.lib.logger import for_handler
 
 router = APIRouter()
@@ -65,9 +66,8 @@ def discovery(discovery_name: Annotated[str, Path(title="discovery_name", descri
                 raise Exception(
                     f"最少存活实例数{alive_num}不满足，总实例数(含之前已下线数量){len(discovery_instances)}，要下线实例数{len(down_hosts)}，剩余在线实例数{len(alive_hosts)}")
         discovery_client.modify_registration(registration, instances=instances)
-        DiscoveryInstance({}).delete_by_instances(
-            [f"{instance.ip}:{instance.port}" for instance in instances if not instance.enabled],
-            db.get_sqla_helper()[1])
+        health_store.delete_by_instances(
+            [f"{instance.ip}:{instance.port}" for instance in instances if not instance.enabled])
     except Exception as e:
         logger.error(f"主动下线上线注册中心的服务失败,discovery_name {discovery_name},registration {registration}",
                      exc_info=e)
@@ -77,12 +77,15 @@ def discovery(discovery_name: Annotated[str, Path(title="discovery_name", descri
 
 @router.get("/gateway-api-to-file/{gateway_name}")
 def gateway_to_file(gateway_name: str = Path(title="gateway_name", description="网关中心名称"),
-                    file_name: Optional[str] = Query(default=None, title="file_name", description="文件名称")):
+                    file_name: Optional[str] = Query(default=None, title="file_name", description="文件名称"),
+                    compress: bool = Query(default=False, alias="gzip", title="gzip",
+                                           description="是否 gzip 压缩，压缩时文件名加 .gz 后缀")):
     """
-    读取网关admin api转换成文件用于备份或者db-less模式
+    读取网关admin api转换成文件用于备份或者db-less模式，边拉取边输出，同时写入文件
     @rtype: str
     @param gateway_name: 网关名称
     @param file_name: 文件名称
+    @param compress: 是否 gzip 压缩
     @return: 成功返回db-less配置文件
     """
     try:
@@ -90,8 +93,9 @@ def gateway_to_file(gateway_name: str = Path(title="gateway_name", description="
         gateway_client: Gateway = gateway_clients.get(gateway_name)
         if not gateway_client:
             return Response(status_code=404, content=f"没有获取到网关实例{gateway_name}")
-        content, file = gateway_client.fetch_admin_api_to_file(file_name)
-        return Response(status_code=200, content=content, headers={"syncer-file-location": f"{file}"})
+        stream, file = gateway_client.stream_admin_api_to_file(file_name, compress)
+        return StreamingResponse(stream, status_code=200, media_type="application/gzip" if compress else "text/plain",
+                                 headers={"syncer-file-location": f"{file}"})
     except Exception as e:
         logger.error(
             f"读取网关admin api转换成文件用于备份或者db-less模式失败,gateway_name :{gateway_name},file_name:{file_name}",
@@ -100,6 +104,21 @@ def gateway_to_file(gateway_name: str = Path(title="gateway_name", description="
                         headers={"syncer-err-msg": base64.b64encode(f"{e.args}".encode("utf-8")).decode("utf-8")})
 
 
+@router.get("/gateway-write-stats/{gateway_name}")
+def gateway_write_stats(gateway_name: str = Path(title="gateway_name", description="网关中心名称")):
+    """
+    网关每个 upstream 的写入统计，用于观察条件写入省掉了多少次写入(目前仅支持apisix)
+    @rtype: json
+    @param gateway_name: 网关名称
+    @return: {upstream名称: {writes(实际写入), skipped(节点一致跳过), conflicts(比对后被其他人修改), failures}}
+    """
+    from app.model.config import gateway_clients
+    gateway_client: Gateway = gateway_clients.get(gateway_name)
+    if not gateway_client:
+        return Response(status_code=404, content=f"没有获取到网关实例{gateway_name}")
+    return JSONResponse(content=gateway_client.write_stats())
+
+
 @router.post("/migrate/{origin_gateway_name}/to/{target_gateway_name}")
 async def migrate_gateway(
         origin_gateway_name: Annotated[str, Path(title="origin_gateway_name", description="数据来源网关中心名称")],
@@ -139,7 +158,7 @@ async def restore_gateway(
     通过文件还原网关数据(目前仅支持apisix)
     @param body: 待还原配置文件数据
     @param target_gateway_name: 数据迁入目标网关中心名称
-    @return: 成功返回 OK
+    @return: 成功返回 OK，网关返回还原汇总时返回汇总，有资源还原失败时 http status code 为500
     """
     try:
         from app.model.config import gateway_clients
@@ -147,7 +166,9 @@ async def restore_gateway(
         target_gateway_client: Gateway = gateway_clients.get(target_gateway_name)
         if not target_gateway_client:
             return Response(status_code=404, content=f"没有获取到待还原网关实例{target_gateway_name}")
-        await target_gateway_client.restore_gateway(body)
+        result = await target_gateway_client.restore_gateway(body)
+        if isinstance(result, dict):
+            return JSONResponse(content=result, status_code=500 if result.get("failed") else 200)
     except Exception as e:
         logger.error(
             f"通过文件还原网关数据,target_gateway_name :{target_gateway_name},body:{body}",
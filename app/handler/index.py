@@ -1,7 +1,7 @@
 import gc
 import sys
 from datetime import datetime, timedelta
-from typing import Annotated
+from typing import Annotated, Optional
 
 from fastapi import APIRouter
 from fastapi import Response
@@ -106,3 +106,31 @@ def health():
         logger.error(f"健康检查报错", exc_info=e)
     response = JSONResponse(content=result, status_code=status_code)
     return response
+
+
+@router.get("/health/probe-cache", summary="健康检查探测结果缓存统计", description="健康检查探测结果缓存的命中/未命中次数")
+def probe_cache():
+    """
+    健康检查探测结果缓存统计
+    @rtype: json
+    @return: ttl_sec, size, hits(缓存命中), inflight_hits(复用正在进行的探测), misses, saved_probes, hit_ratio
+    """
+    from app.service.health.prober import prober
+    return JSONResponse(content=prober.cache.stats())
+
+
+@router.get("/health/events", summary="健康检查事件", description="查询内存中最近的健康检查事件(探测结果和状态变更)")
+def health_event_list(target_id: Annotated[Optional[str], Query(title="target_id", description="作业id")] = None,
+                      service: Annotated[Optional[str], Query(title="service", description="服务名称")] = None,
+                      instance: Annotated[Optional[str], Query(title="instance", description="实例 ip:port")] = None,
+                      kind: Annotated[Optional[str], Query(title="kind", description="probe 或 transition")] = None,
+                      since: Annotated[Optional[datetime], Query(title="since", description="开始时间")] = None,
+                      until: Annotated[Optional[datetime], Query(title="until", description="结束时间")] = None,
+                      limit: Annotated[int, Query(title="limit", description="最多返回条数，默认100")] = 100):
+    """
+    健康检查事件
+    @rtype: json
+    @return: 按时间倒序的事件列表 [{time, target_id, kind, service, instance, result, status}]
+    """
+    from app.service.health.events import health_events
+    return JSONResponse(content=health_events.query(target_id, service, instance, kind, since, until, limit))
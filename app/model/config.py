@@ -1,3 +1,4 @@
+import importlib.util
 import re
 from enum import Enum
 from typing import List, Dict
@@ -19,6 +20,8 @@ class HealthCheckMethod(Enum):
 class HealthCheckType(Enum):
     HTTP = "http"
     HTTPS = "https"
+    TCP = "tcp"
+    GRPC = "grpc"
 
 
 class DiscoveryType(Enum):
@@ -29,16 +32,50 @@ class DiscoveryType(Enum):
 class GatewayType(Enum):
     KONG = "kong"
     APISIX = "apisix"
+    # apisix standalone 模式，直接维护本地 apisix.yaml
+    APISIX_STANDALONE = "apisix_standalone"
 
 
 class Common(BaseModel):
     syncer_api_key: str = Field('', alias="syncer-api-key")
+    fingerprint_store: str = Field(None, alias="fingerprint-store")
+    health_check_concurrency: int = Field(200, alias="health-check-concurrency")
+    health_flush_interval_sec: float = Field(5, alias="health-flush-interval-sec")
+    health_check_qps: float = Field(0, alias="health-check-qps")
+    probe_cache_ttl_sec: float = Field(-1, alias="probe-cache-ttl-sec")
+    health_events_size: int = Field(1000, alias="health-events-size")
 
     @model_validator(mode='after')
     def check_common(self) -> 'Common':
         assert self.syncer_api_key and self.syncer_api_key != 'NopU13xRheZng2hqHAwaI0TF5VHNN05G', "安全起见请正确填写接口安全key"
         assert re.compile(r'^(?=.*?[A-Z])(?=.*?[a-z])(?=.*?[0-9])(?=.*?[#?!@$%^&*-]).{32,}$').fullmatch(
             self.syncer_api_key), "请设置复杂安全key（长度最少为32位，必须同时包含字母、数字、特殊字符）"
+        assert self.health_check_concurrency > 0, "health-check-concurrency 必须大于0，全局同时进行的健康检查数"
+        assert self.health_flush_interval_sec > 0, "health-flush-interval-sec 必须大于0，实例健康状态写入数据库的间隔"
+        assert self.health_check_qps >= 0, "health-check-qps 不能小于0，全局每秒健康检查数，0 为不限制"
+        assert self.health_events_size > 0, "health-events-size 必须大于0，每个作业在内存中保留的健康检查事件数"
+        return self
+
+
+class Transport(BaseModel):
+    max_connections: int = Field(100, alias="max-connections")
+    max_keepalive_connections: int = Field(20, alias="max-keepalive-connections")
+    keepalive_expiry: float = Field(30, alias="keepalive-expiry")
+    timeout_sec: float = Field(10, alias="timeout-sec")
+    connect_timeout_sec: float = Field(5, alias="connect-timeout-sec")
+    max_in_flight: int = Field(16, alias="max-in-flight")
+    http2: bool = False
+    verify: bool = True
+
+    @model_validator(mode='after')
+    def check_transport(self) -> 'Transport':
+        assert self.max_connections > 0, "transport.max-connections 必须大于0，最大连接数"
+        assert self.max_keepalive_connections >= 0, "transport.max-keepalive-connections 必须大于等于0，最大空闲长连接数"
+        self.max_keepalive_connections = min(self.max_keepalive_connections, self.max_connections)
+        assert self.keepalive_expiry >= 0, "transport.keepalive-expiry 必须大于等于0，空闲长连接保持时间，单位秒"
+        assert self.timeout_sec > 0, "transport.timeout-sec 必须大于0，请求超时时间，单位秒"
+        assert self.connect_timeout_sec > 0, "transport.connect-timeout-sec 必须大于0，建连超时时间，单位秒"
+        assert self.max_in_flight >= 0, "transport.max-in-flight 必须大于等于0，同时在途请求数上限，0 为不限制"
         return self
 
 
@@ -48,6 +85,7 @@ class Discovery(BaseModel):
     prefix: str = None
     host: str = None
     config: dict = None
+    transport: Transport = Field(default_factory=Transport)
 
     @model_validator(mode='after')
     def check_discovery(self) -> 'Discovery':
@@ -62,14 +100,26 @@ class Gateway(BaseModel):
     admin_url: str = Field(None, alias="admin-url")
     prefix: str = None
     config: dict = None
+    transport: Transport = Field(default_factory=Transport)
 
     @model_validator(mode='after')
     def check_gateways(self) -> 'Gateway':
-        assert self.type is not None, "type 必填，网关类型，值为: kong, apisix"
-        assert len(self.admin_url) > 0, "admin-url 必填，网关地址"
+        assert self.type is not None, "type 必填，网关类型，值为: kong, apisix, apisix_standalone"
+        if self.type == GatewayType.APISIX_STANDALONE:
+            assert (self.config or {}).get("file"), "config.file 必填，apisix standalone 模式的 apisix.yaml 路径"
+        else:
+            assert self.admin_url and len(self.admin_url) > 0, "admin-url 必填，网关地址"
         return self
 
 
+def check_grpc_installed(health_check_type: str):
+    """
+    grpc 健康检查依赖可选的 grpcio，没有安装时加载配置就报错，不能等到探测时把实例都判为不健康
+    """
+    assert health_check_type != HealthCheckType.GRPC.value or importlib.util.find_spec("grpc") is not None, \
+        "healthcheck.type 为 grpc 时需要安装 grpcio (pip install grpcio)"
+
+
 class HealthCheck(BaseModel):
     type: HealthCheckType = HealthCheckType.HTTP
     uri: str = "/"
@@ -80,16 +130,19 @@ class HealthCheck(BaseModel):
     healthy: dict = {}
     unhealthy: dict = {}
     alert: dict = {}
+    grpc_service: str = Field("", alias="grpc-service")
 
     @model_validator(mode='after')
     def health_check(self) -> 'HealthCheck':
-        assert self.type is not None, "type 必填，访问方式: http,https"
+        assert self.type is not None, "type 必填，访问方式: http,https,tcp,grpc"
         assert self.timeout_sec > 0, "timeout-sec 必填，超时时间，单位秒，默认5秒"
         assert len(self.interval) > 0, "interval 必填，检查定时表达式"
         assert self.min_hosts > 0, "min-hosts 必填，最小可用节点数，如果低于等于，不会下线节点"
-        assert len(self.healthy.get("http_statuses", [])) > 0, "healthy.http_statuses 必填，健康 http 状态码集合"
+        check_grpc_installed(self.type.value)
+        if self.type in (HealthCheckType.HTTP, HealthCheckType.HTTPS):
+            assert len(self.healthy.get("http_statuses", [])) > 0, "healthy.http_statuses 必填，健康 http 状态码集合"
+            assert len(self.unhealthy.get("http_statuses", [])) > 0, "healthy.http_statuses 必填，不健康 http 状态码集合"
         assert self.healthy.get("successes", 0) > 0, "healthy.successes 必填，确定节点健康的次数"
-        assert len(self.unhealthy.get("http_statuses", [])) > 0, "healthy.http_statuses 必填，不健康 http 状态码集合"
         assert self.unhealthy.get("failures", 0) > 0, "unhealthy.failures 必填，确定节点非健康的次数"
         return self
 
@@ -101,9 +154,14 @@ class Targets(BaseModel):
     name: str = None
     enabled: bool = False
     exclude_service: List[str] = Field([], alias="exclude-service")
+    include_service: List[str] = Field([], alias="include-service")
+    metadata_selector: Dict[str, str] = Field({}, alias="metadata-selector")
     upstream_prefix: str = Field(None, alias="upstream-prefix")
     fetch_interval: str = Field("0 0 * * * *", alias="fetch-interval")
     maximum_interval_sec: int = Field(-1, alias="maximum-interval-sec")
+    concurrency: int = 1
+    full_verify_cycles: int = Field(10, alias="full-verify-cycles")
+    subscribe: bool = False
     config: dict = {}
     healthcheck: dict = None
 
@@ -112,6 +170,16 @@ class Targets(BaseModel):
         assert self.discovery is not None, "discovery 必填，注册中心名称"
         assert self.gateway is not None, "gateway 必填，网关名称"
         assert len(self.fetch_interval) > 0, "fetch-interval 必填，同步间隔，格式为 秒 分 时 日 月 周, 默认为每天零点零分 0 0 * * * *"
+        assert self.concurrency > 0, "concurrency 必须大于0，同时同步的服务数，默认为1(串行)"
+        assert self.full_verify_cycles > 0, "full-verify-cycles 必须大于0，每隔多少轮全量比对一次网关，1 为每轮都全量比对"
+        try:
+            # 只校验正则，运行时的筛选规则由 task_syncer.get_service_selector 按作业编译并缓存
+            from app.service.selector import ServiceSelector
+            ServiceSelector(self.include_service, self.exclude_service, self.metadata_selector)
+        except re.error as e:
+            raise AssertionError(f"include-service/exclude-service/metadata-selector 正则格式错误: {e}")
+        if self.healthcheck:
+            check_grpc_installed(self.healthcheck.get("type"))
         if "\"{{." in self.config.get("template", ""):
             logger.warning(
                 self.name + "config.template 中存在 {{. }} 变量，请检查是否正确填写，已自动删除该变量，改用系统自带模板，当前值: " + \
@@ -158,3 +226,5 @@ class Settings(BaseModel):
 settings = Settings()
 gateway_clients = {}
 discovery_clients = {}
+# key 为作业 id，value 为编译好的服务筛选规则，第一次使用时编译，reload 时清空
+service_selectors = {}
@@ -1,51 +1,39 @@
-import itertools
-import json
-import uuid
 from datetime import datetime, timedelta
 from enum import Enum
 from typing import List, Dict
 
-import httpx
 from db_libs.sqla_lib import SqlaReflectHelper
-from funboost import funboost_current_task
-from httpx import TimeoutException
 from pydantic import BaseModel, Field
 from pydantic import model_validator, AliasChoices
-from sqlalchemy import Column, Integer, String, Boolean, and_, delete, text
+from sqlalchemy import Column, Integer, String, Boolean, Index, delete, text
 from sqlalchemy.dialects.sqlite import DATETIME
 from sqlalchemy.ext.declarative import declarative_base
 
-from app.model.config import HealthCheckType
 from core.lib.logger import for_model
-from core.lib.util import http_status_in_array
 
 logger = for_model(__name__)
 
 Base = declarative_base()
 
-SQL_UPDATE_INSTANCES = text("""
-update instances
-set successes= min(case when :failures + :timeouts > 0 then 0 else successes + :successes end, 256),
-    failures= min(case when :successes > 0 then 0 else failures + :failures end, 256),
-    timeouts= min(case when :successes > 0 then 0 else timeouts + :timeouts end, 256),
-    status= ifnull(:status, 'unknown'),
-    last_time=:last_time
-where id = :id
-""")
-
-SQL_SELECT_INSTANCES = text("""
-select *
-from instances
-where target_id = :target_id
-  and service = :service
-order by iif(status = 'unhealthy', 1, 0) asc, failures + timeouts asc, successes desc
-limit ifnull(:skip, 0),-1
+SQL_UPSERT_INSTANCES = text("""
+insert into instances (id, target_id, service, instance, successes, failures, timeouts, status, create_time, last_time)
+values (:id, :target_id, :service, :instance, :successes, :failures, :timeouts, :status, :create_time, :last_time)
+on conflict(id) do update set successes=excluded.successes,
+                              failures=excluded.failures,
+                              timeouts=excluded.timeouts,
+                              status=excluded.status,
+                              last_time=excluded.last_time
 """)
 
 
 class DiscoveryInstance(Base):
     __tablename__ = 'instances'
-    __table_args__ = {'extend_existing': True}
+    __table_args__ = (
+        # reload 时按作业恢复健康状态(query_by_target)，顺序和内存中的 (作业, 服务, 实例) 一致
+        # 探测结果的写入和删除都按主键 id，不需要其他索引
+        Index('ix_instances_target', 'target_id', 'service', 'instance'),
+        {'extend_existing': True},
+    )
 
     id = Column(String, primary_key=True)
     target_id = Column(String)
@@ -79,6 +67,8 @@ class DiscoveryInstance(Base):
     def check_timeout(self,last_time):
         if self.last_time is None:
             return False
+        if isinstance(last_time, datetime):
+            return datetime.now() - last_time > timedelta(minutes=10)
         self.last_time = self.last_time.split('.')[0]
         # 尝试不同的日期时间格式
         formats = ["%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S"]
@@ -100,50 +90,16 @@ class DiscoveryInstance(Base):
     def to_dict_item(self):
         return dict([(k, getattr(self, k)) for k in self.__dict__.keys() if not k.startswith("_")])
 
-    def get_instances_by_target_id(self, target_id: str, sqla_helper: SqlaReflectHelper) -> List['DiscoveryInstance']:
-        with sqla_helper.session as ss:
-            instances = ss.query(DiscoveryInstance).filter(DiscoveryInstance.target_id == target_id).all()
-            if instances:
-                return [row.to_dict() for row in instances]
-            else:
-                return []
-
-    def health_check(self, healthcheck: dict, sqla_helper: SqlaReflectHelper):
-        success = False
-        params = {'id': self.id, "successes": 0, "failures": 0, "timeouts": 0, "status": self.status}
-        schema = ""
-        try:
-            if self.status == "unhealthy":
-                # 如果不健康了，不再进行健康检查，超过10分钟后删除实例
-                # 如果实例恢复了，会重新插入，进而重新进行健康检查
-                # 如果一直不恢复，或者已经下线了，提前删除也不影响
-                if self.check_timeout(self.last_time):
-                    logger.warning(f"实例 {self.target_id} {self.service} {self.instance} 超过10分钟仍未恢复，删除")
-                    self.delete_by_instances([self.instance], sqla_helper)
-                return
-            if HealthCheckType.HTTP.value == healthcheck.get("type"):
-                schema = "http://"
-            elif HealthCheckType.HTTPS.value == healthcheck.get("type"):
-                schema = "https://"
-            assert len(schema) > 0, f"暂时不支持 {healthcheck.get('type')} 协议"
-            resp = httpx.request(method=healthcheck.get("method", "GET").upper(),
-                                 url=f"{schema}{self.instance}{healthcheck.get('uri')}",
-                                 timeout=healthcheck.get("timeout-sec", 30))
-            if http_status_in_array(resp.status_code, healthcheck.get("healthy", {}).get("http_statuses", [])):
-                params['successes'] = 1
-                success = True
-            elif http_status_in_array(resp.status_code, healthcheck.get("unhealthy", {}).get("http_statuses", [])):
-                params['failures'] = 1
-        except TimeoutException as e:
-            params['timeouts'] = 1
-            logger.warning(
-                f"健康检查 {self.target_id} {self.service} {schema}{self.instance}{healthcheck.get('uri')} 超时, {e.args}")
-        except Exception as e:
-            params['failures'] = 1
-            logger.warning(
-                f"健康检查 {self.target_id} {self.service} {schema}{self.instance}{healthcheck.get('uri')} 失败, {e.args}")
-        params['last_time'] = datetime.now()
-        if success:
+    def next_counts(self, healthcheck: dict, result: dict) -> dict:
+        """
+        根据一次探测结果计算实例新的计数和状态
+        @param healthcheck: 健康检查配置
+        @param result: 探测结果 {"successes": 0|1, "failures": 0|1, "timeouts": 0|1}
+        @return: HealthStore.apply 的参数
+        """
+        params = {'id': self.id, "successes": result.get("successes", 0), "failures": result.get("failures", 0),
+                  "timeouts": result.get("timeouts", 0), "status": self.status, "last_time": datetime.now()}
+        if params['successes']:
             if self.successes + params['successes'] >= healthcheck.get("healthy", {}).get("successes", 1):
                 params['status'] = "healthy"
         else:
@@ -151,95 +107,44 @@ class DiscoveryInstance(Base):
                 params['status'] = "unhealthy"
             if self.timeouts + params['timeouts'] >= healthcheck.get("unhealthy", {}).get("timeouts", 1):
                 params['status'] = "unhealthy"
-        self.set_counts(params, sqla_helper)
-        if not success:
-            instances = self.get_target_service_all_instance(0, sqla_helper)
-            fct = funboost_current_task()
-            msg_time = None
-            if fct:
-                msg_time = fct.function_result_status.publish_time
-            logger.warning(
-                f"健康检查 {self.target_id} {self.service} {schema}{self.instance}{healthcheck.get('uri')} ,msg_time: {msg_time}, 实例状态: {json.dumps([d.to_dict_item() for d in instances])}")
-        if params['status'] != self.status and healthcheck.get("alert", {}).get("url"):
-            instances = self.get_target_service_all_instance(0, sqla_helper)
-            keyfunc = lambda item: item['status']
-            group_dict = {k: [t.to_dict_item() for t in list(v)] for k, v in
-                          itertools.groupby(sorted(instances, key=keyfunc), keyfunc)}
-            logger.info(
-                f"{self.target_id} 下的服务: {self.service} 中的实例: {self.instance} 由 {self.status} 改为 {params['status']}")
-            body = self.to_dict_item()
-            if params['status'] == "unhealthy":
-                body['successes'] = 0
-                body['failures'] = params['failures'] + self.failures
-                body['timeouts'] = params['timeouts'] + self.timeouts
-            else:
-                body['successes'] = params['successes'] + self.successes
-                body['failures'] = 0
-                body['timeouts'] = 0
-            body['last_time'] = params['last_time']
-            body['new_status'] = params['status']
-            body['items'] = group_dict
-            try:
-                resp = httpx.request(method=healthcheck.get("alert", {}).get("method", "GET").upper(), timeout=10,
-                                     url=healthcheck.get("alert", {}).get("url"), params={"body": json.dumps(body)})
-                logger.info(
-                    f"健康检查状态变更通知 参数为: {json.dumps(body)} {healthcheck.get('alert', {})} 结果为: {resp.text}, status_code: {resp.status_code}, headers: {resp.headers}")
-            except Exception as e:
-                logger.error(f"健康检查状态变更通知 {healthcheck.get('alert', {})} 报错 {e.args}")
-
-    def save_or_update(self, discovery_instances: ['Instance'], sqla_helper: SqlaReflectHelper):
-        with sqla_helper.session as ss:
-            instances = ss.query(DiscoveryInstance).filter(and_(DiscoveryInstance.target_id == self.target_id,
-                                                                DiscoveryInstance.service == self.service)).all()
-            if len(discovery_instances) == 0:
-                return instances
-            dis_ins = [f"{d.ip}:{d.port}" for d in discovery_instances if d.enabled]
-            db_ins = [d.instance for d in instances]
-
-            # 增加新增的
-            save_instances = [DiscoveryInstance(
-                {"id": self.id or str(uuid.uuid4()), "target_id": self.target_id, "service": self.service,
-                 "instance": d, "create_time": datetime.now()}) for d in dis_ins if d not in db_ins]
-
-            update_instances = [d for d in instances if
-                                d.instance in dis_ins and d.status == "unhealthy" and d.last_time and datetime.now().timestamp() - d.last_time.timestamp() >= 60]
-
-            if save_instances:
-                logger.info(f"新增的实例: {json.dumps([d.to_dict_item() for d in save_instances])}")
-                ss.add_all(save_instances)
-                ss.commit()
-            # 更新已有实例
-            if update_instances:
-                logger.info(f"更新的实例: {json.dumps([d.to_dict_item() for d in update_instances])}")
-                for d in update_instances:
-                    self.set_counts({'id': d.id, "successes": 0, "failures": 0, "timeouts": 0, "status": "unknown",
-                                     "last_time": datetime.now()}, sqla_helper)
-            return instances
-
-    def set_counts(self, params: {}, sqla_helper: SqlaReflectHelper):
-        with sqla_helper.session as ss:
-            ss.execute(SQL_UPDATE_INSTANCES, params)
-            ss.commit()
+        return params
+
+    def alert_body(self, params: dict) -> dict:
+        """
+        实例状态变更通知的内容
+        @param params: next_counts 计算出的新计数和状态
+        @return: 实例信息，计数为变更后的值，new_status 为新状态
+        """
+        body = self.to_dict_item()
+        if params['status'] == "unhealthy":
+            body['successes'] = 0
+            body['failures'] = params['failures'] + self.failures
+            body['timeouts'] = params['timeouts'] + self.timeouts
+        else:
+            body['successes'] = params['successes'] + self.successes
+            body['failures'] = 0
+            body['timeouts'] = 0
+        body['last_time'] = params['last_time']
+        body['new_status'] = params['status']
+        return body
 
-    def delete_by_instances(self, instances: [], sqla_helper: SqlaReflectHelper):
-        if len(instances) == 0:
-            return
+    @staticmethod
+    def flush(rows: List[dict], deleted: List[str], sqla_helper: SqlaReflectHelper):
+        """
+        一个事务内批量写入(executemany)和删除实例
+        @param rows: 新增或更新的实例
+        @param deleted: 删除的实例 id
+        """
         with sqla_helper.session as ss:
-            logger.info(f"删除无效的实例: {json.dumps(instances)}")
-            sql = delete(DiscoveryInstance).where(DiscoveryInstance.instance.in_(instances))
-            ss.execute(sql)
+            if rows:
+                ss.execute(SQL_UPSERT_INSTANCES, rows)
+            if deleted:
+                ss.execute(delete(DiscoveryInstance).where(DiscoveryInstance.id.in_(deleted)))
             ss.commit()
 
-    def get_target_service_all_instance(self, skip: 0, sqla_helper: SqlaReflectHelper) -> List['DiscoveryInstance']:
-        with sqla_helper.session as ss:
-            instances = ss.execute(SQL_SELECT_INSTANCES,
-                                   {"target_id": self.target_id, "service": self.service, "skip": skip}).all()
-            return [DiscoveryInstance(row._asdict()) for row in instances]
-
     @staticmethod
     def create_table_if_not_exists(sqla_helper: SqlaReflectHelper):
-        Base.metadata.drop_all(sqla_helper.engine)
-        Base.metadata.create_all(sqla_helper.engine)
+        migrate_schema(sqla_helper)
 
     @staticmethod
     def query_all(sqla_helper: SqlaReflectHelper) -> List['DiscoveryInstance']:
@@ -250,9 +155,23 @@ class DiscoveryInstance(Base):
             return result
 
     @staticmethod
-    def clear_all(sqla_helper: SqlaReflectHelper):
+    def query_by_target(target_id: str, sqla_helper: SqlaReflectHelper) -> List['DiscoveryInstance']:
+        """
+        @param target_id: 作业id
+        @return: 作业下保存的全部实例(不绑定 session)
+        """
+        with sqla_helper.session as ss:
+            rows = ss.query(DiscoveryInstance).filter(DiscoveryInstance.target_id == target_id).all()
+            return [DiscoveryInstance(row.to_dict_item()) for row in rows]
+
+    @staticmethod
+    def delete_other_targets(target_ids: List[str], sqla_helper: SqlaReflectHelper):
+        """
+        删除已经不在配置中的作业的实例
+        @param target_ids: 配置中的作业id
+        """
         with sqla_helper.session as ss:
-            ss.query(DiscoveryInstance).delete()
+            ss.execute(delete(DiscoveryInstance).where(DiscoveryInstance.target_id.not_in(target_ids)))
             ss.commit()
 
 
@@ -294,8 +213,7 @@ class Jobs(Base):
 
     @staticmethod
     def create_table_if_not_exists(sqla_helper: SqlaReflectHelper):
-        Base.metadata.drop_all(sqla_helper.engine)
-        Base.metadata.create_all(sqla_helper.engine)
+        migrate_schema(sqla_helper)
 
     @staticmethod
     def query_all(sqla_helper: SqlaReflectHelper) -> List['Jobs']:
@@ -312,6 +230,32 @@ class Jobs(Base):
             ss.commit()
 
 
+# 表结构版本号，保存在 PRAGMA user_version，每次修改表结构/索引时加1并在 SCHEMA_MIGRATIONS 中增加对应的步骤
+SCHEMA_VERSION = 1
+
+
+def _migrate_v1(conn):
+    # 之前的版本每次 reload 都会重建表，表中没有需要保留的数据，直接按当前结构重建
+    Base.metadata.drop_all(conn)
+    Base.metadata.create_all(conn)
+
+
+SCHEMA_MIGRATIONS = {1: _migrate_v1}
+
+
+def migrate_schema(sqla_helper: SqlaReflectHelper):
+    """
+    按 PRAGMA user_version 依次执行未执行过的表结构变更
+    """
+    with sqla_helper.engine.begin() as conn:
+        version = conn.exec_driver_sql("PRAGMA user_version").scalar() or 0
+        for step in range(version + 1, SCHEMA_VERSION + 1):
+            logger.info(f"数据库表结构从版本 {step - 1} 升级到 {step}")
+            SCHEMA_MIGRATIONS[step](conn)
+        if version != SCHEMA_VERSION:
+            conn.exec_driver_sql(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+
 class Instance(BaseModel):
     port: int
     ip: str
@@ -335,9 +279,35 @@ class Instance(BaseModel):
         return self
 
 
+class SyncOutcome(BaseModel):
+    """
+    description: 网关写入结果，target 为空表示整个 upstream 一次写入
+    """
+    upstream: str
+    target: str = None
+    action: str
+    success: bool = True
+    status_code: int = None
+    message: str = None
+
+
+class RestoreOutcome(BaseModel):
+    """
+    description: 还原单个网关资源的结果
+    """
+    kind: str
+    id: str = None
+    success: bool = False
+    attempts: int = 0
+    status_code: int = None
+    message: str = None
+
+
 class Service(BaseModel):
     name: str
     last_time: int = -1
+    # 注册中心提供的服务版本号，版本号没变说明实例没有变化，-1 表示不支持
+    revision: int = -1
     instances: List[Instance] = []
 
     @model_validator(mode='after')
@@ -1,12 +1,20 @@
 from abc import abstractmethod
-from typing import List
+from typing import List, Iterator, Callable
 
 from app.model.syncer_model import Instance, Registration, Service
+from app.service.transport import HttpTransport
 
 
 class Discovery(object):
     def __init__(self, config):
         self._config = config
+        self._transport = HttpTransport(config.transport)
+
+    def close(self):
+        """
+        关闭注册中心客户端持有的连接池
+        """
+        self._transport.close()
 
     @abstractmethod
     def get_all_service(self, config: dict, enabled_only: bool = True) -> List[Service]:
@@ -18,6 +26,15 @@ class Discovery(object):
         """
         pass
 
+    def iter_all_service(self, config: dict, enabled_only: bool = True) -> Iterator[Service]:
+        """
+        逐个返回服务，支持分页的注册中心可以边拉取边返回，syncer 不用等全部拉取完就能开始同步
+        @param enabled_only: 只返回启用的实例
+        @param config: 额外参数，比如groupName,namespaceId等
+        @return:  通用服务迭代器
+        """
+        yield from self.get_all_service(config, enabled_only)
+
     @abstractmethod
     def get_service_all_instances(self, service_name: str, ext_data: dict, enabled_only: bool = True) -> tuple[
         List[Instance], int]:
@@ -30,6 +47,16 @@ class Discovery(object):
         """
         pass
 
+    def subscribe(self, target: dict, service_names: List[str], callback: Callable[[dict, str], None]) -> bool:
+        """
+        订阅服务变更，服务有变更时回调 callback(target, service_name)
+        @param target: 同步作业
+        @param service_names: 需要订阅的服务名称
+        @param callback: 变更回调
+        @return: 注册中心不支持订阅时返回 False
+        """
+        return False
+
     @abstractmethod
     def modify_registration(self, registration: Registration, instances: List[Instance]):
         """
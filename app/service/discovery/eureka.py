@@ -1,8 +1,8 @@
 import json
+import threading
+import time
 from typing import List
 
-import httpx
-
 from app.model.syncer_model import Instance, Registration, Service
 from app.service.discovery.discovery import Discovery
 from core.lib.logger import for_service
@@ -19,25 +19,114 @@ eureka_status = {
 }
 
 
+def as_list(value) -> list:
+    """
+    eureka 的 json 里只有一个元素时返回的是对象不是数组
+    """
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
 class Eureka(Discovery):
     def __init__(self, config):
         super().__init__(config)
+        self.delta = bool((config.config or {}).get("delta", True))
+        # eureka 服务端增量队列的保留时间(eureka.server.retention-time-in-m-s-in-delta-queue 默认3分钟)
+        # 距离上次拉取超过这个时间，中间的变更可能已经不在 /apps/delta 里了，只能全量拉取
+        self.delta_retention_sec = float((config.config or {}).get("delta-retention-sec", 180))
+        # hashcode 只是各状态的实例数，实例替换(下线一个上线一个)时 hashcode 不变，定期全量拉取兜底
+        self.full_fetch_interval_sec = float((config.config or {}).get("full-fetch-interval-sec", 600))
+        self._last_fetch = 0
+        self._last_full_fetch = 0
+        # 本地注册表镜像 app 名称 -> {instanceId: instance}，通过 /apps/delta 增量更新
+        self._apps = {}
+        # app 名称 -> 版本号，app 的实例有变化时版本号变大，syncer 据此跳过没有变化的 app
+        self._revisions = {}
+        self._revision = 0
+        self._lock = threading.Lock()
 
     def get_all_service(self, config: dict, enabled_only: bool = True) -> List[Service]:
         # https://github.com/Netflix/eureka/wiki/Eureka-REST-operations
-        resp = self.eureka_execute(uri="/")
-        apps = resp.get("applications", {}).get("application", [])
+        with self._lock:
+            now = time.monotonic()
+            if self.delta and self._apps and now - self._last_fetch < self.delta_retention_sec and \
+                    now - self._last_full_fetch < self.full_fetch_interval_sec:
+                self.fetch_delta()
+            else:
+                self.fetch_full()
+            apps = [(name, list(instances.values()), self._revisions.get(name, -1)) for name, instances in
+                    self._apps.items()]
         services: List[Service] = []
-        for app in apps:
-            services.append(
-                Service(name=app.get("name"), instances=self.get_instances(app.get("instance", []), enabled_only)))
+        for name, instances, revision in apps:
+            services.append(Service(name=name, instances=self.get_instances(instances, enabled_only),
+                                    revision=revision))
         return services
 
+    def fetch_full(self):
+        resp = self.eureka_execute(uri="/")
+        apps = {}
+        for app in as_list(resp.get("applications", {}).get("application")):
+            apps[app.get("name")] = {item.get("instanceId"): item for item in as_list(app.get("instance"))}
+        origin, self._apps = self._apps, apps
+        for name in set(apps) | set(origin):
+            if self.signature(apps.get(name)) != self.signature(origin.get(name)):
+                self.bump_revision(name)
+        self._last_fetch = self._last_full_fetch = time.monotonic()
+
+    def fetch_delta(self):
+        """
+        增量拉取 /apps/delta 合并到本地镜像，合并后 hashcode 和服务端不一致时退回全量拉取
+        """
+        resp = self.eureka_execute(uri="/delta")
+        applications = resp.get("applications", {}) if isinstance(resp, dict) else {}
+        for app in as_list(applications.get("application")):
+            name = app.get("name")
+            instances = self._apps.setdefault(name, {})
+            for item in as_list(app.get("instance")):
+                if item.get("actionType") == "DELETED":
+                    instances.pop(item.get("instanceId"), None)
+                else:
+                    instances[item.get("instanceId")] = item
+            if not instances:
+                self._apps.pop(name, None)
+            self.bump_revision(name)
+        if self.hashcode() != applications.get("apps__hashcode"):
+            logger.info(
+                f"eureka 增量合并后 hashcode 不一致, 本地: {self.hashcode()}, 服务端: {applications.get('apps__hashcode')}, 改为全量拉取")
+            self.fetch_full()
+            return
+        self._last_fetch = time.monotonic()
+
+    def hashcode(self) -> str:
+        """
+        和 eureka 服务端相同的算法，按状态排序拼接 状态_数量_
+        """
+        counts = {}
+        for instances in self._apps.values():
+            for item in instances.values():
+                counts[item.get("status")] = counts.get(item.get("status"), 0) + 1
+        return "".join(f"{status}_{count}_" for status, count in sorted(counts.items()))
+
+    @staticmethod
+    def signature(instances: dict) -> set:
+        """
+        只比较同步关心的字段，续约时间等心跳字段的变化不算实例变化
+        """
+        return {(key, item.get("ipAddr"), json.dumps(item.get("port")), item.get("status"),
+                 json.dumps(item.get("metadata"), sort_keys=True)) for key, item in (instances or {}).items()}
+
+    def bump_revision(self, name: str):
+        self._revision += 1
+        self._revisions[name] = self._revision
+        if name not in self._apps:
+            self._revisions.pop(name, None)
+
     def get_service_all_instances(self, service_name: str, ext_data: dict, enabled_only: bool = True) -> tuple[
         List[Instance], int]:
         resp = self.eureka_execute(uri="/" + service_name)
         app = resp.get("application", {})
-        instances: List[Instance] = self.get_instances(app.get("instance", []), enabled_only)
+        instances: List[Instance] = self.get_instances(as_list(app.get("instance")), enabled_only)
         service_up_timestamp = -1
         if instances:
             service_up_timestamp = instances[0].ext.get("serviceUpTimestamp", -1)
@@ -69,9 +158,9 @@ class Eureka(Discovery):
         return instances
 
     def eureka_execute(self, method="GET", uri=None, params=None, data=None) -> dict:
-        resp = httpx.request(method, f"{self._config.host}{self._config.prefix}apps{uri}",
-                             params=params, data=data, timeout=10,
-                             headers={"Content-Type": "application/json", "Accept": "application/json"})
+        resp = self._transport.request(method, f"{self._config.host}{self._config.prefix}apps{uri}",
+                                       params=params, data=data,
+                                       headers={"Content-Type": "application/json", "Accept": "application/json"})
 
         logger.info(
             f"请求 eureka 接口, method: {method}, url: {self._config.host}{self._config.prefix}{uri}, 请求参数: {params}, 请求数据: {data}, 响应结果: {resp.text}")
@@ -0,0 +1,174 @@
+import gzip
+import hashlib
+import json
+import socket
+import threading
+from typing import List, Callable
+
+from core.lib.logger import for_service
+
+logger = for_service(__name__)
+
+SUBSCRIBE_MODE_POLL = "poll"
+SUBSCRIBE_MODE_UDP = "udp"
+# 默认查询间隔，单位秒
+POLL_INTERVAL_SEC = 30
+UDP_INTERVAL_SEC = 5
+
+
+def local_ip() -> str:
+    """
+    获取本机出口ip，nacos 推送 udp 时需要
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        try:
+            s.connect(("8.8.8.8", 80))
+            return s.getsockname()[0]
+        except OSError:
+            return "127.0.0.1"
+
+
+def hosts_checksum(hosts: list) -> str:
+    items = sorted(f"{item.get('ip')}:{item.get('port')}:{float(item.get('weight', 1))}:"
+                   f"{item.get('enabled', True)}:{item.get('healthy', True)}" for item in hosts or [])
+    return hashlib.sha1("\n".join(items).encode("utf-8")).hexdigest()
+
+
+class NacosSubscriber(object):
+    """
+    订阅 nacos 服务变更
+    poll: 定时查询 /ns/instance/list，实例列表的 checksum 变化时回调
+    udp: 查询时带上 udpPort/clientIP 注册推送地址，nacos 有变更时主动推送，同时保留定时查询兜底
+    """
+
+    def __init__(self, nacos):
+        self._nacos = nacos
+        config = nacos._config.config or {}
+        self.mode = config.get("subscribe-mode", SUBSCRIBE_MODE_POLL)
+        # poll 模式每个服务每轮一次 /ns/instance/list，定时 syncer 兜底，间隔可以长一些
+        # udp 模式查询同时用于续约推送地址，nacos 超过10秒没有查询就不再推送，间隔必须小于10秒
+        self.interval = float(config.get("poll-interval-sec",
+                                         POLL_INTERVAL_SEC if self.mode == SUBSCRIBE_MODE_POLL else UDP_INTERVAL_SEC))
+        self.udp_port = int(config.get("udp-port", 0))
+        self.client_ip = config.get("client-ip") or None
+        self._lock = threading.Lock()
+        # 作业 id -> (作业, 服务 key 集合, 回调)
+        self._watches = {}
+        # 服务 key (namespaceId, groupName, serviceName) -> checksum
+        self._checksums = {}
+        self._stop = threading.Event()
+        self._threads = []
+        self._socket = None
+
+    @staticmethod
+    def service_key(target: dict, service_name: str) -> tuple:
+        config = target.get("config") or {}
+        return config.get("namespaceId", ""), config.get("groupName", "DEFAULT_GROUP"), service_name
+
+    def watch(self, target: dict, service_names: List[str], callback: Callable[[dict, str], None]):
+        """
+        设置作业需要订阅的服务，会替换该作业之前订阅的服务
+        @param target: 同步作业
+        @param service_names: 服务名称列表
+        @param callback: 服务有变更时回调 callback(target, service_name)
+        """
+        with self._lock:
+            self._watches[target.get("id")] = (target, {self.service_key(target, name) for name in service_names},
+                                               callback)
+            if not self._threads:
+                self.start()
+
+    def start(self):
+        if self.mode == SUBSCRIBE_MODE_UDP:
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._socket.bind(("0.0.0.0", self.udp_port))
+            self._socket.settimeout(1)
+            self.udp_port = self._socket.getsockname()[1]
+            self.client_ip = self.client_ip or local_ip()
+            self._threads.append(threading.Thread(target=self.receive, name="nacos-udp-push", daemon=True))
+        self._threads.append(threading.Thread(target=self.poll, name="nacos-subscribe-poll", daemon=True))
+        for t in self._threads:
+            t.start()
+        logger.info(f"开始订阅 nacos 服务变更, mode: {self.mode}, udp: {self.client_ip}:{self.udp_port}")
+
+    def close(self):
+        self._stop.set()
+        for t in self._threads:
+            t.join(timeout=self.interval + 1)
+        if self._socket is not None:
+            self._socket.close()
+
+    def keys(self) -> set:
+        with self._lock:
+            return set().union(*[keys for _, keys, _ in self._watches.values()])
+
+    def poll(self):
+        """
+        每轮把所有订阅的服务查询一次，多个作业订阅的同一个服务只查询一次，
+        查询均匀分散在 interval 内，服务多时不会每隔 interval 集中请求 nacos
+        """
+        while not self._stop.is_set():
+            keys = self.keys()
+            pause = self.interval / len(keys) if keys else self.interval
+            for key in keys:
+                try:
+                    self.query(key)
+                except Exception as e:
+                    logger.warning(f"查询 nacos 服务 {key} 实例失败", exc_info=e)
+                if self._stop.wait(pause):
+                    break
+            if not keys:
+                self._stop.wait(pause)
+
+    def query(self, key: tuple):
+        namespace_id, group_name, service_name = key
+        params = {"serviceName": service_name, "groupName": group_name, "namespaceId": namespace_id,
+                  "healthyOnly": False}
+        if self.mode == SUBSCRIBE_MODE_UDP:
+            # nacos 通过查询请求登记推送地址，超过10秒不查询就不再推送
+            params |= {"udpPort": self.udp_port, "clientIP": self.client_ip}
+        resp = self._nacos.nacos_execute(uri="ns/instance/list", params=params)
+        if isinstance(resp, dict):
+            self.changed(key, resp.get("checksum") or hosts_checksum(resp.get("hosts", [])))
+
+    def receive(self):
+        while not self._stop.is_set():
+            try:
+                packet, addr = self._socket.recvfrom(64 * 1024)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            try:
+                if packet[:2] == b"\x1f\x8b":
+                    packet = gzip.decompress(packet)
+                msg = json.loads(packet.decode("utf-8"))
+                ack = {"type": "push-ack", "lastRefTime": str(msg.get("lastRefTime", 0)), "data": ""}
+                self._socket.sendto(json.dumps(ack).encode("utf-8"), addr)
+                if msg.get("type") not in ("dom", "service"):
+                    continue
+                data = json.loads(msg.get("data") or "{}")
+                group_name, _, service_name = data.get("name", "").rpartition("@@")
+                checksum = data.get("checksum") or hosts_checksum(data.get("hosts", []))
+                for key in self.keys():
+                    if key[2] == service_name and (not group_name or key[1] == group_name):
+                        self.changed(key, checksum)
+            except Exception as e:
+                logger.warning(f"处理 nacos udp 推送失败 {packet[:200]}", exc_info=e)
+
+    def changed(self, key: tuple, checksum: str):
+        """
+        记录服务 checksum，第一次只记录不回调，之后 checksum 变化时回调订阅了该服务的作业
+        """
+        with self._lock:
+            origin = self._checksums.get(key)
+            self._checksums[key] = checksum
+            if origin is None or origin == checksum:
+                return
+            callbacks = [(target, callback) for target, keys, callback in self._watches.values() if key in keys]
+        logger.info(f"nacos 服务 {key} 有变更, 立即同步, 作业: {[target.get('id') for target, _ in callbacks]}")
+        for target, callback in callbacks:
+            try:
+                callback(target, key[2])
+            except Exception as e:
+                logger.warning(f"nacos 服务变更回调失败 {target.get('id')} {key}", exc_info=e)
@@ -0,0 +1,123 @@
+import hashlib
+import json
+import os
+import pathlib
+import tempfile
+import threading
+from typing import List
+
+from app.model.syncer_model import Instance
+from core.lib.logger import for_service
+
+logger = for_service(__name__)
+
+
+class FingerprintStore(object):
+    """
+    记录每个 (作业, 服务) 上一次成功写入网关的实例指纹，指纹没变化时跳过网关的读取和写入
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._items = {}
+        self._revisions = {}
+        self._cycles = {}
+        self._dirty = False
+
+    @staticmethod
+    def fingerprint(instances: List[Instance]) -> str:
+        items = sorted(f"{item.ip}:{item.port}:{float(item.weight)}:{item.enabled}" for item in instances or [])
+        return hashlib.sha1("\n".join(items).encode("utf-8")).hexdigest()
+
+    def get(self, target_id: str, service_name: str) -> str:
+        return self._items.get(f"{target_id}/{service_name}")
+
+    def put(self, target_id: str, service_name: str, fingerprint: str):
+        key = f"{target_id}/{service_name}"
+        with self._lock:
+            if self._items.get(key) != fingerprint:
+                self._items[key] = fingerprint
+                self._dirty = True
+
+    def get_revision(self, target_id: str, service_name: str) -> int:
+        return self._revisions.get(f"{target_id}/{service_name}")
+
+    def put_revision(self, target_id: str, service_name: str, revision: int):
+        """
+        记录上一次成功同步时注册中心的服务版本号，注册中心不支持版本号(-1)时不记录
+        """
+        if revision is not None and revision >= 0:
+            self._revisions[f"{target_id}/{service_name}"] = revision
+
+    def discard(self, target_id: str, service_name: str = None):
+        """
+        删除指纹，下一轮会重新读取网关比对
+        @param target_id: 作业id
+        @param service_name: 服务名称，为空时删除整个作业的指纹
+        """
+        with self._lock:
+            if service_name is not None:
+                self._revisions.pop(f"{target_id}/{service_name}", None)
+                self._dirty = self._items.pop(f"{target_id}/{service_name}", None) is not None or self._dirty
+                return
+            prefix = f"{target_id}/"
+            for key in [key for key in self._revisions if key.startswith(prefix)]:
+                self._revisions.pop(key)
+            for key in [key for key in self._items if key.startswith(prefix)]:
+                self._items.pop(key)
+                self._dirty = True
+
+    def next_cycle(self, target_id: str, verify_cycles: int) -> bool:
+        """
+        作业进入下一轮同步
+        @param target_id: 作业id
+        @param verify_cycles: 每隔多少轮做一次全量校验
+        @return: 本轮是否需要全量校验(不使用指纹跳过)
+        """
+        with self._lock:
+            cycle = self._cycles.get(target_id, 0)
+            self._cycles[target_id] = cycle + 1
+        return verify_cycles <= 1 or cycle % verify_cycles == 0
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._revisions.clear()
+            self._cycles.clear()
+            self._dirty = False
+
+    def load(self, file_name: str):
+        """
+        加载上次保存的指纹，文件里的指纹都是全量校验或成功写入网关后记录的，
+        加载到指纹的作业视为已经完成第 0 轮，重启后第一轮不再强制全量校验，否则持久化没有意义
+        """
+        if not file_name or not os.path.exists(file_name):
+            return
+        try:
+            with open(file_name, encoding="utf-8") as f:
+                items = json.load(f)
+            with self._lock:
+                self._items.update(items)
+                for key in items:
+                    self._cycles.setdefault(key.split("/", 1)[0], 1)
+        except Exception as e:
+            logger.warning(f"加载实例指纹文件 {file_name} 失败", exc_info=e)
+
+    def dump(self, file_name: str):
+        if not file_name or not self._dirty:
+            return
+        with self._lock:
+            content = json.dumps(self._items)
+            self._dirty = False
+        pathlib.Path(file_name).parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=pathlib.Path(file_name).parent, prefix=".fingerprint-")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(content)
+            os.replace(tmp_name, file_name)
+        except Exception as e:
+            logger.warning(f"保存实例指纹文件 {file_name} 失败", exc_info=e)
+            pathlib.Path(tmp_name).unlink(missing_ok=True)
+
+
+fingerprints = FingerprintStore()
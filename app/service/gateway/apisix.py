@@ -1,17 +1,23 @@
+import asyncio
 import json
+import os
 import pathlib
 import tempfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from string import Template
-from threading import Thread
-from typing import List
+from threading import Thread, Lock
+from typing import List, Tuple, Optional, Iterator, Iterable, Callable
 import re
 
 import httpx
 import yaml
 
-from app.model.syncer_model import Instance
+from app.model.syncer_model import Instance, SyncOutcome
 from app.service import repr_str
 from app.service.gateway.gateway import Gateway
+from app.service.gateway.restore import RestoreExecutor, RestoreTask, RateLimiter
 from core.lib.logger import for_service
 
 logger = for_service(__name__)
@@ -65,6 +71,8 @@ $Value
 
 fetch_all_upstream = "upstreams"
 
+# order 为还原时的批次，引用其他资源的要排在被引用的资源之后:
+# consumer.group_id -> consumer_groups，service.upstream_id -> upstreams，route/stream_route -> upstreams/services/plugin_configs
 apisix_uri_dict = {
     "ssl": {"version": [APISIX_V2], "field": "ssl", "order": 0},
     "ssls": {"version": [APISIX_V3], "field": "ssls", "order": 0},
@@ -73,13 +81,13 @@ apisix_uri_dict = {
     "secrets": {"version": [APISIX_V3], "field": "secrets", "order": 0},
     "plugins/list": {"version": [APISIX_V2, APISIX_V3], "field": "plugins", "order": 0},
     "global_rules": {"version": [APISIX_V2, APISIX_V3], "field": "global_rules", "order": 0},
-    "stream_routes": {"version": [APISIX_V2, APISIX_V3], "field": "stream_routes", "order": 0},
+    "stream_routes": {"version": [APISIX_V2, APISIX_V3], "field": "stream_routes", "order": 3},
     "plugin_configs": {"version": [APISIX_V2, APISIX_V3], "field": "plugin_configs", "order": 0},
     "plugin_metadata": {"version": [APISIX_V2, APISIX_V3], "field": "plugin_metadata", "order": 0},
-    "consumers": {"version": [APISIX_V2, APISIX_V3], "field": "consumers", "order": 1},
+    "consumers": {"version": [APISIX_V2, APISIX_V3], "field": "consumers", "order": 2},
     "services": {"version": [APISIX_V2, APISIX_V3], "field": "services", "order": 2},
-    "upstreams": {"version": [APISIX_V2, APISIX_V3], "field": "upstreams", "order": 2},
-    "consumer_groups": {"version": [APISIX_V3], "field": "consumer_groups", "order": 2},
+    "upstreams": {"version": [APISIX_V2, APISIX_V3], "field": "upstreams", "order": 1},
+    "consumer_groups": {"version": [APISIX_V3], "field": "consumer_groups", "order": 1},
     "routes": {"version": [APISIX_V2, APISIX_V3], "field": "routes", "order": 3},
 }
 
@@ -89,48 +97,232 @@ alias_uris = {"ssl": "ssls", "proto": "protos", "ssls": "ssl", "protos": "proto"
 
 has_upstream = ["/apisix/routes/", "/apisix/stream_routes/", "/apisix/services/", "/apisix/upstreams/"]
 
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+
+class _ApisixDumper(yaml.SafeDumper):
+    """多行字符串使用 | 块格式输出，只注册在这个子类上，不修改全局的 yaml.SafeDumper"""
+    org_represent_str = yaml.SafeDumper.represent_str
+
+
+_ApisixDumper.add_representer(str, repr_str)
+
+
+def safe_dump(data) -> str:
+    return yaml.dump(data, Dumper=_ApisixDumper, sort_keys=True, allow_unicode=True, default_flow_style=False)
+
+
+def tee_to_file(chunks: Iterable[bytes], file_name: str, compress: bool = False,
+                cleanup: Callable[[], None] = None) -> Iterator[bytes]:
+    """
+    边输出边写入文件，先写同目录的临时文件，全部输出完成后再 rename，中途失败不会覆盖已有的文件
+    @param chunks: 内容
+    @param file_name: 文件名
+    @param compress: 是否 gzip 压缩，文件和输出的都是压缩后的内容
+    @param cleanup: 结束(包括中途失败、客户端断开)时的清理
+    """
+    path = pathlib.Path(file_name)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix=f".{path.name}.", dir=path.parent)
+    # wbits=31 输出 gzip 格式
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in chunks:
+                data = compressor.compress(chunk) if compressor else chunk
+                if data:
+                    f.write(data)
+                    yield data
+            if compressor:
+                data = compressor.flush()
+                f.write(data)
+                yield data
+        os.replace(tmp, path)
+    except BaseException as e:
+        if not isinstance(e, GeneratorExit):
+            logger.error(f"导出网关配置到文件 {file_name} 失败", exc_info=e)
+        pathlib.Path(tmp).unlink(missing_ok=True)
+        raise
+    finally:
+        if cleanup:
+            cleanup()
+
 
 class Apisix(Gateway):
     def __init__(self, config):
         super().__init__(config)
         self.service_name_map = {}
+        # upstream 名称 -> {id, nodes, modifiedIndex}，begin_cycle 后第一次读取网关时刷新
+        self.upstream_index = None
+        self._index_stale = False
+        self._index_lock = Lock()
+        # upstream 名称 -> {writes, skipped, conflicts, failures}
+        self._write_stats = {}
+        self._stats_lock = Lock()
+        # 同一个网关的多次还原共用一个速率限制
+        self.restore_rate_limiter = RateLimiter(float(config.config.get("restore-qps", 0)))
         self.VERSION = config.config.get("version", APISIX_V2)
 
+    def begin_cycle(self, target: dict):
+        """
+        每轮同步开始时标记 upstream 快照过期，本轮第一个需要读取网关的服务再拉取全部 upstream，
+        本轮内的其他服务都从快照中查找; 指纹没有变化的服务不读取网关，整轮都跳过时不拉取
+        @param target: target配置
+        """
+        self._index_stale = True
+
+    def refresh_upstream_index(self, target: dict):
+        """
+        拉取全部 upstream 快照，并发同步时只有一个线程拉取，其他线程等待后直接使用
+        @param target: target配置
+        """
+        with self._index_lock:
+            if not self._index_stale:
+                return
+            index = {}
+            for upstream in self.iter_resources(fetch_all_upstream):
+                name = upstream.get("value", {}).get("name")
+                if name:
+                    index[name] = self.upstream_entry(upstream)
+            self.upstream_index = index
+            self.service_name_map.update(
+                {name: f"{fetch_all_upstream}/{item.get('id')}" for name, item in index.items()})
+            self._index_stale = False
+        logger.info(f"拉取 apisix upstream 快照, 作业: {target.get('id')}, upstream 数量: {len(index)}")
+
+    def iter_resources(self, uri: str):
+        """
+        分页拉取资源列表，v3 使用 page/page_size 分页，v2 为 etcd 目录结构，一次返回全部
+        @param uri: 资源路径，比如 upstreams
+        @return: 资源迭代器，元素为 {"key", "value", "modifiedIndex", ...}
+        """
+        if APISIX_V3 != self.VERSION:
+            yield from self.apisix_execute("GET", uri, {}).get("list", [])
+            return
+        page_size = int(self._config.config.get("page-size", 500))
+        page, fetched = 1, 0
+        while True:
+            resp = self.apisix_execute("GET", uri, {"page": page, "page_size": page_size})
+            items = resp.get("list") or []
+            yield from items
+            fetched += len(items)
+            if len(items) < page_size or fetched >= resp.get("total", 0):
+                break
+            page += 1
+
+    @staticmethod
+    def upstream_entry(upstream: dict) -> dict:
+        value = upstream.get("value", {})
+        # modifiedIndex 在 etcd 节点上(和 value 同级)，没有时用 value.update_time
+        return {"id": value.get("id"), "nodes": value.get("nodes"),
+                "modifiedIndex": upstream.get("modifiedIndex", value.get("modifiedIndex", value.get("update_time")))}
+
+    @staticmethod
+    def normalize_nodes(nodes) -> Tuple[Tuple[str, int, float], ...]:
+        """
+        节点集合的规范形式，忽略顺序、list/dict 两种写法以及 1 和 1.0 的差异
+        @param nodes: upstream.nodes 或者 Instance 列表
+        @return: 排好序的 (host, port, weight)
+        """
+        if isinstance(nodes, dict):
+            items = [(addr.rsplit(":", 1)[0], addr.rsplit(":", 1)[1], weight) for addr, weight in nodes.items()]
+        else:
+            items = [(node.ip, node.port, node.weight) if isinstance(node, Instance) else (
+                node.get("host"), node.get("port"), node.get("weight")) for node in nodes or []]
+        return tuple(sorted((str(host), int(port), float(weight or 0)) for host, port, weight in items))
+
+    def count_write(self, upstream_name: str, key: str):
+        with self._stats_lock:
+            stats = self._write_stats.setdefault(upstream_name,
+                                                 {"writes": 0, "skipped": 0, "conflicts": 0, "failures": 0})
+            stats[key] += 1
+
+    def write_stats(self) -> dict:
+        with self._stats_lock:
+            return {name: dict(stats) for name, stats in self._write_stats.items()}
+
+    def fetch_upstream(self, upstream_name: str) -> Optional[dict]:
+        """
+        写入前重新读取单个 upstream，读取失败返回 None
+        @return: {id, nodes, modifiedIndex}
+        """
+        uri = self.service_name_map.get(upstream_name)
+        if not uri:
+            return None
+        try:
+            resp = self.apisix_execute("GET", uri, {})
+        except Exception as e:
+            logger.warning(f"读取 upstream {upstream_name} 失败, 按快照比对的结果写入", exc_info=e)
+            return None
+        for upstream in resp.get("list") or [resp]:
+            if upstream.get("value", {}).get("name") == upstream_name:
+                return self.upstream_entry(upstream)
+        return None
+
+    @staticmethod
+    def nodes_to_instances(nodes) -> List[Instance]:
+        instances = []
+        if isinstance(nodes, list):
+            for node in nodes:
+                instances.append(Instance(ip=node.get("host"), port=node.get("port"), weight=node.get("weight")))
+        elif isinstance(nodes, dict):
+            for addr, weight in nodes.items():
+                host, port = addr.split(":")
+                instances.append(Instance(ip=host, port=port, weight=weight))
+        return instances
+
     def get_service_all_instances(self, target: dict, upstream_name: str = None) -> List[Instance]:
         # 如果 target.upstream_prefix 存在，则使用 upstream_prefix-upstream_name，否则直接使用 upstream_name
         upstream_name = self.get_upstream_name(target, upstream_name)
+        if self._index_stale:
+            self.refresh_upstream_index(target)
+        # 有快照直接从快照里取，快照里没有说明是新服务
+        if self.upstream_index is not None:
+            entry = self.upstream_index.get(upstream_name)
+            return self.nodes_to_instances(entry.get("nodes")) if entry else []
         # 如果upstream_name为空，则获取所有upstream的实例
         uri = self.service_name_map.get(upstream_name, fetch_all_upstream)
 
         resp = self.apisix_execute("GET", uri, {})
-        instances = []
         if "list" not in resp:
             resp["list"] = [resp]
         for upstream in resp.get("list", []):
             self.service_name_map[
                 upstream.get("value").get("name")] = f"{fetch_all_upstream}/{upstream.get('value').get('id')}"
             if upstream_name != upstream.get("value").get('name'): continue
+            return self.nodes_to_instances(upstream.get("value").get("nodes"))
+        return []
 
-            if isinstance(upstream.get("value").get("nodes"), list):
-                for node in upstream.get("value").get("nodes"):
-                    instances.append(Instance(ip=node.get("host"), port=node.get("port"), weight=node.get("weight")))
-            elif isinstance(upstream.get("value").get("nodes"), dict):
-                for addr, weight in upstream.get("value").get("nodes").items():
-                    host, port = addr.split(":")
-                    instances.append(Instance(ip=host, port=port, weight=weight))
-            break
-        return instances
-
-    def sync_instances(self, target: dict, upstream_name: str, diff_ins: list, instances: list):
+    def sync_instances(self, target: dict, upstream_name: str, diff_ins: list, instances: list) -> List[SyncOutcome]:
         if not diff_ins and not instances:
             logger.info(f"没有变更实例，跳过同步")
-            return
+            return []
 
         # apisix 不支持变量更新nodes，所以diffIns无用，直接用discoveryInstances即可
-        nodes_json = json.dumps([{"host": item.ip, "port": item.port, "weight": item.weight} for item in instances])
+        nodes_json = json.dumps([{"host": item.ip, "port": item.port,
+                                  "weight": int(item.weight) if float(item.weight).is_integer() else item.weight}
+                                 for item in instances])
         method = "PATCH"
         upstream_name = self.get_upstream_name(target, upstream_name)
 
+        # 条件写入: 比对的网关实例来自快照，写入前重新读取 upstream，modifiedIndex 和快照不同说明比对之后被其他人改过，
+        # 记为冲突并按最新的节点重新比对，节点集合和要写入的一致时跳过，避免产生无意义的 etcd revision
+        # apisix admin api 没有 If-Match，读取和写入之间的修改仍然会被覆盖，由下一次全量比对纠正
+        snapshot = (self.upstream_index or {}).get(upstream_name)
+        current = self.fetch_upstream(upstream_name)
+        if current is not None:
+            if snapshot is not None and current.get("modifiedIndex") != snapshot.get("modifiedIndex"):
+                self.count_write(upstream_name, "conflicts")
+                logger.warning(f"upstream {upstream_name} 在比对之后被修改过, modifiedIndex: "
+                               f"{snapshot.get('modifiedIndex')} -> {current.get('modifiedIndex')}, 按最新节点重新比对")
+            if self.upstream_index is not None:
+                self.upstream_index[upstream_name] = current
+            snapshot = current
+        if snapshot is not None and self.normalize_nodes(snapshot.get("nodes")) == self.normalize_nodes(instances):
+            self.count_write(upstream_name, "skipped")
+            logger.info(f"upstream {upstream_name} 的节点和注册中心一致，跳过写入")
+            return [SyncOutcome(upstream=upstream_name, action="skip")]
+
         uri = self.service_name_map.get(upstream_name)
         if uri:
             uri = f"{uri}/nodes"
@@ -141,61 +333,124 @@ class Apisix(Gateway):
             tpl = Template(target.get("config").get("template", default_apisix_upstream_template))
             body = tpl.substitute(name=upstream_name, nodes=nodes_json)
 
-        resp = self.apisix_execute(method, uri, {}, body)
+        outcome = SyncOutcome(upstream=upstream_name, action="update" if method == "PATCH" else "create",
+                              success=False)
+        self.count_write(upstream_name, "writes")
+        try:
+            resp = self.apisix_execute(method, uri, {}, body)
+        except Exception as e:
+            self.count_write(upstream_name, "failures")
+            outcome.message = f"{e.args}"
+            return [outcome]
         logger.info(f"更新 upstream 结果: {resp}")
+        # 写入成功后同步更新快照，保证本轮后续查询拿到的是最新节点
+        for upstream in resp.get("list") or [resp]:
+            if upstream.get("value", {}).get("name") != upstream_name:
+                continue
+            outcome.success = True
+            if self.upstream_index is not None:
+                self.upstream_index[upstream_name] = self.upstream_entry(upstream)
+            self.service_name_map[upstream_name] = f"{fetch_all_upstream}/{upstream.get('value').get('id')}"
+        if not outcome.success:
+            self.count_write(upstream_name, "failures")
+            outcome.message = f"{resp}"
+        return [outcome]
 
     def fetch_admin_api_to_file(self, file_name: str):
         """
         从apisix获取upstream信息，并保存到文件
         @return:
         """
-        val = {}
-        for uri, item in apisix_uri_dict.items():
-            if self.VERSION not in item.get("version"):
-                continue
-            resp = self.apisix_execute("GET", uri, {}, None)
-            val[item.get("field")] = []
-            for vv in resp.get("list"):
-                item_val = vv.get("value", vv)
-                if item_val.get("status", 1) == 0:
-                    continue
-                item_val.pop("create_time", None)
-                item_val.pop("update_time", None)
-                val[item.get("field")].append(item_val)
-
-        yaml.SafeDumper.org_represent_str = yaml.SafeDumper.represent_str
-
-        yaml.add_representer(str, repr_str, Dumper=yaml.SafeDumper)
+        stream, file_name = self.stream_admin_api_to_file(file_name)
+        return b"".join(stream).decode("utf-8"), file_name
 
-        content = Template(apisix_config_template).substitute(
-            Value=yaml.safe_dump(val, sort_keys=True, allow_unicode=True, default_flow_style=False),
-            VersionComment=apisix_config_version_comment.get(self.VERSION),
-            Version=self.VERSION)
+    def stream_admin_api_to_file(self, file_name: str, compress: bool = False) -> Tuple[Iterator[bytes], str]:
+        """
+        并发分页拉取各类资源，每类资源边拉取边渲染到临时文件，再按字段名顺序流式输出，内存占用和网关规模无关
+        输出内容和一次性 yaml.safe_dump 的结果相同，可以直接用于还原
+        @param file_name: 保存的文件名，为空时为 临时目录/apisix.yaml
+        @param compress: 是否 gzip 压缩，压缩时文件名加 .gz 后缀
+        @return: (内容迭代器，迭代的同时写入文件，文件名)
+        """
         file_name = file_name or tempfile.gettempdir() + "/apisix.yaml"
-        pathlib.Path(file_name).parent.mkdir(parents=True, exist_ok=True)
-        with open(file_name, "w") as f:
-            f.write(content)
-        return content, file_name
-
-    async def restore_gateway(self, body: str):
+        if compress and not file_name.endswith(".gz"):
+            file_name += ".gz"
+        sections = sorted((item.get("field"), uri) for uri, item in apisix_uri_dict.items() if
+                          self.VERSION in item.get("version"))
+        concurrency = max(int(self._config.config.get("export-concurrency", 4)), 1)
+        pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="apisix-export")
+        spools = {field: tempfile.TemporaryFile() for field, _ in sections}
+        futures = {field: pool.submit(self.export_section, uri, spools[field]) for field, uri in sections}
+        prefix, suffix = Template(apisix_config_template).substitute(
+            Value="\0", VersionComment=apisix_config_version_comment.get(self.VERSION),
+            Version=self.VERSION).split("\0")
+
+        def chunks() -> Iterator[bytes]:
+            yield prefix.encode("utf-8")
+            for field, _ in sections:
+                if not futures[field].result():
+                    yield f"{field}: []\n".encode("utf-8")
+                    continue
+                yield f"{field}:\n".encode("utf-8")
+                spool = spools[field]
+                spool.seek(0)
+                while data := spool.read(EXPORT_CHUNK_SIZE):
+                    yield data
+                spool.close()
+            yield suffix.encode("utf-8")
+
+        def cleanup():
+            pool.shutdown(wait=False, cancel_futures=True)
+            for spool in spools.values():
+                spool.close()
+
+        return tee_to_file(chunks(), file_name, compress, cleanup), file_name
+
+    def export_section(self, uri: str, spool) -> int:
+        """
+        拉取一类资源，每一页渲染成 yaml 列表项追加到 spool
+        @return: 资源数量
+        """
+        count = 0
+        for vv in self.iter_resources(uri):
+            item_val = vv.get("value", vv)
+            if item_val.get("status", 1) == 0:
+                continue
+            item_val.pop("create_time", None)
+            item_val.pop("update_time", None)
+            spool.write(safe_dump([item_val]).encode("utf-8"))
+            count += 1
+        logger.info(f"导出 apisix {uri} 数量: {count}")
+        return count
+
+    async def restore_gateway(self, body: str) -> dict:
+        """
+        按 apisix_uri_dict 的 order 分批还原，同一批并发写入，线程数 restore-workers，速率 restore-qps
+        @return: RestoreExecutor.run 的汇总结果
+        """
         versions = re.findall(r">>>  (\w+)  <<<", body or '')
         if versions and self.VERSION != versions[0]:
             logger.warning(
                 f"通过配置文件还原apisix配置，apisix version: {self.VERSION}, 配置文件 version: {versions[0]} 不同版本导入可能会失败")
         data = yaml.safe_load(body)
-        threads = []
-        for uri, item in sorted(apisix_uri_dict.items(), key=lambda x: x[1].get("order")):
-            item_data = data.get(item.get('field'), [])
+        tasks = []
+        for uri, item in apisix_uri_dict.items():
+            item_data = data.get(item.get('field')) or []
             if ignore_uris.__contains__(uri) or self.VERSION not in item.get("version") or len(item_data) == 0:
                 continue
-            logger.info(f"开始恢复 {uri} 数据 {item_data}")
+            logger.info(f"准备恢复 {uri} 数据, 数量: {len(item_data)}")
             for val in item_data:
-                t = Thread(target=self.apisix_execute,
-                           args=("PUT", uri + "/" + val.get("id", val.get("name")), {}, json.dumps(val)))
-                t.start()
-                threads.append(t)
-        for t in threads:
-            t.join()
+                # consumer 以 username 为主键，plugin_metadata 以插件名为主键
+                item_id = str(val.get("id") or val.get("username") or val.get("name"))
+                tasks.append(RestoreTask(item.get("order"), uri, item_id,
+                                         partial(self.apisix_request, "PUT", f"{uri}/{item_id}", {}, json.dumps(val))))
+        executor = RestoreExecutor(workers=int(self._config.config.get("restore-workers", 8)),
+                                   rate_limiter=self.restore_rate_limiter,
+                                   retries=int(self._config.config.get("restore-retries", 3)))
+        result = await asyncio.get_running_loop().run_in_executor(None, executor.run, tasks)
+        logger.info(f"还原 apisix 完成, 总数: {result['total']}, 成功: {result['succeeded']}, "
+                    f"失败: {result['failed']}, 重试: {result['retried']}, 耗时: {result['elapsed_sec']}s")
+        return result
 
     async def migrate_to(self, target_gateway: Gateway):
         assert isinstance(target_gateway, Apisix), "目前仅支持apisix网关之间的迁移"
@@ -259,18 +514,7 @@ class Apisix(Gateway):
         return data
 
     def apisix_execute(self, method, uri, params, data=None):
-        http_resp = httpx.request(method, f"{self._config.admin_url}{self._config.prefix}{uri}",
-                                  params=params, data=data, timeout=10,
-                                  headers={"X-API-KEY": self._config.config.get("X-API-KEY"),
-                                           "Content-Type": "application/json", "Accept": "application/json"})
-        resp_txt = http_resp.text
-        if http_resp.status_code >= 400:
-            logger.warning(
-                f"请求 apisix 接口,version: {self._config.config.get('version')}, method: {method}, url: {self._config.admin_url}{self._config.prefix}{uri}, 请求参数: {params}, 请求数据: {data}, 响应结果: {resp_txt}")
-        else:
-            logger.info(
-                f"请求 apisix 接口,version: {self._config.config.get('version')}, method: {method}, url: {self._config.admin_url}{self._config.prefix}{uri}, 请求参数: {params}, 请求数据: {data}, 响应结果: {resp_txt}")
-
+        resp_txt = self.apisix_request(method, uri, params, data).text
         resp = json.loads(resp_txt)
 
         if "error_msg" in resp:
@@ -285,3 +529,18 @@ class Apisix(Gateway):
             if "value" in resp.get("node", {}):
                 resp["list"].append(resp.get("node", {}))
         return resp
+
+    def apisix_request(self, method, uri, params, data=None) -> httpx.Response:
+        http_resp = self._transport.request(method, f"{self._config.admin_url}{self._config.prefix}{uri}",
+                                            params=params, data=data,
+                                            headers={"X-API-KEY": self._config.config.get("X-API-KEY"),
+                                                     "Content-Type": "application/json",
+                                                     "Accept": "application/json"})
+        resp_txt = http_resp.text
+        if http_resp.status_code >= 400:
+            logger.warning(
+                f"请求 apisix 接口,version: {self._config.config.get('version')}, method: {method}, url: {self._config.admin_url}{self._config.prefix}{uri}, 请求参数: {params}, 请求数据: {data}, 响应结果: {resp_txt}")
+        else:
+            logger.info(
+                f"请求 apisix 接口,version: {self._config.config.get('version')}, method: {method}, url: {self._config.admin_url}{self._config.prefix}{uri}, 请求参数: {params}, 请求数据: {data}, 响应结果: {resp_txt}")
+        return http_resp
@@ -0,0 +1,177 @@
+import json
+import os
+import pathlib
+import tempfile
+import threading
+import time
+from string import Template
+from typing import List, Tuple
+
+import yaml
+
+from app.model.syncer_model import Instance, SyncOutcome
+from app.service.gateway.apisix import Apisix, APISIX_V2, apisix_config_template, apisix_config_version_comment, \
+    default_apisix_upstream_template, safe_dump
+from app.service.gateway.gateway import Gateway
+from core.lib.logger import for_service
+
+logger = for_service(__name__)
+
+
+class ApisixStandalone(Gateway):
+    """
+    apisix standalone(db-less) 模式，不经过 admin api，直接维护本地 apisix.yaml 的 upstreams 部分
+    其他部分(routes 等)原样保留，每个 upstream 单独渲染并缓存，只重新渲染有变化的 upstream
+    短时间内的多次变更合并成一次写入，写入先写临时文件再 rename，apisix 不会读到写了一半的文件
+    """
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.file = config.config.get("file")
+        self.VERSION = config.config.get("version", APISIX_V2)
+        self.debounce_sec = float(config.config.get("debounce-sec", 1))
+        self._lock = threading.Lock()
+        self._timer = None
+        # 文件中除 upstreams 外的部分，以及渲染好的文本
+        self._others = {}
+        self._others_text = ""
+        # upstream 名称 -> upstream，保持文件中的顺序
+        self._upstreams = {}
+        # upstream 名称 -> 渲染好的 yaml 列表项
+        self._rendered = {}
+        # 等待写入的 upstream 名称 -> upstream
+        self._pending = {}
+        self._mtime = None
+        self.load()
+
+    def load(self):
+        """
+        从文件加载，文件不存在时从空配置开始，文件被外部修改过时也会重新加载
+        """
+        path = pathlib.Path(self.file)
+        doc = yaml.safe_load(path.read_text(encoding="utf-8")) if path.exists() else None
+        doc = doc or {}
+        upstreams = doc.pop("upstreams", None) or []
+        self._others = doc
+        self._others_text = safe_dump(doc) if doc else ""
+        self._upstreams = {item.get("name", item.get("id")): item for item in upstreams}
+        self._rendered = {name: safe_dump([item]) for name, item in self._upstreams.items()}
+        self._mtime = path.stat().st_mtime_ns if path.exists() else None
+        logger.info(f"加载 apisix standalone 配置 {self.file}, upstream 数量: {len(self._upstreams)}")
+
+    def get_service_all_instances(self, target: dict, upstream_name: str = None) -> List[Instance]:
+        upstream_name = self.get_upstream_name(target, upstream_name)
+        with self._lock:
+            upstream = self._pending.get(upstream_name, self._upstreams.get(upstream_name))
+        return Apisix.nodes_to_instances(upstream.get("nodes")) if upstream else []
+
+    def sync_instances(self, target: dict, upstream_name: str, diff_ins: list, instances: list) -> List[SyncOutcome]:
+        if not diff_ins and not instances:
+            logger.info(f"没有变更实例，跳过同步")
+            return []
+        upstream_name = self.get_upstream_name(target, upstream_name)
+        nodes = [{"host": item.ip, "port": item.port,
+                  "weight": int(item.weight) if float(item.weight).is_integer() else item.weight}
+                 for item in instances]
+        with self._lock:
+            origin = self._pending.get(upstream_name, self._upstreams.get(upstream_name))
+            if origin is not None and Apisix.normalize_nodes(origin.get("nodes")) == Apisix.normalize_nodes(nodes):
+                logger.info(f"upstream {upstream_name} 的节点和注册中心一致，跳过写入")
+                return [SyncOutcome(upstream=upstream_name, action="skip")]
+            if origin is None:
+                tpl = Template(target.get("config").get("template", default_apisix_upstream_template))
+                upstream = json.loads(tpl.substitute(name=upstream_name, nodes=json.dumps(nodes)))
+                upstream.setdefault("id", upstream_name)
+            else:
+                upstream = dict(origin, nodes=nodes)
+            self._pending[upstream_name] = upstream
+            self.schedule()
+        return [SyncOutcome(upstream=upstream_name, action="update" if origin else "create")]
+
+    def schedule(self):
+        """
+        第一个变更到达后等待 debounce-sec 秒，期间的变更合并成一次写入，调用方需要持有 self._lock
+        """
+        if self._timer is not None:
+            return
+        self._timer = threading.Timer(self.debounce_sec, self.flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def flush(self):
+        with self._lock:
+            self._timer = None
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, {}
+            try:
+                path = pathlib.Path(self.file)
+                if (path.stat().st_mtime_ns if path.exists() else None) != self._mtime:
+                    logger.warning(f"{self.file} 被外部修改过，重新加载后再写入")
+                    self.load()
+                for name, upstream in pending.items():
+                    self._upstreams[name] = upstream
+                    self._rendered[name] = safe_dump([upstream])
+                start = time.perf_counter()
+                self.write(self.render())
+                logger.info(f"写入 apisix standalone 配置 {self.file}, 变更 upstream: {list(pending)}, "
+                            f"耗时: {(time.perf_counter() - start) * 1000:.1f}ms")
+            except Exception as e:
+                logger.error(f"写入 apisix standalone 配置 {self.file} 失败, 稍后重试", exc_info=e)
+                self._pending = {**pending, **self._pending}
+                self.schedule()
+
+    def render(self) -> str:
+        upstreams = "upstreams:\n" + "".join(self._rendered.values()) if self._rendered else ""
+        return Template(apisix_config_template).substitute(Value=self._others_text + upstreams,
+                                                           VersionComment=apisix_config_version_comment.get(
+                                                               self.VERSION),
+                                                           Version=self.VERSION)
+
+    def write(self, content: str):
+        """
+        先写同目录下的临时文件再 rename 覆盖，rename 是原子的
+        """
+        path = pathlib.Path(self.file)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix=f".{path.name}.", dir=path.parent)
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+            os.chmod(tmp, path.stat().st_mode & 0o777 if path.exists() else 0o644)
+            os.replace(tmp, path)
+        except BaseException:
+            pathlib.Path(tmp).unlink(missing_ok=True)
+            raise
+        self._mtime = path.stat().st_mtime_ns
+
+    def close(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        self.flush()
+        super().close()
+
+    def fetch_admin_api_to_file(self, file_name: str) -> Tuple[str, str]:
+        self.flush()
+        with self._lock:
+            content = self.render()
+        if file_name and file_name != self.file:
+            pathlib.Path(file_name).parent.mkdir(parents=True, exist_ok=True)
+            with open(file_name, "w") as f:
+                f.write(content)
+            return content, file_name
+        return content, self.file
+
+    async def restore_gateway(self, body: str):
+        yaml.safe_load(body)
+        with self._lock:
+            self.write(body)
+            self._pending = {}
+            self.load()
+
+    async def migrate_to(self, target_gateway: 'Gateway'):
+        raise Exception("Unrealized")
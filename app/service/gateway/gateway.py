@@ -1,25 +1,75 @@
+import gzip
 from abc import abstractmethod
-from typing import Tuple, List
+from typing import Tuple, List, Iterator, Optional
 
-from app.model.syncer_model import Instance
+from app.model.syncer_model import Instance, SyncOutcome
+from app.service.transport import HttpTransport
 
 
 class Gateway(object):
     def __init__(self, config):
         self._config = config
+        self._transport = HttpTransport(config.transport)
+
+    def close(self):
+        """
+        关闭网关客户端持有的连接池
+        """
+        self._transport.close()
+
+    def begin_cycle(self, target: dict):
+        """
+        每轮同步开始前调用，网关可以在这里预取本轮需要的数据
+        @param target: target配置
+        """
+        pass
 
     @abstractmethod
     def get_service_all_instances(self, target: dict, upstream_name: str = None) -> List[Instance]:
         pass
 
     @abstractmethod
-    def sync_instances(self, target: dict, upstream_name: str, diff_ins: list, instances: list):
+    def sync_instances(self, target: dict, upstream_name: str, diff_ins: list, instances: list) -> List[SyncOutcome]:
+        """
+        将变更实例写入网关
+        @param target: target配置
+        @param upstream_name: upstream名称
+        @param diff_ins: 变更的实例，enabled 为 False 表示删除
+        @param instances: 注册中心的全部实例
+        @return: 每次写入的结果，失败的记录会由 syncer 记录下来
+        """
         pass
 
+    def end_cycle(self, target: dict) -> List[SyncOutcome]:
+        """
+        每轮同步结束后调用，需要整体提交的网关可以在这里一次写入
+        @param target: target配置
+        @return: 写入结果
+        """
+        return []
+
+    def write_stats(self) -> dict:
+        """
+        每个 upstream 的写入统计，不支持的网关返回空
+        @return: {upstream名称: {writes, skipped, conflicts, failures}}
+        """
+        return {}
+
     @abstractmethod
     def fetch_admin_api_to_file(self, file_name: str) -> Tuple[str, str]:
         pass
 
+    def stream_admin_api_to_file(self, file_name: str, compress: bool = False) -> Tuple[Iterator[bytes], str]:
+        """
+        流式导出，默认一次性生成，支持流式的网关覆盖这个方法
+        @param file_name: 文件名
+        @param compress: 是否 gzip 压缩输出
+        @return: (内容迭代器, 文件名)
+        """
+        content, file_name = self.fetch_admin_api_to_file(file_name)
+        data = content.encode("utf-8")
+        return iter([gzip.compress(data) if compress else data]), file_name
+
     @abstractmethod
     async def migrate_to(self, target_gateway: 'Gateway'):
         pass
@@ -34,5 +84,8 @@ class Gateway(object):
         return '-'.join(
             [item for item in [target.get("upstream_prefix", None), upstream_name] if item is not None])
 
-    async def restore_gateway(self, body: str) -> str:
+    async def restore_gateway(self, body: str) -> Optional[dict]:
+        """
+        @return: 支持的网关返回还原汇总 {total, succeeded, failed, retried, elapsed_sec, kinds, failures}
+        """
         pass
@@ -1,14 +1,20 @@
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from string import Template
-from typing import Tuple, List
+from typing import Tuple, List, Optional, Dict
 
-import httpx
+import yaml
 
-from app.model.syncer_model import Instance
+from app.model.syncer_model import Instance, SyncOutcome
 from app.service.gateway.gateway import Gateway
 from core.lib.logger import for_service
 
 logger = for_service(__name__)
 
+# syncer 创建的 upstream 和 target 都带这个 tag
+SYNCER_TAG = "discovery-syncer-python-auto"
+
 default_kong_upstream_template = """
 {
     "name": "$name",
@@ -29,46 +35,191 @@ class Kong(Gateway):
     def __init__(self, config):
         super().__init__(config)
         self.service_name_map = {}
+        self.dbless = bool(config.config.get("dbless", False))
+        self.batch_concurrency = max(int(config.config.get("batch-concurrency", 8)), 1)
+        # db-less 模式下本轮待推送的 upstream，key 为作业 id
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._push_lock = threading.Lock()
+        # kong 默认每页100条，最大1000
+        self.page_size = min(max(int(config.config.get("page-size", 1000)), 1), 1000)
+        self.bulk_fetch = bool(config.config.get("bulk-fetch", False))
+        # upstream 名称 -> 实例列表，bulk-fetch 开启时由 begin_cycle 刷新
+        self.upstream_index: Optional[Dict[str, List[Instance]]] = None
+
+    def iter_pages(self, uri: str, params: dict = None) -> Optional[List[dict]]:
+        """
+        按 offset 翻页拉取列表，直到响应中没有 offset/next
+        @param uri: 列表路径
+        @param params: 查询参数，比如 tags
+        @return: 全部 data，资源不存在(404)时返回 None
+        """
+        params = {**(params or {}), "size": self.page_size}
+        items = []
+        while True:
+            resp = self.kong_execute("GET", uri, params)
+            if resp.status_code == 404:
+                return None
+            assert resp.status_code < 400, f"获取 kong {uri} 失败: {resp.status_code} {resp.text}"
+            body = resp.json()
+            items.extend(body.get("data") or [])
+            if not body.get("offset"):
+                return items
+            params["offset"] = body.get("offset")
+
+    def to_instances(self, targets: List[dict]) -> List[Instance]:
+        instances: List[Instance] = []
+        for item in targets:
+            ip, port = item.get("target").split(":")
+            instances.append(Instance(ip=ip, port=port, weight=item.get("weight", 100)))
+        return instances
+
+    def begin_cycle(self, target: dict):
+        """
+        bulk-fetch 开启时，按 tag 拉取全部 syncer 创建的 upstream，再并发拉取每个 upstream 的 target，本轮内的服务都从快照中查找
+        kong 没有顶层的 /targets 列表接口，target 只能通过 /upstreams/{id}/targets 获取
+        """
+        if not self.bulk_fetch:
+            return
+        upstreams = {item.get("id"): item.get("name") for item in self.iter_pages("upstreams", {"tags": SYNCER_TAG})
+                     or []}
+        with ThreadPoolExecutor(max_workers=self.batch_concurrency, thread_name_prefix="kong-targets") as pool:
+            # 拉取期间被删除的 upstream 返回 404，按没有 target 处理
+            targets = [items or [] for items in pool.map(self.fetch_targets, upstreams)]
+        index = {name: self.to_instances(items) for name, items in zip(upstreams.values(), targets)}
+        self.service_name_map.update({name: True for name in index})
+        self.upstream_index = index
+        logger.info(f"拉取 kong upstream 快照, 作业: {target.get('id')}, upstream 数量: {len(index)}")
+
+    def fetch_targets(self, upstream_name: str) -> Optional[List[dict]]:
+        """
+        @param upstream_name: upstream 名称或 id
+        @return: upstream 下全部 target，upstream 不存在时返回 None
+        """
+        return self.iter_pages(f"upstreams/{upstream_name}{self._config.config.get('targets_uri', '/targets')}")
 
     def get_service_all_instances(self, target: dict, upstream_name: str = None) -> List[Instance]:
         # https://docs.konghq.com/gateway/api/admin-oss/latest/
         upstream_name = self.get_upstream_name(target, upstream_name)
-        uri = f"upstreams/{upstream_name}{self._config.config.get('targets_uri', '/targets')}"
-        resp = self.kong_execute("GET", uri, {})
-        if resp.status_code == 404:
+        # 快照里只有带 syncer tag 的 upstream，没有的(新服务或者手工创建的 upstream)单独查询
+        instances = (self.upstream_index or {}).get(upstream_name)
+        if instances is not None:
+            return list(instances)
+        targets = self.fetch_targets(upstream_name)
+        if targets is None:
             return []
         self.service_name_map[upstream_name] = True
-        instances: List[Instance] = []
-        for item in resp.json().get("data", []):
-            ip, port = item.get("target").split(":")
-            instances.append(Instance(ip=ip, port=port, weight=item.get("weight", self._config.weight)))
-        return instances
+        return self.to_instances(targets)
 
-    def sync_instances(self, target: dict, upstream_name: str, diff_ins: list, instances: list):
+    def sync_instances(self, target: dict, upstream_name: str, diff_ins: list, instances: list) -> List[SyncOutcome]:
         upstream_name = self.get_upstream_name(target, upstream_name)
         if not diff_ins:
             logger.info(f"kong {upstream_name} 没有变更实例，跳过同步")
-            return
+            return []
+        # 写入后快照不再准确，之后的查询直接读网关
+        if self.upstream_index is not None:
+            self.upstream_index.pop(upstream_name, None)
+        if self.dbless:
+            # db-less 模式不能单独写 target，本轮结束时统一生成声明式配置推送到 /config
+            with self._lock:
+                self._pending.setdefault(target.get("id"), {})[upstream_name] = (target, list(instances))
+            return []
         if upstream_name not in self.service_name_map:
             tpl = Template(target.get("config").get("template", default_kong_upstream_template))
             self.kong_execute("PUT", "upstreams", {}, tpl.substitute(name=upstream_name))
             self.service_name_map[upstream_name] = True
 
-        tpl = Template(default_kong_target_template)
-        for instance in diff_ins:
-            target_uri = f"upstreams/{upstream_name}/targets/"
-            method = "POST"
-            data = None
+        # 先新增再删除，滚动发布时不会出现 upstream 短暂没有节点的情况
+        creates = [instance for instance in diff_ins if instance.enabled]
+        deletes = [instance for instance in diff_ins if not instance.enabled]
+        outcomes = []
+        with ThreadPoolExecutor(max_workers=self.batch_concurrency, thread_name_prefix="kong-targets") as pool:
+            for group in [creates, deletes]:
+                outcomes.extend(pool.map(lambda instance: self.sync_target(upstream_name, instance), group))
+        return outcomes
+
+    def sync_target(self, upstream_name: str, instance: Instance) -> SyncOutcome:
+        target_uri = f"upstreams/{upstream_name}/targets"
+        addr = f"{instance.ip}:{instance.port}"
+        outcome = SyncOutcome(upstream=upstream_name, target=addr, action="create" if instance.enabled else "delete")
+        try:
             if instance.enabled:
-                data = tpl.substitute(ip=instance.ip, port=instance.port, weight=instance.weight)
+                data = Template(default_kong_target_template).substitute(ip=instance.ip, port=instance.port,
+                                                                         weight=instance.weight)
+                resp = self.kong_execute("POST", target_uri, {}, data)
+                if resp.status_code == 409:
+                    outcome.action = "update"
+                    resp = self.kong_execute("PUT", f"{target_uri}/{addr}", {}, data)
             else:
-                target_uri = f"{target_uri}/{instance.ip}:{instance.port}"
-                method = "DELETE"
-            resp = self.kong_execute(method, target_uri, {}, data)
-            if instance.enabled and resp.status_code == 409:
-                target_uri = f"{target_uri}/{instance.ip}:{instance.port}"
-                method = "PUT"
-                self.kong_execute(method, target_uri, {}, data)
+                resp = self.kong_execute("DELETE", f"{target_uri}/{addr}", {})
+            outcome.status_code = resp.status_code
+            # 删除不存在的 target 也视为成功
+            outcome.success = resp.status_code < 400 or (not instance.enabled and resp.status_code == 404)
+            if not outcome.success:
+                outcome.message = resp.text
+        except Exception as e:
+            outcome.success = False
+            outcome.message = f"{e.args}"
+        return outcome
+
+    def end_cycle(self, target: dict) -> List[SyncOutcome]:
+        if not self.dbless:
+            return []
+        with self._lock:
+            pending = self._pending.pop(target.get("id"), {})
+        if not pending:
+            return []
+        outcomes = [SyncOutcome(upstream=name, action="replace") for name in pending]
+        try:
+            # 同一个网关的声明式配置是整体替换的，串行推送避免多个作业互相覆盖
+            with self._push_lock:
+                doc = self.fetch_declarative_config()
+                self.merge_declarative_upstreams(doc, pending)
+                resp = self.kong_execute("POST", "config", {}, json.dumps(doc))
+            for outcome in outcomes:
+                outcome.status_code = resp.status_code
+                outcome.success = resp.status_code < 400
+                outcome.message = None if outcome.success else resp.text
+        except Exception as e:
+            for outcome in outcomes:
+                outcome.success = False
+                outcome.message = f"{e.args}"
+        return outcomes
+
+    def fetch_declarative_config(self) -> dict:
+        resp = self.kong_execute("GET", "config", {})
+        assert resp.status_code < 400, f"获取 kong 声明式配置失败: {resp.status_code} {resp.text}"
+        config = resp.json().get("config")
+        doc = yaml.safe_load(config) if isinstance(config, str) else config
+        return doc or {"_format_version": "3.0"}
+
+    def merge_declarative_upstreams(self, doc: dict, pending: dict):
+        """
+        用本轮注册中心的实例替换声明式配置中对应 upstream 的 targets
+        @param doc: kong 声明式配置
+        @param pending: upstream 名称 -> (target配置, 实例列表)
+        """
+        upstreams = {item.get("name"): item for item in doc.setdefault("upstreams", [])}
+        ids = {item.get("id"): name for name, item in upstreams.items() if item.get("id")}
+        # 顶层 targets 里属于本次变更 upstream 的去掉，统一放到 upstream 下
+        doc["targets"] = [item for item in doc.get("targets", []) if
+                          ids.get(self.reference(item.get("upstream")), self.reference(item.get("upstream")))
+                          not in pending]
+        if not doc["targets"]:
+            doc.pop("targets")
+        tpl = Template(default_kong_target_template)
+        for name, (target, instances) in pending.items():
+            upstream = upstreams.get(name)
+            if upstream is None:
+                template = target.get("config", {}).get("template", default_kong_upstream_template)
+                upstream = json.loads(Template(template).substitute(name=name))
+                doc["upstreams"].append(upstream)
+            upstream["targets"] = [json.loads(tpl.substitute(ip=item.ip, port=item.port, weight=item.weight))
+                                   for item in instances if item.enabled]
+
+    @staticmethod
+    def reference(value):
+        return value.get("id", value.get("name")) if isinstance(value, dict) else value
 
     def fetch_admin_api_to_file(self, file_name: str) -> Tuple[str, str]:
         # https://docs.konghq.com/gateway/3.6.x/production/deployment-topologies/db-less-and-declarative-config/
@@ -84,9 +235,9 @@ class Kong(Gateway):
         raise Exception("Unrealized")
 
     def kong_execute(self, method, uri, params, data=None):
-        resp = httpx.request(method, f"{self._config.admin_url}{self._config.prefix}{uri}",
-                             params=params, data=data, timeout=10,
-                             headers={"Content-Type": "application/json", "Accept": "application/json"})
+        resp = self._transport.request(method, f"{self._config.admin_url}{self._config.prefix}{uri}",
+                                       params=params, data=data,
+                                       headers={"Content-Type": "application/json", "Accept": "application/json"})
 
         logger.info(
             f"请求 kong 接口, method: {method}, url: {self._config.admin_url}{self._config.prefix}{uri}, 请求参数: {params}, 请求数据: {data}, 响应结果: {resp.text}")
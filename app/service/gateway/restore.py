@@ -0,0 +1,106 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+from typing import List, Callable, NamedTuple
+
+import httpx
+
+from app.model.syncer_model import RestoreOutcome
+from core.lib.logger import for_service
+
+logger = for_service(__name__)
+
+# 需要重试的状态码，其他 4xx 为数据问题，重试也不会成功
+RETRY_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+
+class RestoreTask(NamedTuple):
+    # 屏障顺序，order 小的全部完成后才开始下一批
+    order: int
+    kind: str
+    id: str
+    # 执行一次写入，返回网关的响应
+    request: Callable[[], httpx.Response]
+
+
+class RateLimiter(object):
+    """
+    线程安全的令牌桶，rate <= 0 时不限速，同一个网关的多次还原共用
+    """
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next - now
+            self._next = max(self._next, now) + 1 / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+class RestoreExecutor(object):
+    """
+    有界线程池执行还原任务，按 order 分批，上一批全部完成后再开始下一批(比如 upstream 完成后再写 route)
+    超时、连接失败、429、5xx 按 2**n * backoff 秒退避重试
+    """
+
+    def __init__(self, workers: int = 8, rate_limiter: RateLimiter = None, retries: int = 3, backoff: float = 0.5):
+        self.workers = max(workers, 1)
+        self.rate_limiter = rate_limiter or RateLimiter(0)
+        self.retries = max(retries, 0)
+        self.backoff = backoff
+
+    def run(self, tasks: List[RestoreTask]) -> dict:
+        """
+        @param tasks: 还原任务
+        @return: 汇总 {total, succeeded, failed, retried, elapsed_sec, kinds: {kind: {total, succeeded, failed}}, failures}
+        """
+        start = time.perf_counter()
+        outcomes = []
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="restore") as pool:
+            for order, batch in groupby(sorted(tasks, key=lambda task: task.order), key=lambda task: task.order):
+                batch = list(batch)
+                logger.info(f"开始还原第 {order} 批, 资源: {sorted({task.kind for task in batch})}, 数量: {len(batch)}")
+                outcomes.extend(pool.map(self.execute, batch))
+        return self.summary(outcomes, time.perf_counter() - start)
+
+    def execute(self, task: RestoreTask) -> RestoreOutcome:
+        outcome = RestoreOutcome(kind=task.kind, id=task.id)
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            self.rate_limiter.acquire()
+            outcome.attempts = attempt + 1
+            try:
+                resp = task.request()
+            except (httpx.TimeoutException, httpx.TransportError) as e:
+                outcome.status_code, outcome.message = None, f"{e.args}"
+                continue
+            outcome.status_code = resp.status_code
+            outcome.success = resp.status_code < 400
+            outcome.message = None if outcome.success else resp.text
+            if outcome.success or resp.status_code not in RETRY_STATUS_CODES:
+                break
+        if not outcome.success:
+            logger.warning(f"还原 {task.kind}/{task.id} 失败, 尝试次数: {outcome.attempts}, "
+                           f"状态码: {outcome.status_code}, 原因: {outcome.message}")
+        return outcome
+
+    @staticmethod
+    def summary(outcomes: List[RestoreOutcome], elapsed: float) -> dict:
+        kinds = {}
+        for outcome in outcomes:
+            kind = kinds.setdefault(outcome.kind, {"total": 0, "succeeded": 0, "failed": 0})
+            kind["total"] += 1
+            kind["succeeded" if outcome.success else "failed"] += 1
+        failures = [outcome.model_dump() for outcome in outcomes if not outcome.success]
+        return {"total": len(outcomes), "succeeded": len(outcomes) - len(failures), "failed": len(failures),
+                "retried": sum(1 for outcome in outcomes if outcome.attempts > 1),
+                "elapsed_sec": round(elapsed, 3), "kinds": kinds, "failures": failures}
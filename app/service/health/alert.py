@@ -0,0 +1,128 @@
+import itertools
+import json
+import queue
+import threading
+import time
+from typing import List
+
+from app.model.config import Transport
+from app.service.transport import HttpTransport
+from core.lib.logger import for_service
+
+logger = for_service(__name__)
+
+
+class AlertDispatcher(object):
+    """
+    健康检查状态变更通知，探测线程只把状态变更放入有界队列，不会阻塞
+    后台线程把同一个 (作业, 服务) 在 alert.window-sec 内的状态变更合并成一次请求，失败时按 1,2,4... 秒退避重试 alert.retries 次
+    """
+
+    def __init__(self, max_size: int = 10000):
+        self._queue = queue.Queue(maxsize=max_size)
+        self._lock = threading.Lock()
+        self._thread = None
+        # 和注册中心/网关一样走 HttpTransport，使用默认的连接池和超时配置(请求超时10秒)
+        self._transport = HttpTransport(Transport())
+        # (作业 id, 服务) -> {"deadline": 发送时间, "alert": 通知配置, "transitions": [状态变更]}
+        self._pending = {}
+        # [(下一次重试时间, 第几次重试, 通知配置, 请求内容)]
+        self._retries = []
+        self.dropped = 0
+
+    def put(self, target_id: str, service: str, alert: dict, transition: dict) -> bool:
+        """
+        提交一次状态变更，队列满时丢弃
+        @param target_id: 作业id
+        @param service: 服务名称
+        @param alert: healthcheck.alert 配置
+        @param transition: 状态变更内容 DiscoveryInstance.alert_body
+        @return: 是否放入队列
+        """
+        self.start()
+        try:
+            self._queue.put_nowait((target_id, service, alert, transition))
+            return True
+        except queue.Full:
+            # 多个探测线程同时提交，计数需要加锁
+            with self._lock:
+                self.dropped += 1
+            logger.warning(f"健康检查状态变更通知队列已满，丢弃 {target_id} {service} {transition.get('instance')}")
+            return False
+
+    def start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.run, name="health-alert", daemon=True)
+                self._thread.start()
+
+    def run(self):
+        while True:
+            try:
+                self.collect(self.next_timeout())
+                self.flush_due()
+            except Exception as e:
+                logger.error("健康检查状态变更通知处理报错", exc_info=e)
+
+    def next_timeout(self) -> float:
+        deadlines = [item["deadline"] for item in self._pending.values()] + [item[0] for item in self._retries]
+        return max(min(deadlines) - time.monotonic(), 0) if deadlines else 1
+
+    def collect(self, timeout: float):
+        try:
+            target_id, service, alert, transition = self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return
+        while True:
+            pending = self._pending.setdefault((target_id, service), {
+                "deadline": time.monotonic() + float(alert.get("window-sec", 2)), "alert": alert, "transitions": []})
+            pending["transitions"].append(transition)
+            try:
+                target_id, service, alert, transition = self._queue.get_nowait()
+            except queue.Empty:
+                return
+
+    def flush_due(self):
+        now = time.monotonic()
+        for key in [key for key, item in self._pending.items() if item["deadline"] <= now]:
+            item = self._pending.pop(key)
+            self.send(item["alert"], self.build_body(key[0], key[1], item["transitions"]), 0)
+        retries, self._retries = [item for item in self._retries if item[0] <= now], [
+            item for item in self._retries if item[0] > now]
+        for _, attempt, alert, body in retries:
+            self.send(alert, body, attempt)
+
+    @staticmethod
+    def build_body(target_id: str, service: str, transitions: List[dict]) -> dict:
+        from app.service.health.store import health_store
+        keyfunc = lambda item: item.status
+        items = {k: [t.to_dict_item() for t in v] for k, v in
+                 itertools.groupby(sorted(health_store.service_instances(target_id, service), key=keyfunc), keyfunc)}
+        return {"target_id": target_id, "service": service, "transitions": transitions, "items": items}
+
+    def send(self, alert: dict, body: dict, attempt: int):
+        content = json.dumps(body, default=str)
+        # 和之前一样默认 GET，内容放在 query 参数 body 中，配置 method: POST 时内容作为 json 请求体发送
+        method = (alert.get("method") or "GET").upper()
+        try:
+            if method == "GET":
+                resp = self._transport.request(method, alert.get("url"), params={"body": content})
+            else:
+                resp = self._transport.request(method, alert.get("url"), content=content,
+                                               headers={"Content-Type": "application/json"})
+            resp.raise_for_status()
+            logger.info(f"健康检查状态变更通知 {body['target_id']} {body['service']} "
+                        f"变更数: {len(body['transitions'])} 结果为: {resp.status_code} {resp.text[:200]}")
+        except Exception as e:
+            retries = int(alert.get("retries", 3))
+            if attempt >= retries:
+                logger.error(f"健康检查状态变更通知 {alert} 重试 {attempt} 次后仍然失败，放弃: {content[:500]}",
+                             exc_info=e)
+                return
+            logger.warning(f"健康检查状态变更通知 {alert} 失败, {2 ** attempt} 秒后重试, {e.args}")
+            self._retries.append((time.monotonic() + 2 ** attempt, attempt + 1, alert, body))
+
+
+alert_dispatcher = AlertDispatcher()
@@ -0,0 +1,91 @@
+import asyncio
+import threading
+import time
+from typing import Optional
+
+from app.model.syncer_model import DiscoveryInstance
+
+
+def statuses(healthcheck: dict, name: str) -> tuple:
+    return tuple(sorted(healthcheck.get(name, {}).get("http_statuses", []), key=str))
+
+
+def probe_key(instance: DiscoveryInstance, healthcheck: dict) -> tuple:
+    """
+    探测方式、判定规则和实例都相同的探测结果可以在作业之间共享，
+    缓存的是按 healthy/unhealthy.http_statuses 和 timeout-sec 判定后的结果，判定规则不同的作业不能共用
+    @return: (scheme, 实例, uri, method, grpc-service, timeout-sec, healthy 状态码, unhealthy 状态码)
+    """
+    return (healthcheck.get("type"), instance.instance, healthcheck.get("uri"), healthcheck.get("method", "GET").upper(),
+            healthcheck.get("grpc-service", ""), healthcheck.get("timeout-sec", 30), statuses(healthcheck, "healthy"),
+            statuses(healthcheck, "unhealthy"))
+
+
+class ProbeCache(object):
+    """
+    探测结果缓存，多个作业指向同一个服务时，同一个实例在 ttl 内只探测一次，正在进行的探测也会被复用
+    每个结果对同一个作业只生效一次，作业下一个周期不会读到自己已经应用过的结果(否则计数会被重复累加)
+    只能在 prober 的事件循环中读写，计数可以在其他线程读取
+    """
+
+    def __init__(self, ttl: float = -1):
+        # 小于0时使用作业的健康检查周期
+        self.ttl = ttl
+        # probe_key -> (开始时间, 探测结果 future, 已经使用过这个结果的作业 id)
+        self._items = {}
+        self._max_ttl = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.inflight_hits = 0
+        self.misses = 0
+
+    def effective_ttl(self, interval: float) -> float:
+        return self.ttl if self.ttl >= 0 else interval
+
+    def get(self, key: tuple, interval: float, target_id: str) -> Optional[asyncio.Future]:
+        """
+        @param target_id: 读取结果的作业 id
+        @return: 其他作业 ttl 内的探测结果或者正在进行的探测，没有或者本作业已经用过时返回 None 并计为一次未命中
+        """
+        item = self._items.get(key)
+        if item is None or target_id in item[2]:
+            self.count("misses")
+            return None
+        if not item[1].done():
+            item[2].add(target_id)
+            self.count("inflight_hits")
+            return item[1]
+        if time.monotonic() - item[0] < self.effective_ttl(interval):
+            item[2].add(target_id)
+            self.count("hits")
+            return item[1]
+        self.count("misses")
+        return None
+
+    def put(self, key: tuple, future: asyncio.Future, target_id: str):
+        self._items[key] = (time.monotonic(), future, {target_id})
+
+    def discard(self, key: tuple):
+        self._items.pop(key, None)
+
+    def prune(self, interval: float):
+        """
+        清理过期的探测结果
+        """
+        self._max_ttl = max(self._max_ttl, self.effective_ttl(interval))
+        now = time.monotonic()
+        for key in [key for key, (start, future, _) in self._items.items() if
+                    future.done() and now - start >= self._max_ttl]:
+            self._items.pop(key)
+
+    def count(self, name: str):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.inflight_hits + self.misses
+            return {"ttl_sec": self.ttl, "size": len(self._items), "hits": self.hits,
+                    "inflight_hits": self.inflight_hits, "misses": self.misses,
+                    "saved_probes": self.hits + self.inflight_hits,
+                    "hit_ratio": round((self.hits + self.inflight_hits) / total, 4) if total else 0}
@@ -0,0 +1,80 @@
+import asyncio
+import threading
+from typing import List, Tuple, Callable
+
+from app.model.syncer_model import DiscoveryInstance
+from app.service.health.alert import alert_dispatcher
+from app.service.health.events import health_events
+from app.service.health.prober import prober
+from app.service.health.store import health_store
+from core.lib.logger import for_service
+
+logger = for_service(__name__)
+
+# 正在预热的 (作业 id, 实例)
+_warming = set()
+_warming_lock = threading.Lock()
+
+
+def apply_results(target: dict, results: List[Tuple[DiscoveryInstance, dict]]) -> List[Tuple[DiscoveryInstance, dict]]:
+    """
+    把探测结果写入内存中的健康状态，记录事件，状态变更时发送通知
+    @param target: 同步作业
+    @param results: prober 的探测结果
+    @return: [(探测前的实例, DiscoveryInstance.next_counts 计算出的新计数和状态)]
+    """
+    target_id = target.get("id")
+    healthcheck = target.get("healthcheck") or {}
+    changes = [(instance, instance.next_counts(healthcheck, result)) for instance, result in results]
+    health_store.apply([params for _, params in changes])
+    for (instance, result), (_, params) in zip(results, changes):
+        outcome = next((key for key in ("successes", "failures", "timeouts") if result.get(key)), "none")
+        health_events.record(target_id, "probe", instance.service, instance.instance, outcome, params['status'])
+        if params['status'] != instance.status:
+            health_events.record(target_id, "transition", instance.service, instance.instance, instance.status,
+                                 params['status'])
+            logger.info(f"{target_id} 下的服务: {instance.service} 中的实例: {instance.instance} "
+                        f"由 {instance.status} 改为 {params['status']}")
+            if healthcheck.get("alert", {}).get("url"):
+                alert_dispatcher.put(target_id, instance.service, healthcheck.get("alert"),
+                                     instance.alert_body(params))
+    return changes
+
+
+def warmup(target: dict, service: str, instances: List[str], on_healthy: Callable[[], None]):
+    """
+    新实例预热，不阻塞调用方: 立即探测，之后每隔 warmup-interval-sec 秒探测一次，直到实例变为 healthy/unhealthy
+    或者探测了 warmup-attempts 次，有实例变为 healthy 时回调 on_healthy(通常是立即同步该服务)
+    @param target: 同步作业
+    @param service: 服务名称
+    @param instances: 需要预热的实例 ip:port
+    @param on_healthy: 有实例变为 healthy 时的回调，在线程池中执行
+    """
+    with _warming_lock:
+        keys = {instance for instance in instances if (target.get("id"), instance) not in _warming}
+        _warming.update((target.get("id"), instance) for instance in keys)
+    if keys:
+        logger.info(f"新实例预热, 通过健康检查后再写入网关, 作业: {target.get('id')}, service_name: {service}, "
+                    f"instances: {sorted(keys)}")
+        prober.submit(_warmup(target, service, keys, on_healthy))
+
+
+async def _warmup(target: dict, service: str, keys: set, on_healthy: Callable[[], None]):
+    healthcheck = target.get("healthcheck") or {}
+    interval = float(healthcheck.get("warmup-interval-sec", 2))
+    try:
+        for _ in range(int(healthcheck.get("warmup-attempts", 30))):
+            instances = [d for d in health_store.service_instances(target.get("id"), service) if
+                         d.instance in keys and d.status == "unknown"]
+            if not instances:
+                break
+            changes = apply_results(target, await asyncio.gather(
+                *[prober.probe_limited(target, instance) for instance in instances]))
+            if any(params['status'] == "healthy" for _, params in changes):
+                await asyncio.get_running_loop().run_in_executor(None, on_healthy)
+            await asyncio.sleep(interval)
+    except Exception as e:
+        logger.warning(f"新实例预热失败, 作业: {target.get('id')}, service_name: {service}", exc_info=e)
+    finally:
+        with _warming_lock:
+            _warming.difference_update((target.get("id"), instance) for instance in keys)
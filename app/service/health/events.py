@@ -0,0 +1,65 @@
+import threading
+import time
+from collections import deque, namedtuple
+from datetime import datetime
+from typing import List, Optional
+
+# 健康检查事件，kind 为 probe(一次探测) 或 transition(状态变更)
+# probe: result 为 successes/failures/timeouts，status 为探测后的状态
+# transition: result 为原状态，status 为新状态
+HealthEvent = namedtuple("HealthEvent", ["time", "kind", "service", "instance", "result", "status"])
+
+
+class HealthEvents(object):
+    """
+    每个作业最近的健康检查事件，保存在内存中的环形队列，超过 size 时丢弃最早的事件
+    """
+
+    def __init__(self, size: int = 1000):
+        self.size = size
+        self._lock = threading.Lock()
+        # 作业 id -> deque[HealthEvent]
+        self._events = {}
+
+    def record(self, target_id: str, kind: str, service: str, instance: str, result: str, status: str):
+        event = HealthEvent(time.time(), kind, service, instance, result, status)
+        with self._lock:
+            events = self._events.get(target_id)
+            if events is None:
+                events = self._events[target_id] = deque(maxlen=self.size)
+            events.append(event)
+
+    def query(self, target_id: str = None, service: str = None, instance: str = None, kind: str = None,
+              since: Optional[datetime] = None, until: Optional[datetime] = None, limit: int = 100) -> List[dict]:
+        """
+        @return: 按时间倒序的事件
+        """
+        begin = since.timestamp() if since else 0
+        end = until.timestamp() if until else float("inf")
+        with self._lock:
+            items = [(tid, list(events)) for tid, events in self._events.items() if not target_id or tid == target_id]
+        result = []
+        for tid, events in items:
+            result.extend(dict(event._asdict(), target_id=tid) for event in events if
+                          begin <= event.time <= end and (not service or event.service == service) and
+                          (not instance or event.instance == instance) and (not kind or event.kind == kind))
+        result.sort(key=lambda item: item["time"], reverse=True)
+        for item in result[:limit]:
+            item["time"] = datetime.fromtimestamp(item["time"]).isoformat(sep=" ", timespec="milliseconds")
+        return result[:limit]
+
+    def resize(self, size: int):
+        """
+        reload 时调整每个作业保留的事件数，保留已有的事件
+        """
+        with self._lock:
+            if size != self.size:
+                self.size = size
+                self._events = {tid: deque(events, maxlen=size) for tid, events in self._events.items()}
+
+    def clear(self):
+        with self._lock:
+            self._events.clear()
+
+
+health_events = HealthEvents()
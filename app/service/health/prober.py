@@ -0,0 +1,242 @@
+import asyncio
+import concurrent.futures
+import threading
+from typing import List, Tuple, Optional, Coroutine
+
+from httpx import TimeoutException
+
+from app.model.config import HealthCheckType, Transport
+from app.model.syncer_model import DiscoveryInstance
+from app.service.health.cache import ProbeCache, probe_key
+from app.service.health.scheduler import probe_scheduler, FairRateLimiter
+from app.service.transport import HttpTransport
+from core.lib.logger import for_service
+from core.lib.util import http_status_in_array
+
+logger = for_service(__name__)
+
+
+# grpc.health.v1.HealthCheckResponse.ServingStatus.SERVING
+GRPC_SERVING = 1
+
+
+def encode_health_request(service: str) -> bytes:
+    """
+    grpc.health.v1.HealthCheckRequest {string service = 1;} 的 protobuf 编码，避免依赖 grpcio-health-checking
+    """
+    data = service.encode("utf-8")
+    if not data:
+        return b""
+    size, length = len(data), bytearray()
+    while True:
+        bits, size = size & 0x7f, size >> 7
+        length.append(bits | (0x80 if size else 0))
+        if not size:
+            break
+    return b"\x0a" + bytes(length) + data
+
+
+def decode_health_response(data: bytes) -> int:
+    """
+    grpc.health.v1.HealthCheckResponse {ServingStatus status = 1;} 的 protobuf 解码，status 为 0 时会被省略
+    """
+    if len(data) >= 2 and data[0] == 0x08:
+        return data[1]
+    return 0
+
+
+class HealthProber(object):
+    """
+    进程内的主动健康检查，所有作业共用一个事件循环和 AsyncClient 连接池
+    同一个作业的实例并发探测，并发数受 healthcheck.concurrency(单个作业) 和 common.health-check-concurrency(全局) 限制
+    每秒探测数受 common.health-check-qps(全局) 限制，多个作业轮流分配
+    """
+
+    def __init__(self, concurrency: int = 200, qps: float = 0, cache_ttl: float = -1):
+        self._concurrency = concurrency
+        self._qps = qps
+        self.cache = ProbeCache(cache_ttl)
+        self._lock = threading.Lock()
+        self._loop = None
+        self._thread = None
+        self._transport = None
+        self._global_limit = None
+        self._rate_limiter = None
+        # 作业 id -> (并发数, 信号量)
+        self._target_limits = {}
+
+    def start(self):
+        with self._lock:
+            if self._loop is not None:
+                return
+            self._loop = asyncio.new_event_loop()
+            self._transport = HttpTransport(Transport(**{"max-connections": self._concurrency,
+                                                         "max-keepalive-connections": self._concurrency,
+                                                         "max-in-flight": 0}))
+            self._thread = threading.Thread(target=self._loop.run_forever, name="health-prober", daemon=True)
+            self._thread.start()
+
+    def reset(self, concurrency: int = None, qps: float = None, cache_ttl: float = None):
+        """
+        reload 时关闭事件循环和连接池，下一次探测时按新的配置重新创建
+        """
+        with self._lock:
+            loop, thread, transport = self._loop, self._thread, self._transport
+            self._loop, self._thread, self._transport, self._global_limit = None, None, None, None
+            self._rate_limiter = None
+            self.cache = ProbeCache(self.cache.ttl if cache_ttl is None else cache_ttl)
+            self._target_limits.clear()
+            if concurrency is not None:
+                self._concurrency = concurrency
+            if qps is not None:
+                self._qps = qps
+        if loop is None:
+            return
+        if transport is not None:
+            asyncio.run_coroutine_threadsafe(transport.aclose(), loop).result(timeout=10)
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(timeout=10)
+        loop.close()
+
+    def run(self, target: dict, instances: List[DiscoveryInstance], interval: float = 0) -> List[
+        Tuple[DiscoveryInstance, dict]]:
+        """
+        探测作业的实例，阻塞到本周期需要探测的实例全部探测完成
+        @param target: 同步作业
+        @param instances: 作业下的实例
+        @param interval: 健康检查周期，单位秒，探测会分散在周期内
+        @return: [(实例, 探测结果 {"successes": 0|1, "failures": 0|1, "timeouts": 0|1})]
+        """
+        plans = probe_scheduler.plan(target, instances, interval)
+        if not plans:
+            return []
+        self.start()
+        future = asyncio.run_coroutine_threadsafe(self.probe_all(target, plans, interval), self._loop)
+        return future.result()
+
+    def target_limit(self, target: dict) -> asyncio.Semaphore:
+        concurrency = int((target.get("healthcheck") or {}).get("concurrency", 20))
+        origin = self._target_limits.get(target.get("id"))
+        if origin is None or origin[0] != concurrency:
+            origin = (concurrency, asyncio.Semaphore(concurrency))
+            self._target_limits[target.get("id")] = origin
+        return origin[1]
+
+    def submit(self, coro: Coroutine) -> concurrent.futures.Future:
+        """
+        在探测的事件循环中执行，不阻塞调用方
+        """
+        self.start()
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    async def probe_limited(self, target: dict, instance: DiscoveryInstance) -> Tuple[DiscoveryInstance, dict]:
+        """
+        受全局速率、全局并发和作业并发限制的一次探测，不使用缓存
+        """
+        if self._global_limit is None:
+            self._global_limit = asyncio.Semaphore(self._concurrency)
+            self._rate_limiter = FairRateLimiter(self._qps)
+        await self._rate_limiter.acquire(target.get("id"))
+        async with self.target_limit(target), self._global_limit:
+            return instance, await self.probe(instance, target.get("healthcheck") or {})
+
+    async def probe_all(self, target: dict, plans: List[Tuple[DiscoveryInstance, float]], interval: float = 0) -> List[
+        Tuple[DiscoveryInstance, dict]]:
+        self.cache.prune(interval)
+        healthcheck = target.get("healthcheck") or {}
+
+        async def limited(instance: DiscoveryInstance, delay: float):
+            if delay > 0:
+                await asyncio.sleep(delay)
+            # 多个作业指向同一个服务时，ttl 内同一个实例只探测一次，其他作业复用结果(包括正在进行的探测)
+            key = probe_key(instance, healthcheck)
+            cached = self.cache.get(key, interval, target.get("id"))
+            if cached is not None:
+                return instance, await asyncio.shield(cached)
+            future = self._loop.create_future()
+            self.cache.put(key, future, target.get("id"))
+            try:
+                _, result = await self.probe_limited(target, instance)
+            except BaseException:
+                self.cache.discard(key)
+                future.cancel()
+                raise
+            future.set_result(result)
+            return instance, result
+
+        return list(await asyncio.gather(*[limited(instance, delay) for instance, delay in plans]))
+
+    async def probe(self, instance: DiscoveryInstance, healthcheck: dict) -> dict:
+        result = {"successes": 0, "failures": 0, "timeouts": 0}
+        probe_type = healthcheck.get("type")
+        func = {HealthCheckType.HTTP.value: self.probe_http, HealthCheckType.HTTPS.value: self.probe_http,
+                HealthCheckType.TCP.value: self.probe_tcp, HealthCheckType.GRPC.value: self.probe_grpc}.get(probe_type)
+        address = f"{probe_type}://{instance.instance}{healthcheck.get('uri') or ''}"
+        try:
+            assert func is not None, f"暂时不支持 {probe_type} 协议"
+            outcome = await func(instance, healthcheck)
+            if outcome:
+                result[outcome] = 1
+        except ImportError as e:
+            # 本地缺少依赖不是实例的问题，不计入成功或者失败
+            logger.error(f"健康检查 {instance.target_id} {instance.service} {address} 无法执行, {e.args}")
+        except (TimeoutException, asyncio.TimeoutError) as e:
+            result['timeouts'] = 1
+            logger.warning(f"健康检查 {instance.target_id} {instance.service} {address} 超时, {e.args}")
+        except Exception as e:
+            result['failures'] = 1
+            logger.warning(f"健康检查 {instance.target_id} {instance.service} {address} 失败, {e.args}")
+        return result
+
+    async def probe_http(self, instance: DiscoveryInstance, healthcheck: dict) -> Optional[str]:
+        """
+        @return: 命中 healthy.http_statuses 返回 successes，命中 unhealthy.http_statuses 返回 failures，都没命中返回 None
+        """
+        resp = await self._transport.arequest(method=healthcheck.get("method", "GET").upper(),
+                                              url=f"{healthcheck.get('type')}://{instance.instance}{healthcheck.get('uri')}",
+                                              timeout=healthcheck.get("timeout-sec", 30))
+        if http_status_in_array(resp.status_code, healthcheck.get("healthy", {}).get("http_statuses", [])):
+            return "successes"
+        if http_status_in_array(resp.status_code, healthcheck.get("unhealthy", {}).get("http_statuses", [])):
+            return "failures"
+        return None
+
+    @staticmethod
+    async def probe_tcp(instance: DiscoveryInstance, healthcheck: dict) -> Optional[str]:
+        """
+        只建立 tcp 连接，连接成功即健康，连接被拒绝等异常为失败
+        """
+        host, _, port = instance.instance.rpartition(":")
+        _, writer = await asyncio.wait_for(asyncio.open_connection(host, int(port)),
+                                           timeout=healthcheck.get("timeout-sec", 30))
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+        return "successes"
+
+    @staticmethod
+    async def probe_grpc(instance: DiscoveryInstance, healthcheck: dict) -> Optional[str]:
+        """
+        标准 grpc.health.v1.Health/Check，返回 SERVING 即健康，需要安装 grpcio
+        检查的服务名取 healthcheck.grpc-service，默认为空(整个 server)
+        """
+        try:
+            import grpc
+        except ImportError:
+            raise ImportError("grpc 健康检查需要安装 grpcio (pip install grpcio)")
+        async with grpc.aio.insecure_channel(instance.instance) as channel:
+            check = channel.unary_unary("/grpc.health.v1.Health/Check",
+                                        request_serializer=encode_health_request,
+                                        response_deserializer=decode_health_response)
+            try:
+                status = await check(healthcheck.get("grpc-service", ""), timeout=healthcheck.get("timeout-sec", 30))
+            except grpc.aio.AioRpcError as e:
+                if e.code() == grpc.StatusCode.DEADLINE_EXCEEDED:
+                    raise asyncio.TimeoutError(e.details())
+                raise
+        return "successes" if status == GRPC_SERVING else "failures"
+
+
+prober = HealthProber()
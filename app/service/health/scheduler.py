@@ -0,0 +1,133 @@
+import asyncio
+import hashlib
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import List, Tuple
+
+from app.model.syncer_model import DiscoveryInstance
+
+# 探测分散在周期的前 90% 内，留出时间等最后一批探测返回
+SPREAD_RATIO = 0.9
+# health_check 任务会阻塞到最后一个探测完成，分散的时间不能超过 funboost 的 function_timeout(600秒)
+# 留出探测超时(timeout-sec)和排队的时间，周期很长(比如默认每小时一次)时只分散在前 300 秒内
+MAX_SPREAD_SEC = 300
+# 稳定状态，连续多个周期没有变化时降低探测频率
+# unhealthy 的实例不再探测(task_syncer.health_check 中过滤掉，超过10分钟后删除)，不需要降频
+STABLE_STATUSES = ("healthy",)
+
+
+def jitter(instance: str) -> float:
+    """
+    同一个实例每次得到相同的偏移，不同实例均匀分布在 [0, 1)
+    只和实例有关，多个作业探测同一个实例时在同一时刻，可以合并成一次探测
+    """
+    digest = hashlib.sha1(instance.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") / 2 ** 64
+
+
+class ProbeScheduler(object):
+    """
+    健康检查的调度: 每个实例按固定偏移分散在整个周期内探测，避免同一时刻探测作业下的全部实例
+    healthy 状态连续 stable-cycles 个周期没有变化的实例，每 stable-cycles 个周期探测间隔翻倍，最多 max-backoff 个周期探测一次
+    状态刚变化或者还是 unknown 的实例每个周期都探测
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (作业 id, 实例) -> (上次状态, 连续没有变化的周期数)
+        self._states = {}
+        # 作业 id -> 周期数
+        self._cycles = {}
+
+    def backoff(self, status: str, stable: int, healthcheck: dict) -> int:
+        """
+        @return: 每多少个周期探测一次
+        """
+        if status not in STABLE_STATUSES:
+            return 1
+        stable_cycles = max(int(healthcheck.get("stable-cycles", 3)), 1)
+        max_backoff = max(int(healthcheck.get("max-backoff", 4)), 1)
+        return min(2 ** (stable // stable_cycles), max_backoff)
+
+    def plan(self, target: dict, instances: List[DiscoveryInstance], interval: float) -> List[
+        Tuple[DiscoveryInstance, float]]:
+        """
+        @param target: 同步作业
+        @param instances: 作业下的实例
+        @param interval: 周期，单位秒，为0时不分散
+        @return: 本周期需要探测的实例和探测前等待的秒数
+        """
+        target_id = target.get("id")
+        healthcheck = target.get("healthcheck") or {}
+        window = min(interval * SPREAD_RATIO, MAX_SPREAD_SEC) if healthcheck.get("jitter", True) else 0
+        plans = []
+        with self._lock:
+            cycle = self._cycles.get(target_id, 0)
+            self._cycles[target_id] = cycle + 1
+            keys = set()
+            for instance in instances:
+                key = (target_id, instance.instance)
+                keys.add(key)
+                status, stable = self._states.get(key, (None, 0))
+                stable = stable + 1 if status == instance.status else 0
+                self._states[key] = (instance.status, stable)
+                offset = jitter(instance.instance)
+                # 同一个作业下降频的实例也错开在不同周期探测
+                if (cycle + int(offset * 1024)) % self.backoff(instance.status, stable, healthcheck):
+                    continue
+                plans.append((instance, offset * window))
+            # 清理已经删除的实例
+            for key in [key for key in self._states if key[0] == target_id and key not in keys]:
+                self._states.pop(key)
+        return plans
+
+    def clear(self):
+        with self._lock:
+            self._states.clear()
+            self._cycles.clear()
+
+
+class FairRateLimiter(object):
+    """
+    全局探测速率限制(令牌桶)，多个作业排队时轮流发放令牌，避免实例多的作业占满预算
+    只能在同一个事件循环中使用
+    """
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self._burst = max(rate * 0.1, 1)
+        self._tokens = self._burst
+        self._last = time.monotonic()
+        # 作业 id -> 等待令牌的 future
+        self._waiters = OrderedDict()
+        self._task = None
+
+    async def acquire(self, key: str):
+        if self.rate <= 0:
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(key, deque()).append(future)
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._dispatch())
+        await future
+
+    async def _dispatch(self):
+        while self._waiters:
+            now = time.monotonic()
+            self._tokens = min(self._burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            while self._tokens >= 1 and self._waiters:
+                key, waiters = next(iter(self._waiters.items()))
+                future = waiters.popleft()
+                if waiters:
+                    self._waiters.move_to_end(key)
+                else:
+                    self._waiters.pop(key)
+                if not future.done():
+                    future.set_result(None)
+                    self._tokens -= 1
+            await asyncio.sleep(max(1 / self.rate, 0.005))
+
+
+probe_scheduler = ProbeScheduler()
@@ -0,0 +1,206 @@
+import threading
+import uuid
+from datetime import datetime
+from typing import List, Dict
+
+from db_libs.sqla_lib import SqlaReflectHelper
+
+from app.model.syncer_model import DiscoveryInstance, Instance
+from core.lib.logger import for_service
+
+logger = for_service(__name__)
+
+# 计数上限
+MAX_COUNT = 256
+
+
+def health_order(item: DiscoveryInstance) -> tuple:
+    """
+    健康顺序: 不健康的排在最后，失败次数少的、成功次数多的排在前面
+    """
+    return item.status == "unhealthy", item.failures + item.timeouts, -item.successes
+
+
+class HealthStore(object):
+    """
+    实例健康状态(计数和状态)保存在内存中，key 为 (作业, 服务, 实例)
+    syncer 和健康检查都只读写内存，后台线程定时把有变化的实例在一个事务内批量写入 sqlite，
+    reload 时停止前写入一次，再从 sqlite 恢复各作业的状态，计数不会因为 reload/重启清零
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        # (target_id, service) -> {instance: DiscoveryInstance}
+        self._items: Dict[tuple, Dict[str, DiscoveryInstance]] = {}
+        # id -> DiscoveryInstance
+        self._index: Dict[str, DiscoveryInstance] = {}
+        self._dirty = set()
+        self._deleted = set()
+        self._stop = None
+        self._thread = None
+        self._sqla_helper = None
+
+    @staticmethod
+    def _copy(item: DiscoveryInstance) -> DiscoveryInstance:
+        return DiscoveryInstance(item.to_dict_item())
+
+    def _add(self, item: DiscoveryInstance):
+        self._items.setdefault((item.target_id, item.service), {})[item.instance] = item
+        self._index[item.id] = item
+        self._deleted.discard(item.id)
+        self._dirty.add(item.id)
+
+    def _remove(self, item: DiscoveryInstance):
+        service = self._items.get((item.target_id, item.service), {})
+        service.pop(item.instance, None)
+        if not service:
+            self._items.pop((item.target_id, item.service), None)
+        self._index.pop(item.id, None)
+        self._dirty.discard(item.id)
+        self._deleted.add(item.id)
+
+    def save_or_update(self, target_id: str, service: str, discovery_instances: List[Instance]):
+        """
+        syncer 同步时登记注册中心的实例: 新增没有的实例，不健康超过60秒又出现在注册中心的实例重置为 unknown
+        @param target_id: 作业id
+        @param service: 服务名称
+        @param discovery_instances: 注册中心实例列表
+        """
+        if not discovery_instances:
+            return
+        now = datetime.now()
+        with self._lock:
+            origin = self._items.get((target_id, service), {})
+            for key in {f"{d.ip}:{d.port}" for d in discovery_instances if d.enabled}:
+                item = origin.get(key)
+                if item is None:
+                    self._add(DiscoveryInstance({"id": str(uuid.uuid4()), "target_id": target_id, "service": service,
+                                                 "instance": key, "create_time": now}))
+                elif item.status == "unhealthy" and item.last_time and (now - item.last_time).total_seconds() >= 60:
+                    logger.info(f"重置不健康的实例: {target_id} {service} {key}")
+                    item.successes, item.failures, item.timeouts = 0, 0, 0
+                    item.status, item.last_time = "unknown", now
+                    self._dirty.add(item.id)
+
+    def instances(self, target_id: str) -> List[DiscoveryInstance]:
+        """
+        @return: 作业下全部实例的副本
+        """
+        with self._lock:
+            return [self._copy(item) for (tid, _), items in self._items.items() if tid == target_id
+                    for item in items.values()]
+
+    def service_instances(self, target_id: str, service: str, skip: int = 0) -> List[DiscoveryInstance]:
+        """
+        @param skip: 跳过排在前面的实例数(要保留的 min-hosts)
+        @return: 服务下按健康程度排序的实例副本
+        """
+        with self._lock:
+            items = sorted(self._items.get((target_id, service), {}).values(), key=health_order)
+            return [self._copy(item) for item in items[skip or 0:]]
+
+    def apply(self, params: List[dict]):
+        """
+        应用探测结果，成功时清零失败和超时次数，失败或超时时清零成功次数，计数不超过 MAX_COUNT
+        @param params: DiscoveryInstance.next_counts 的结果列表
+        """
+        with self._lock:
+            for param in params:
+                item = self._index.get(param['id'])
+                if item is None:
+                    continue
+                successes, failures, timeouts = param['successes'], param['failures'], param['timeouts']
+                item.successes = min(0 if failures + timeouts > 0 else item.successes + successes, MAX_COUNT)
+                item.failures = min(0 if successes > 0 else item.failures + failures, MAX_COUNT)
+                item.timeouts = min(0 if successes > 0 else item.timeouts + timeouts, MAX_COUNT)
+                item.status = param.get('status') or 'unknown'
+                item.last_time = param.get('last_time')
+                self._dirty.add(item.id)
+
+    def delete_by_instances(self, instances: List[str]):
+        """
+        删除实例(所有作业)
+        @param instances: ip:port 列表
+        """
+        if not instances:
+            return
+        keys = set(instances)
+        with self._lock:
+            for item in [item for item in self._index.values() if item.instance in keys]:
+                self._remove(item)
+        logger.info(f"删除无效的实例: {instances}")
+
+    def load(self, target_id: str, sqla_helper: SqlaReflectHelper):
+        """
+        从数据库恢复作业的实例健康状态，同一个实例有多条记录时保留最后探测的一条，其余的删除
+        @param target_id: 作业id
+        """
+        try:
+            items = DiscoveryInstance.query_by_target(target_id, sqla_helper)
+        except Exception as e:
+            logger.warning(f"从数据库恢复实例健康状态失败, 作业: {target_id}", exc_info=e)
+            return
+        with self._lock:
+            for item in sorted(items, key=lambda d: str(d.last_time or "")):
+                origin = self._items.get((item.target_id, item.service), {}).get(item.instance)
+                if origin is not None:
+                    self._remove(origin)
+                self._items.setdefault((item.target_id, item.service), {})[item.instance] = item
+                self._index[item.id] = item
+        logger.info(f"从数据库恢复实例健康状态, 作业: {target_id}, 实例数: {len(items)}")
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._index.clear()
+            self._dirty.clear()
+            self._deleted.clear()
+
+    def flush(self, sqla_helper: SqlaReflectHelper):
+        """
+        把有变化的实例在一个事务内写入数据库，失败时保留到下一次
+        """
+        with self._lock:
+            dirty, deleted = self._dirty, self._deleted
+            self._dirty, self._deleted = set(), set()
+            rows = [self._index[key].to_dict_item() for key in dirty if key in self._index]
+        if not rows and not deleted:
+            return
+        try:
+            DiscoveryInstance.flush(rows, list(deleted), sqla_helper)
+        except Exception as e:
+            logger.warning(f"实例健康状态写入数据库失败, 下次重试, 更新: {len(rows)}, 删除: {len(deleted)}", exc_info=e)
+            with self._lock:
+                self._dirty |= {key for key in dirty if key in self._index}
+                self._deleted |= deleted - set(self._index)
+
+    def start(self, interval: float, sqla_helper: SqlaReflectHelper):
+        """
+        启动后台写入线程，reload 时先 stop 再 start
+        @param interval: 写入间隔，单位秒
+        """
+        self.stop()
+        self._sqla_helper = sqla_helper
+        stop = threading.Event()
+
+        def run():
+            while not stop.wait(interval):
+                self.flush(sqla_helper)
+
+        self._stop = stop
+        self._thread = threading.Thread(target=run, name="health-store-flush", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        停止后台写入线程，停止前把还没写入的变化写入一次
+        """
+        if self._stop is not None:
+            self._stop.set()
+            self._thread.join(timeout=10)
+            self._stop, self._thread = None, None
+        if self._sqla_helper is not None:
+            self.flush(self._sqla_helper)
+
+
+health_store = HealthStore()
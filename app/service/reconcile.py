@@ -0,0 +1,69 @@
+from typing import List, Iterable, Set, Tuple
+
+from pydantic import BaseModel
+
+from app.model.syncer_model import Instance
+
+
+def instance_key(instance: Instance) -> str:
+    return f"{instance.ip}:{instance.port}"
+
+
+class ReconcileResult(BaseModel):
+    """
+    description: 注册中心实例和网关实例的比对结果，元素都是副本，不会修改传入的实例
+    """
+    # 注册中心有，网关没有
+    adds: List[Instance] = []
+    # 网关有，注册中心没有
+    removes: List[Instance] = []
+    # 两边都有，权重不同，取注册中心的实例
+    weight_changes: List[Instance] = []
+    # 两边都有，权重相同
+    unchanged: List[Instance] = []
+
+    @property
+    def changes(self) -> List[Instance]:
+        """
+        需要写入网关的实例，新增和改权重的 enabled=True，删除的 enabled=False，都带 change=True
+        """
+        return [*self.adds, *self.weight_changes, *self.removes]
+
+    def __bool__(self) -> bool:
+        return bool(self.adds or self.removes or self.weight_changes)
+
+
+def reconcile(discovery_instances: Iterable[Instance], gateway_instances: Iterable[Instance]) -> ReconcileResult:
+    """
+    按 ip:port 比对注册中心和网关的实例，O(n)
+    @param discovery_instances: 注册中心实例列表
+    @param gateway_instances: 网关实例列表
+    @return: 比对结果
+    """
+    dim = {instance_key(item): item for item in discovery_instances or []}
+    gim = {instance_key(item): item for item in gateway_instances or []}
+    result = ReconcileResult()
+    for key, item in dim.items():
+        origin = gim.get(key)
+        if origin is None:
+            result.adds.append(item.model_copy(update={"change": True, "enabled": True}))
+        elif float(origin.weight) != float(item.weight):
+            result.weight_changes.append(item.model_copy(update={"change": True, "enabled": True}))
+        else:
+            result.unchanged.append(item)
+    result.removes = [item.model_copy(update={"change": True, "enabled": False})
+                      for key, item in gim.items() if key not in dim]
+    return result
+
+
+def partition(instances: Iterable[Instance], keys: Set[str]) -> Tuple[List[Instance], List[Instance]]:
+    """
+    按 ip:port 把实例分成两组，O(n)
+    @param instances: 实例列表
+    @param keys: ip:port 集合
+    @return: (不在 keys 中的实例, 在 keys 中的实例)
+    """
+    kept, matched = [], []
+    for item in instances or []:
+        (matched if instance_key(item) in keys else kept).append(item)
+    return kept, matched
@@ -0,0 +1,82 @@
+import re
+import threading
+from typing import List, Dict
+
+from cachetools import LRUCache
+
+from app.model.syncer_model import Instance
+
+
+# 开头的全局标志，比如 (?i)foo，全局标志只能出现在正则开头，这样的正则不能合并
+GLOBAL_FLAGS = re.compile(r"^\(\?[aiLmsux]+\)")
+
+
+def mergeable(pattern: str, compiled: re.Pattern) -> bool:
+    """
+    带全局标志的正则不能放到合并后的中间，带分组的正则合并后 \\1 等反向引用会指向别的分组，同名分组会编译失败
+    """
+    return not GLOBAL_FLAGS.match(pattern) and compiled.groups == 0
+
+
+def compile_patterns(patterns: List[str]) -> List[re.Pattern]:
+    """
+    把多个正则合并成一个，re.match 的语义和逐个匹配 any(re.match(p, name) for p in patterns) 相同
+    带全局标志或者分组的正则单独编译
+    @param patterns: 正则列表
+    @return: 编译后的正则列表，列表为空时返回空列表
+    """
+    if not patterns:
+        return []
+    compiled = [re.compile(pattern) for pattern in patterns]
+    plain = [pattern for pattern, item in zip(patterns, compiled) if mergeable(pattern, item)]
+    separate = [item for pattern, item in zip(patterns, compiled) if not mergeable(pattern, item)]
+    merged = [re.compile("|".join(f"(?:{pattern})" for pattern in plain))] if plain else []
+    return merged + separate
+
+
+def match_any(patterns: List[re.Pattern], name: str) -> bool:
+    return any(pattern.match(name) for pattern in patterns)
+
+
+class ServiceSelector(object):
+    """
+    服务筛选，include-service 为空时默认包含全部服务，exclude-service 优先于 include-service，
+    metadata-selector 要求服务至少有一个实例的元数据匹配全部的 key
+    服务名称的匹配结果会缓存，同一个服务每轮只需要一次字典查询
+    """
+
+    def __init__(self, include: List[str] = None, exclude: List[str] = None, metadata: Dict[str, str] = None,
+                 cache_size: int = 4096):
+        self._include = compile_patterns(include)
+        self._exclude = compile_patterns(exclude)
+        self._metadata = {key: re.compile(value or "") for key, value in (metadata or {}).items()}
+        self._cache = LRUCache(maxsize=cache_size)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_target(cls, target: dict) -> 'ServiceSelector':
+        return cls(target.get("include_service"), target.get("exclude_service"), target.get("metadata_selector"))
+
+    def match_name(self, name: str) -> bool:
+        """
+        @param name: 服务名称
+        @return: 服务名称是否命中 include-service 且没有命中 exclude-service
+        """
+        with self._lock:
+            selected = self._cache.get(name)
+        if selected is None:
+            selected = (not self._include or match_any(self._include, name)) and not match_any(self._exclude, name)
+            with self._lock:
+                self._cache[name] = selected
+        return selected
+
+    def match_metadata(self, instances: List[Instance]) -> bool:
+        """
+        元数据筛选依赖实例列表，不缓存
+        @param instances: 注册中心实例列表
+        @return: 没有配置 metadata-selector，或者至少一个实例的元数据匹配全部 key 时返回 True
+        """
+        if not self._metadata:
+            return True
+        return any(all(key in (instance.metadata or {}) and pattern.match(str(instance.metadata[key]))
+                       for key, pattern in self._metadata.items()) for instance in instances or [])
@@ -0,0 +1,99 @@
+import asyncio
+import importlib.util
+import threading
+
+import httpx
+
+from core.lib.logger import for_service
+
+logger = for_service(__name__)
+
+
+class HttpTransport(object):
+    """
+    注册中心/网关共用的 http 连接池，每个 server 一个实例，在 reload() 时创建，reload 前关闭
+    """
+
+    def __init__(self, config):
+        self._config = config
+        self._lock = threading.Lock()
+        self._client = None
+        self._async_client = None
+        self._async_loop = None
+        self._closed = False
+        # 限制同一个 server 的在途请求数，多个同步作业/并发同步共用
+        self._in_flight = threading.BoundedSemaphore(config.max_in_flight) if config.max_in_flight > 0 else None
+        self._http2 = config.http2
+        if self._http2 and importlib.util.find_spec("h2") is None:
+            logger.warning("transport.http2 需要安装 h2 (pip install httpx[http2])，已降级为 http/1.1")
+            self._http2 = False
+
+    def _client_kwargs(self) -> dict:
+        return {
+            "limits": httpx.Limits(max_connections=self._config.max_connections,
+                                   max_keepalive_connections=self._config.max_keepalive_connections,
+                                   keepalive_expiry=self._config.keepalive_expiry),
+            "timeout": httpx.Timeout(self._config.timeout_sec, connect=self._config.connect_timeout_sec),
+            "http2": self._http2,
+            "verify": self._config.verify,
+        }
+
+    @property
+    def client(self) -> httpx.Client:
+        if self._client is None:
+            with self._lock:
+                assert not self._closed, "transport 已关闭"
+                if self._client is None:
+                    self._client = httpx.Client(**self._client_kwargs())
+        return self._client
+
+    @property
+    def async_client(self) -> httpx.AsyncClient:
+        """
+        AsyncClient 的连接绑定在创建它的事件循环上，事件循环变化时重新创建
+        """
+        loop = asyncio.get_running_loop()
+        if self._async_client is None or self._async_loop is not loop or self._async_loop.is_closed():
+            assert not self._closed, "transport 已关闭"
+            self._async_client = httpx.AsyncClient(**self._client_kwargs())
+            self._async_loop = loop
+        return self._async_client
+
+    def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        if self._in_flight is None:
+            return self.client.request(method, url, **kwargs)
+        with self._in_flight:
+            return self.client.request(method, url, **kwargs)
+
+    async def arequest(self, method: str, url: str, **kwargs) -> httpx.Response:
+        return await self.async_client.request(method, url, **kwargs)
+
+    def close(self):
+        """
+        关闭连接池，已关闭的 transport 不能再使用
+        """
+        with self._lock:
+            self._closed = True
+            client, self._client = self._client, None
+            async_client, async_loop = self._async_client, self._async_loop
+            self._async_client, self._async_loop = None, None
+        if client is not None:
+            client.close()
+        if async_client is not None and async_loop is not None and not async_loop.is_closed():
+            if async_loop.is_running():
+                asyncio.run_coroutine_threadsafe(async_client.aclose(), async_loop)
+            else:
+                async_loop.run_until_complete(async_client.aclose())
+
+    async def aclose(self):
+        """
+        在 async_client 所在的事件循环中关闭连接池
+        """
+        with self._lock:
+            self._closed = True
+            client, self._client = self._client, None
+            async_client, self._async_client, self._async_loop = self._async_client, None, None
+        if client is not None:
+            client.close()
+        if async_client is not None:
+            await async_client.aclose()
@@ -6,6 +6,6 @@ from funboost import BoosterDiscovery
 from app.tasks import task_syncer
 
 task_syncer.syncer.consume()
+task_syncer.service_syncer.consume()
 task_syncer.reload.consume()
 task_syncer.health_check.consume()
-task_syncer.instance_health_check.consume()
@@ -1,16 +1,27 @@
 import datetime
 import functools
 import importlib
+import itertools
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from apscheduler.triggers.cron import CronTrigger
-from funboost import boost, funboost_aps_scheduler, funboost_current_task
+from funboost import boost, funboost_aps_scheduler
 from funboost.timing_job.apscheduler_use_redis_store import funboost_background_scheduler_redis_store
 from nb_time import NbTime
 
-from app.model.syncer_model import Jobs, DiscoveryInstance, Registration
+from app.model.syncer_model import Jobs, DiscoveryInstance, Registration, Service
 from app.service.discovery.discovery import Discovery
+from app.service.fingerprint import fingerprints
 from app.service.gateway.gateway import Gateway
+from app.service.health.checker import apply_results, warmup
+from app.service.health.events import health_events
+from app.service.health.prober import prober
+from app.service.health.scheduler import probe_scheduler
+from app.service.health.store import health_store
+from app.service.reconcile import reconcile, partition, instance_key
+from app.service.selector import ServiceSelector
 from app.tasks.common import FunboostCommonConfig
 from core.database import db
 from core.lib.logger import for_task
@@ -51,9 +62,39 @@ def get_gateway_client(name: str) -> Gateway:
     return gateway_client
 
 
+def get_service_selector(target: dict) -> ServiceSelector:
+    """
+    @param target: 同步作业
+    @return: 作业的服务筛选规则，每个进程第一次使用时按作业配置编译一次
+    """
+    from app.model.config import service_selectors
+    selector = service_selectors.get(target.get("id"))
+    if selector is None:
+        selector = service_selectors.setdefault(target.get("id"), ServiceSelector.from_target(target))
+    return selector
+
+
+# 作业 id -> 锁，网关的一轮同步状态(快照、db-less 待推送的 upstream)按作业保存，
+# 同一个作业的定时同步和推送触发的单服务同步串行执行，单服务同步不会读到或者提交定时同步做了一半的状态
+_cycle_locks = {}
+_cycle_locks_lock = threading.Lock()
+
+
+def cycle_lock(target: dict) -> threading.Lock:
+    with _cycle_locks_lock:
+        return _cycle_locks.setdefault(target.get("id"), threading.Lock())
+
+
 def clear_client():
     funboost_background_scheduler_redis_store.remove_all_jobs()
-    from app.model.config import discovery_clients, gateway_clients
+    from app.model.config import discovery_clients, gateway_clients, service_selectors
+
+    # 关闭旧客户端持有的连接池，避免 reload 后连接泄露
+    for client in [*discovery_clients.values(), *gateway_clients.values()]:
+        try:
+            client.close()
+        except Exception as e:
+            logger.warning(f"关闭客户端连接池失败 {client}", exc_info=e)
 
     discovery_clients.clear()
     get_discovery_client.cache_clear()
@@ -61,36 +102,41 @@ def clear_client():
     gateway_clients.clear()
     get_gateway_client.cache_clear()
 
+    fingerprints.clear()
+    service_selectors.clear()
+    prober.reset()
+    probe_scheduler.clear()
+    health_store.stop()
+    health_store.clear()
+
     enginex, sqla_helper = db.get_sqla_helper()
     Jobs.create_table_if_not_exists(sqla_helper)
     Jobs.clear_all(sqla_helper)
 
 
-@boost(boost_params=FunboostCommonConfig(queue_name='queue_instance_health_check', qps=100))
-def instance_health_check(target: dict, instance: dict):
-    sqla_helper = db.get_sqla_helper()[1]
-    healthcheck = target.get("healthcheck", None)
-    discovery_instance = DiscoveryInstance(instance)
-    try:
-        discovery_instance.health_check(healthcheck=healthcheck, sqla_helper=sqla_helper)
-    except Exception as e:
-        logger.warning(f"健康检查报错 {e.args}")
-
-
 @boost(boost_params=FunboostCommonConfig(queue_name='queue_health_check_job', qps=50, ))
 def health_check(target: dict):
+    """
+    探测作业下的全部实例，funboost 只负责把作业分发到 worker，实例的探测在 worker 进程内并发执行
+    @param target: 同步作业
+    """
     healthcheck = target.get("healthcheck", None)
     target_id = target.get("id", None)
     if not target_id or not healthcheck:
         return
-    sqla_helper = db.get_sqla_helper()[1]
-    instances = DiscoveryInstance({}).get_instances_by_target_id(target_id, sqla_helper)
+    instances = health_store.instances(target_id)
     if not instances:
         return
-    fct = funboost_current_task()
-    for instance in instances:
-        instance_health_check.publish({'target': target, 'instance': instance.to_dict_item()},
-                                      task_id=fct.function_result_status.task_id)
+    # 不健康的实例不再进行健康检查，超过10分钟后删除实例
+    # 如果实例恢复了，会重新插入，进而重新进行健康检查
+    # 如果一直不恢复，或者已经下线了，提前删除也不影响
+    expired = [d.instance for d in instances if d.status == "unhealthy" and d.check_timeout(d.last_time)]
+    if expired:
+        logger.warning(f"实例 {target_id} {expired} 超过10分钟仍未恢复，删除")
+        health_store.delete_by_instances(expired)
+    results = prober.run(target, [d for d in instances if d.status != "unhealthy"],
+                         interval_seconds(healthcheck.get("interval") or target.get("fetch_interval")))
+    apply_results(target, results)
 
 
 @boost(boost_params=FunboostCommonConfig(queue_name='queue_syncer_job', qps=50, ))
@@ -105,77 +151,190 @@ def syncer(target: dict):
     if not discovery_client or not gateway_client:
         logger.warning(f"没有获取到注册中心或者网关实例{target}")
         return
-    services = discovery_client.get_all_service(target.get("config"))
-    if len(services) == 0:
+    # 注册中心分页返回服务，拿到第一页就开始同步
+    services = discovery_client.iter_all_service(target.get("config"))
+    first = next(services, None)
+    if first is None:
         logger.info(f"没有获取到服务列表{target}")
         return
+    selector = get_service_selector(target)
+    # 本轮同步的服务，用于订阅注册中心的变更推送
+    service_names = []
+
+    def selected_services():
+        # 不符合 include/exclude-service 的服务不同步也不订阅，名称只在这里判断一次
+        for service in itertools.chain([first], services):
+            if selector.match_name(service.name):
+                service_names.append(service.name)
+                yield service
 
-    logger.info(f"同步服务列表, 作业: {target.get('id')} services: {services}")
-    for service in services:
-        # 如果服务名称在排除列表中，则跳过
-        exclude = any(bool(re.match(ex, service.name)) for ex in target.get("exclude_service", []))
-        if exclude:
-            continue
-        # 同步服务的所有实例
-        discovery_instances = service.instances
-        if not discovery_instances:
-            discovery_instances, last_time = discovery_client.get_service_all_instances(service.name,
-                                                                                        target.get("config"))
-            service.last_time = last_time and last_time > 0 or int(NbTime().timestamp)
-        logger.info(
-            f"同步服务实例, 作业: {target.get('id')}, service_name: {service.name}, 最后更新时间为: {NbTime(service.last_time).datetime_str} ,instances: {discovery_instances}")
-
-        sqla_helper = db.get_sqla_helper()[1]
-        healthcheck = target.get("healthcheck", {})
-        if healthcheck:
-            try:
-                # syncer 同步任务，只管存或更新
-                DiscoveryInstance({"target_id": target.get('id'), "service": service.name}).save_or_update(
-                    discovery_instances, sqla_helper)
-                # 拿到 discovery_instances 和 health_check 里的 unhealthy 比较，将 discovery 的下掉，保留 >= min-hosts
-                instances = DiscoveryInstance(
-                    {"target_id": target.get('id'), "service": service.name}).get_target_service_all_instance(
-                    healthcheck.get("min-hosts", 1), sqla_helper)
-                unhealthy = [d for d in instances if d.status == "unhealthy"]
-                # 总节点-不健康节点>最小检查数(要保留的节点数)
-                if unhealthy:
-                    # 移除 discovery_instances 中 unhealthy 实例
-                    unhealthy_instances = [d for d in discovery_instances if
-                                           f"{d.ip}:{d.port}" in [b.instance for b in unhealthy]]
-                    # 重新修改注册中心实例
-                    discovery_instances = [d for d in discovery_instances if
-                                           f"{d.ip}:{d.port}" not in [b.instance for b in unhealthy]]
-                    if unhealthy_instances:
-                        for unhealthy_instance in unhealthy_instances:
-                            unhealthy_instance.change = True
-                            unhealthy_instance.enabled = False
-                        # 下线 unhealthy 实例
-                        registration = Registration(service_name=service.name, ext_data=target.get("config", {}))
-                        discovery_client.modify_registration(registration, unhealthy_instances)
-                    # 删除无效实例
-                    DiscoveryInstance({}).delete_by_instances([d.instance for d in unhealthy], sqla_helper)
-            except Exception as e:
-                logger.warning(f"健康检查下线实例失败, {target.get('id', None)} , {service.name}", exc_info=e)
-
-        gateway_instances = gateway_client.get_service_all_instances(target, service.name)
-        logger.info(
-            f"网关实例列表, 作业: {target.get('id')}, service_name: {service.name}, instances: {gateway_instances}")
-        # key 为 注册中心实例 ip:port，value 为实例信息
-        dim = {f"{item.ip}:{item.port}": item for item in (discovery_instances or [])}
-        # key 为 网关实例 ip:port，value 为实例信息
-        gim = {f"{item.ip}:{item.port}": item for item in (gateway_instances or [])}
-        # 合并两个字典，获取合集
-        merged_dict = {**gim, **dim}
-        # 获取差集
-        diffIns = [item._replace(change=True, enabled=key in dim) for key, item in merged_dict.items() if
-                   key not in dim or key not in gim or dim[key].weight != gim[key].weight]
-        logger.info(f"获取变更实例列表, 作业: {target.get('id')}, service_name: {service.name}, instances: {diffIns}")
-        # 同步差异
-        if not diffIns:
-            logger.info(f"没有变更实例,跳过更新, 作业: {target.get('id')}, service_name: {service.name}")
-            continue
-        gateway_client.sync_instances(target, service.name, diffIns, discovery_instances)
-        Jobs(**target).save_or_update(sqla_helper)
+    logger.info(f"同步服务列表, 作业: {target.get('id')}")
+    concurrency = max(target.get("concurrency", 1) or 1, 1)
+    with cycle_lock(target):
+        gateway_client.begin_cycle(target)
+        # 每隔 full-verify-cycles 轮忽略指纹，全量比对一次网关，用于发现网关被手工修改等情况
+        full_verify = fingerprints.next_cycle(target.get("id"), target.get("full_verify_cycles", 10))
+        try:
+            if concurrency == 1:
+                changes = [sync_service(target, service, discovery_client, gateway_client, full_verify) for service
+                           in selected_services()]
+            else:
+                # 服务之间并行，单个服务内部仍然是 读取 -> 比对 -> 写入 的顺序
+                with ThreadPoolExecutor(max_workers=concurrency,
+                                        thread_name_prefix=f"syncer-{target.get('id')}") as pool:
+                    changes = list(pool.map(
+                        lambda item: sync_service(target, item, discovery_client, gateway_client, full_verify),
+                        selected_services()))
+        finally:
+            if not record_outcomes(target, gateway_client.end_cycle(target)):
+                fingerprints.discard(target.get("id"))
+            from app.model.config import settings
+            fingerprints.dump(settings.config.common.fingerprint_store)
+    if any(changes):
+        Jobs(**target).save_or_update(db.get_sqla_helper()[1])
+    if target.get("subscribe") and not discovery_client.subscribe(target, service_names, on_service_changed):
+        logger.warning(f"注册中心不支持订阅服务变更, 只能定时同步, 作业: {target.get('id')}")
+
+
+def on_service_changed(target: dict, service_name: str):
+    """
+    注册中心推送了服务变更，立即同步这一个服务
+    """
+    service_syncer.publish({"target": target, "service_name": service_name})
+
+
+@boost(boost_params=FunboostCommonConfig(queue_name='queue_service_syncer_job', qps=50, ))
+def service_syncer(target: dict, service_name: str):
+    """
+    同步单个服务，由注册中心的变更推送触发，定时的 syncer 作为兜底
+    @param target: 同步作业
+    @param service_name: 服务名称
+    """
+    discovery_client = get_discovery_client(target.get("discovery"))
+    gateway_client = get_gateway_client(target.get("gateway"))
+    if not discovery_client or not gateway_client:
+        logger.warning(f"没有获取到注册中心或者网关实例{target}")
+        return
+    if not get_service_selector(target).match_name(service_name):
+        return
+    instances, last_time = discovery_client.get_service_all_instances(service_name, target.get("config"))
+    service = Service(name=service_name, instances=instances, last_time=last_time)
+    # 单个服务也是完整的一轮: 等同一个作业正在进行的定时同步结束，重新开始一轮，不使用上一轮的网关快照
+    with cycle_lock(target):
+        gateway_client.begin_cycle(target)
+        try:
+            changed = sync_service(target, service, discovery_client, gateway_client, full_verify=False)
+        finally:
+            if not record_outcomes(target, gateway_client.end_cycle(target)):
+                fingerprints.discard(target.get("id"))
+    if changed:
+        Jobs(**target).save_or_update(db.get_sqla_helper()[1])
+
+
+def record_outcomes(target: dict, outcomes: list) -> bool:
+    """
+    记录网关写入结果，部分失败时打印失败明细
+    @param target: 同步作业
+    @param outcomes: 网关写入结果
+    @return: 是否全部成功
+    """
+    failures = [outcome for outcome in (outcomes or []) if not outcome.success]
+    if failures:
+        logger.warning(
+            f"同步网关部分失败, 作业: {target.get('id')}, 成功: {len(outcomes) - len(failures)}, 失败: {len(failures)}, 失败明细: {failures}")
+    return not failures
+
+
+def sync_service(target: dict, service: Service, discovery_client: Discovery, gateway_client: Gateway,
+                 full_verify: bool = True) -> bool:
+    """
+    同步单个服务的实例到网关
+    @param target: 同步作业
+    @param service: 注册中心服务
+    @param discovery_client: 注册中心实例
+    @param gateway_client: 网关实例
+    @param full_verify: 是否忽略实例指纹，强制和网关比对
+    @return: 是否有变更写入网关
+    """
+    # 服务名称已经由调用方按 include/exclude-service 筛选过
+    selector = get_service_selector(target)
+    # 注册中心报告服务没有变化(比如 eureka 增量拉取)，没有健康检查时直接跳过
+    healthcheck = target.get("healthcheck", {})
+    if not full_verify and not healthcheck and service.revision >= 0 and \
+            fingerprints.get_revision(target.get("id"), service.name) == service.revision:
+        logger.info(f"服务没有变化,跳过同步, 作业: {target.get('id')}, service_name: {service.name}")
+        return False
+    # 同步服务的所有实例
+    discovery_instances = service.instances
+    if not discovery_instances:
+        discovery_instances, last_time = discovery_client.get_service_all_instances(service.name,
+                                                                                    target.get("config"))
+        service.last_time = last_time and last_time > 0 or int(NbTime().timestamp)
+    if not selector.match_metadata(discovery_instances):
+        logger.info(f"服务实例元数据不匹配 metadata-selector,跳过同步, 作业: {target.get('id')}, service_name: {service.name}")
+        return False
+    logger.info(
+        f"同步服务实例, 作业: {target.get('id')}, service_name: {service.name}, 最后更新时间为: {NbTime(service.last_time).datetime_str} ,instances: {discovery_instances}")
+
+    if healthcheck:
+        try:
+            # syncer 同步任务，只管存或更新
+            health_store.save_or_update(target.get('id'), service.name, discovery_instances)
+            # 拿到 discovery_instances 和 health_check 里的 unhealthy 比较，将 discovery 的下掉，保留 >= min-hosts
+            instances = health_store.service_instances(target.get('id'), service.name, healthcheck.get("min-hosts", 1))
+            unhealthy = {d.instance for d in instances if d.status == "unhealthy"}
+            # 总节点-不健康节点>最小检查数(要保留的节点数)
+            if unhealthy:
+                # 移除 discovery_instances 中 unhealthy 实例
+                discovery_instances, unhealthy_instances = partition(discovery_instances, unhealthy)
+                if unhealthy_instances:
+                    # 下线 unhealthy 实例
+                    registration = Registration(service_name=service.name, ext_data=target.get("config", {}))
+                    discovery_client.modify_registration(registration, [
+                        d.model_copy(update={"change": True, "enabled": False}) for d in unhealthy_instances])
+                # 删除无效实例
+                health_store.delete_by_instances(list(unhealthy))
+        except Exception as e:
+            logger.warning(f"健康检查下线实例失败, {target.get('id', None)} , {service.name}", exc_info=e)
+
+    # 预热: 还没有通过健康检查(unknown)的实例先不写入网关，已经在网关中的保留，通过健康检查后立即同步
+    pending = set()
+    if healthcheck and healthcheck.get("warmup"):
+        pending = {d.instance for d in health_store.service_instances(target.get('id'), service.name) if
+                   d.status == "unknown"}
+    fingerprint = fingerprints.fingerprint(
+        [d.model_copy(update={"enabled": False}) if instance_key(d) in pending else d for d in discovery_instances])
+    if not full_verify and fingerprints.get(target.get("id"), service.name) == fingerprint:
+        logger.info(f"实例指纹没有变化,跳过网关比对, 作业: {target.get('id')}, service_name: {service.name}")
+        fingerprints.put_revision(target.get("id"), service.name, service.revision)
+        return False
+
+    gateway_instances = gateway_client.get_service_all_instances(target, service.name)
+    logger.info(
+        f"网关实例列表, 作业: {target.get('id')}, service_name: {service.name}, instances: {gateway_instances}")
+    if pending:
+        discovery_instances, held = partition(discovery_instances,
+                                              pending - {instance_key(d) for d in gateway_instances or []})
+        if held:
+            warmup(target, service.name, [instance_key(d) for d in held],
+                   functools.partial(on_service_changed, target, service.name))
+    result = reconcile(discovery_instances, gateway_instances)
+    diffIns = result.changes
+    logger.info(f"获取变更实例列表, 作业: {target.get('id')}, service_name: {service.name}, "
+                f"新增: {len(result.adds)}, 删除: {len(result.removes)}, 修改权重: {len(result.weight_changes)}, "
+                f"instances: {diffIns}")
+    # 同步差异
+    if not diffIns:
+        logger.info(f"没有变更实例,跳过更新, 作业: {target.get('id')}, service_name: {service.name}")
+        fingerprints.put(target.get("id"), service.name, fingerprint)
+        fingerprints.put_revision(target.get("id"), service.name, service.revision)
+        return False
+    if record_outcomes(target, gateway_client.sync_instances(target, service.name, diffIns, discovery_instances)):
+        fingerprints.put(target.get("id"), service.name, fingerprint)
+        fingerprints.put_revision(target.get("id"), service.name, service.revision)
+    else:
+        fingerprints.discard(target.get("id"), service.name)
+    return True
 
 
 @boost(boost_params=FunboostCommonConfig(queue_name='queue_reload_job', qps=1, ))
@@ -183,6 +342,11 @@ def reload():
     logger.info("load config yaml")
     from app.model.config import settings, discovery_clients, gateway_clients
     clear_client()
+    fingerprints.load(settings.config.common.fingerprint_store)
+    prober.reset(settings.config.common.health_check_concurrency, settings.config.common.health_check_qps,
+                 settings.config.common.probe_cache_ttl_sec)
+    health_events.resize(settings.config.common.health_events_size)
+    health_store.start(settings.config.common.health_flush_interval_sec, db.get_sqla_helper()[1])
     # key 为 name，value 为 discovery client
     if settings.config.discovery_servers:
         for name, discovery in settings.config.discovery_servers.items():
@@ -201,6 +365,8 @@ def reload():
     if settings.config.targets:
         for index, target in enumerate(settings.config.targets):
             target.id = f"{index}-{target.gateway}-{target.discovery}"
+            if target.healthcheck:
+                health_store.load(target.id, sqla_helper)
 
             if target.enabled:
                 second, minute, hour, day, month, day_of_week, next_run_time = time_parser(target.fetch_interval)
@@ -216,14 +382,26 @@ def reload():
                                                                             day=day, month=month,
                                                                             day_of_week=day_of_week),
                                                         kwargs={"target": target.model_dump()}, replace_existing=True)
-                # 健康检查
+                # 健康检查，每个作业一个定时任务，按 healthcheck.interval 执行，没有配置时和同步间隔相同
                 if target.healthcheck:
-                    funboost_background_scheduler_redis_store.add_push_job(health_check, id="health-check",
-                                                        name="health-check",
-                                                        trigger=CronTrigger(second=second, minute=minute, hour=hour,
-                                                                            day=day, month=month,
-                                                                            day_of_week=day_of_week),
-                                                        kwargs={"target": target.model_dump()}, replace_existing=True)
+                    job_id = f"health-check-{target.id}"
+                    second, minute, hour, day, month, day_of_week, next_run_time = time_parser(
+                        target.healthcheck.get("interval") or target.fetch_interval)
+                    if next_run_time:
+                        funboost_background_scheduler_redis_store.add_push_job(health_check, id=job_id, name=job_id,
+                                                            next_run_time=next_run_time,
+                                                            kwargs={"target": target.model_dump()},
+                                                            replace_existing=True)
+                    else:
+                        funboost_background_scheduler_redis_store.add_push_job(health_check, id=job_id, name=job_id,
+                                                            trigger=CronTrigger(second=second, minute=minute,
+                                                                                hour=hour, day=day, month=month,
+                                                                                day_of_week=day_of_week),
+                                                            kwargs={"target": target.model_dump()},
+                                                            replace_existing=True)
+    # 只保留配置中有健康检查的作业的实例状态
+    DiscoveryInstance.delete_other_targets(
+        [target.id for target in settings.config.targets or [] if target.healthcheck], sqla_helper)
 
 
 def time_parser(fetch_interval: str = ''):
@@ -278,3 +456,17 @@ def time_parser(fetch_interval: str = ''):
             values = fetch_interval.split()
         assert len(values) == 6, f"fetch_interval格式错误: {fetch_interval}"
         return values[0], values[1], values[2], values[3], values[4], values[5], None
+
+
+def interval_seconds(expression: str) -> float:
+    """
+    @param expression: 作业表达式，格式同 time_parser
+    @return: 相邻两次执行的间隔秒数，只执行一次的作业(@reboot)返回0
+    """
+    second, minute, hour, day, month, day_of_week, next_run_time = time_parser(expression)
+    if next_run_time:
+        return 0
+    trigger = CronTrigger(second=second, minute=minute, hour=hour, day=day, month=month, day_of_week=day_of_week)
+    first = trigger.get_next_fire_time(None, datetime.datetime.now(trigger.timezone))
+    following = trigger.get_next_fire_time(first, first + datetime.timedelta(microseconds=1))
+    return (following - first).total_seconds() if first and following else 0
@@ -18,12 +18,25 @@
 import functools
 
 from db_libs.sqla_lib import SqlaReflectHelper
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+
+
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    """
+    WAL 模式下读写互不阻塞，synchronous=NORMAL 在 WAL 模式下只在 checkpoint 时 fsync
+    busy_timeout 避免并发写入时直接报 database is locked
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.close()
 
 
 @functools.lru_cache()
 def get_sqla_helper():
     enginex = create_engine("sqlite+pysqlite:///syncer-jobs.db", echo=True)
+    event.listen(enginex, "connect", set_sqlite_pragma)
     sqla_helper = SqlaReflectHelper(enginex)
     return enginex, sqla_helper
 
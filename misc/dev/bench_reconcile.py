@@ -0,0 +1,66 @@
+"""
+benchmark for app.service.reconcile, run from project root:
+    python misc/dev/bench_reconcile.py [instances] [rounds]
+"""
+import random
+import sys
+import timeit
+
+sys.path.insert(0, ".")
+
+from app.model.syncer_model import Instance  # noqa: E402
+from app.service.reconcile import reconcile, partition  # noqa: E402
+
+
+def make_instances(size: int, offset: int = 0, weight: float = 1.0):
+    return [Instance(ip=f"10.{(i >> 16) & 255}.{(i >> 8) & 255}.{i & 255}", port=8080, weight=weight)
+            for i in range(offset, offset + size)]
+
+
+def legacy_diff(discovery_instances, gateway_instances):
+    """
+    the dict merge + _replace implementation replaced by reconcile(), kept for comparison
+    """
+    dim = {f"{item.ip}:{item.port}": item for item in (discovery_instances or [])}
+    gim = {f"{item.ip}:{item.port}": item for item in (gateway_instances or [])}
+    merged_dict = {**gim, **dim}
+    return [item._replace(change=True, enabled=key in dim) for key, item in merged_dict.items() if
+            key not in dim or key not in gim or dim[key].weight != gim[key].weight]
+
+
+def legacy_partition(discovery_instances, unhealthy):
+    unhealthy_instances = [d for d in discovery_instances if f"{d.ip}:{d.port}" in [b for b in unhealthy]]
+    discovery_instances = [d for d in discovery_instances if f"{d.ip}:{d.port}" not in [b for b in unhealthy]]
+    return discovery_instances, unhealthy_instances
+
+
+def bench(name: str, func, rounds: int):
+    cost = min(timeit.repeat(func, number=1, repeat=rounds))
+    print(f"{name:<48}{cost * 1000:>10.2f} ms")
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    discovery = make_instances(size)
+    # 10% 下线，10% 新增，10% 改权重
+    gateway = make_instances(size, offset=size // 10)
+    for item in random.sample(gateway, size // 10):
+        item.weight = 50
+    unhealthy = {f"{item.ip}:{item.port}" for item in random.sample(discovery, max(size // 100, 1))}
+
+    result = reconcile(discovery, gateway)
+    legacy = legacy_diff([item.model_copy() for item in discovery], [item.model_copy() for item in gateway])
+    assert len(result.changes) == len(legacy)
+    print(f"instances: {size}, adds: {len(result.adds)}, removes: {len(result.removes)}, "
+          f"weight_changes: {len(result.weight_changes)}, unchanged: {len(result.unchanged)}")
+
+    bench("reconcile (identical)", lambda: reconcile(discovery, discovery), rounds)
+    bench("reconcile (30% changed)", lambda: reconcile(discovery, gateway), rounds)
+    bench("legacy diff (30% changed, mutates input)", lambda: legacy_diff(discovery, gateway), rounds)
+    bench(f"partition ({len(unhealthy)} unhealthy)", lambda: partition(discovery, unhealthy), rounds)
+    bench(f"legacy partition ({len(unhealthy)} unhealthy)", lambda: legacy_partition(discovery, unhealthy), 1)
+
+
+if __name__ == '__main__':
+    main()
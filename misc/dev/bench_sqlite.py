@@ -0,0 +1,93 @@
+"""
+benchmark for the instances table, run from project root:
+    python misc/dev/bench_sqlite.py [rows] [rounds]
+compares the legacy schema (no indexes, default journal) with the current one at the same row count:
+query latency of the reload-time restore (DiscoveryInstance.query_by_target) with its query plan,
+plus the batched health flush (upsert and delete by id)
+"""
+import os
+import random
+import sys
+import tempfile
+import timeit
+import uuid
+from datetime import datetime
+
+sys.path.insert(0, ".")
+
+from db_libs.sqla_lib import SqlaReflectHelper  # noqa: E402
+from sqlalchemy import create_engine, delete, event, select  # noqa: E402
+
+from app.model.syncer_model import SQL_UPSERT_INSTANCES, DiscoveryInstance, migrate_schema  # noqa: E402
+from core.database.db import set_sqlite_pragma  # noqa: E402
+
+LEGACY_SCHEMA = """
+create table instances (id varchar primary key, target_id varchar, service varchar, instance varchar,
+successes integer, failures integer, timeouts integer, status varchar, create_time datetime, last_time datetime)
+"""
+
+TARGET_SIZE = 20
+SERVICE_SIZE = 50
+
+
+def make_rows(size: int):
+    now = datetime.now()
+    return [{"id": str(uuid.uuid4()), "target_id": f"{i % TARGET_SIZE}-apisix-nacos",
+             "service": f"service-{i // SERVICE_SIZE}",
+             "instance": f"10.{(i >> 16) & 255}.{(i >> 8) & 255}.{i & 255}:8080",
+             "successes": random.randint(0, 3), "failures": random.randint(0, 3), "timeouts": random.randint(0, 1),
+             "status": random.choice(["healthy", "unhealthy", "unknown"]), "create_time": now, "last_time": now}
+            for i in range(size)]
+
+
+def make_engine(legacy: bool):
+    file_name = os.path.join(tempfile.mkdtemp(prefix="bench-sqlite-"), "syncer-jobs.db")
+    engine = create_engine(f"sqlite+pysqlite:///{file_name}")
+    if legacy:
+        with engine.begin() as conn:
+            conn.exec_driver_sql(LEGACY_SCHEMA)
+    else:
+        event.listen(engine, "connect", set_sqlite_pragma)
+        migrate_schema(SqlaReflectHelper(engine))
+    return engine
+
+
+def upsert(engine, rows):
+    with engine.begin() as conn:
+        conn.execute(SQL_UPSERT_INSTANCES, rows)
+
+
+def bench(name: str, func, rounds: int):
+    cost = min(timeit.repeat(func, number=1, repeat=rounds))
+    print(f"{name:<56}{cost * 1000:>10.3f} ms")
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    rows = make_rows(size)
+    # 和 DiscoveryInstance.query_by_target 相同
+    query = select(DiscoveryInstance).where(DiscoveryInstance.target_id == random.choice(rows)["target_id"])
+    # 和 DiscoveryInstance.flush 的删除相同
+    deleted = delete(DiscoveryInstance).where(
+        DiscoveryInstance.id.in_([row["id"] for row in random.sample(rows, min(size, 500))]))
+    for legacy in (True, False):
+        label = "legacy" if legacy else "current"
+        engine = make_engine(legacy)
+        upsert(engine, rows)
+        print(f"{label}: {size} rows, journal_mode: "
+              f"{engine.connect().exec_driver_sql('PRAGMA journal_mode').scalar()}")
+        with engine.connect() as conn:
+            sql = str(query.compile(engine, compile_kwargs={"literal_binds": True}))
+            plan = conn.exec_driver_sql(f"explain query plan {sql}").all()
+            print("  plan: " + " | ".join(row[-1] for row in plan))
+            bench(f"{label} select target instances (reload restore)", lambda: conn.exec_driver_sql(sql).all(), rounds)
+            bench(f"{label} delete 500 rows by id (rolled back)",
+                  lambda: (conn.execute(deleted), conn.rollback()), rounds)
+        updates = [dict(row, failures=1) for row in random.sample(rows, min(size, 5000))]
+        bench(f"{label} upsert {len(updates)} rows in one transaction", lambda: upsert(engine, updates), 3)
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
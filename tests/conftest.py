@@ -0,0 +1,13 @@
+import os
+import sys
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("PROJECT_ENV", "dev")
+sys.path.insert(0, ROOT)
+
+# app/__init__.py 会创建 FastAPI 应用并注册 funboost 任务(需要 redis)，测试只导入 app 下的模块
+if "app" not in sys.modules:
+    app = types.ModuleType("app")
+    app.__path__ = [os.path.join(ROOT, "app")]
+    sys.modules["app"] = app
@@ -0,0 +1,69 @@
+import http.server
+import json
+import threading
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from app.service.health.alert import AlertDispatcher
+from app.service.transport import HttpTransport
+
+
+class AlertHandler(http.server.BaseHTTPRequestHandler):
+    bodies = []
+
+    def do_GET(self):
+        AlertHandler.bodies.append(json.loads(parse_qs(urlparse(self.path).query)["body"][0]))
+        self.send_response(200)
+        self.end_headers()
+
+    def do_POST(self):
+        AlertHandler.bodies.append(json.loads(self.rfile.read(int(self.headers["Content-Length"]))))
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture()
+def server():
+    AlertHandler.bodies = []
+    srv = http.server.ThreadingHTTPServer(("127.0.0.1", 0), AlertHandler)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    yield srv
+    srv.shutdown()
+
+
+def test_alert_is_sent_through_http_transport(server):
+    dispatcher = AlertDispatcher()
+    assert isinstance(dispatcher._transport, HttpTransport)
+
+    body = {"target_id": "0-apisix-nacos", "service": "svc", "transitions": [{"instance": "10.0.0.1:8080"}]}
+    dispatcher.send({"url": f"http://127.0.0.1:{server.server_port}/alert", "method": "POST"}, body, 0)
+
+    assert AlertHandler.bodies == [body]
+    assert dispatcher._retries == []
+
+
+def test_alert_defaults_to_get_with_body_query(server):
+    dispatcher = AlertDispatcher()
+    body = {"target_id": "0-apisix-nacos", "service": "svc", "transitions": [{"instance": "10.0.0.1:8080"}]}
+    # method 不配置或配置为空时和之前一样使用 GET
+    dispatcher.send({"url": f"http://127.0.0.1:{server.server_port}/alert", "method": ""}, body, 0)
+
+    assert AlertHandler.bodies == [body]
+    assert dispatcher._retries == []
+
+
+def test_dropped_counts_every_full_queue_put():
+    dispatcher = AlertDispatcher(max_size=1)
+    dispatcher._thread = object()  # 不启动后台线程，队列保持满
+    dispatcher._queue.put_nowait(None)
+
+    threads = [threading.Thread(target=lambda: [dispatcher.put("0", "svc", {}, {}) for _ in range(200)])
+               for _ in range(4)]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+
+    assert dispatcher.dropped == 800
@@ -0,0 +1,91 @@
+import json
+
+import yaml
+
+from app.model.config import Gateway as GatewayConfig
+from app.model.syncer_model import Instance
+from app.service.gateway.apisix import Apisix, safe_dump
+
+TARGET = {"id": "0-apisix-nacos", "config": {}}
+
+
+class FakeApisix(Apisix):
+    def __init__(self):
+        super().__init__(GatewayConfig(**{"type": "apisix", "admin-url": "http://apisix", "prefix": "/apisix/admin/",
+                                          "config": {"version": "v3", "page-size": 2}}))
+        self.upstreams = {f"svc-{i}": [{"host": f"10.0.0.{i}", "port": 8080, "weight": 1}] for i in range(3)}
+        self.calls = []
+        self.revisions = {}
+
+    def apisix_execute(self, method, uri, params, data=None):
+        self.calls.append((method, uri, params.get("page")))
+        if method == "PATCH":
+            name = uri.split("/")[1]
+            self.upstreams[name] = json.loads(data)
+            return {"key": f"/apisix/upstreams/{name}",
+                    "value": {"id": name, "name": name, "nodes": self.upstreams[name]}}
+        items = [{"key": f"/apisix/upstreams/{name}", "modifiedIndex": self.revisions.get(name, 1),
+                  "value": {"id": name, "name": name, "nodes": nodes}} for name, nodes in self.upstreams.items()]
+        page, page_size = params.get("page", 1), params.get("page_size", len(items))
+        return {"total": len(items), "list": items[(page - 1) * page_size:page * page_size]}
+
+
+def test_begin_cycle_defers_the_upstream_snapshot_until_a_gateway_read():
+    gateway = FakeApisix()
+
+    # 指纹都没变化，整轮都不读取网关
+    gateway.begin_cycle(TARGET)
+    assert gateway.calls == []
+
+    gateway.begin_cycle(TARGET)
+    assert [item.ip for item in gateway.get_service_all_instances(TARGET, "svc-1")] == ["10.0.0.1"]
+    assert gateway.calls == [("GET", "upstreams", 1), ("GET", "upstreams", 2)]
+    assert gateway.upstream_index["svc-1"] == {"id": "svc-1", "nodes": gateway.upstreams["svc-1"], "modifiedIndex": 1}
+    # 本轮后续的服务使用快照
+    assert [item.ip for item in gateway.get_service_all_instances(TARGET, "svc-2")] == ["10.0.0.2"]
+    assert gateway.get_service_all_instances(TARGET, "new") == []
+    assert len(gateway.calls) == 2
+
+    # 下一轮重新拉取
+    gateway.upstreams["svc-1"] = [{"host": "10.0.1.1", "port": 8080, "weight": 1}]
+    gateway.begin_cycle(TARGET)
+    assert [item.ip for item in gateway.get_service_all_instances(TARGET, "svc-1")] == ["10.0.1.1"]
+    assert len(gateway.calls) == 4
+
+
+def test_sync_instances_rereads_the_upstream_and_counts_conflicts():
+    gateway = FakeApisix()
+    gateway.begin_cycle(TARGET)
+    gateway.get_service_all_instances(TARGET, "svc-1")
+    gateway.calls.clear()
+
+    # 节点集合和网关一致(只是权重写法不同)，读取后跳过写入
+    same = [Instance(ip="10.0.0.1", port=8080, weight=1.0, enabled=True)]
+    assert [item.action for item in gateway.sync_instances(TARGET, "svc-1", same, same)] == ["skip"]
+    assert gateway.calls == [("GET", "upstreams/svc-1", None)]
+
+    # 比对之后被其他人改成了要写入的节点: 记为冲突，按最新节点重新比对后跳过
+    desired = [Instance(ip="10.0.0.9", port=8080, enabled=True)]
+    gateway.upstreams["svc-1"], gateway.revisions["svc-1"] = [{"host": "10.0.0.9", "port": 8080, "weight": 1}], 5
+    assert [item.action for item in gateway.sync_instances(TARGET, "svc-1", desired, desired)] == ["skip"]
+    assert gateway.upstream_index["svc-1"]["modifiedIndex"] == 5
+
+    # 被其他人改成了别的节点: 记为冲突，按注册中心写入
+    gateway.upstream_index["svc-1"] = dict(gateway.upstream_index["svc-1"], modifiedIndex=4)
+    gateway.upstreams["svc-1"] = [{"host": "10.0.0.7", "port": 8080, "weight": 1}]
+    gateway.calls.clear()
+    outcomes = gateway.sync_instances(TARGET, "svc-1", desired, desired)
+    assert [(item.action, item.success) for item in outcomes] == [("update", True)]
+    assert gateway.calls == [("GET", "upstreams/svc-1", None), ("PATCH", "upstreams/svc-1/nodes", None)]
+    assert gateway.upstreams["svc-1"] == [{"host": "10.0.0.9", "port": 8080, "weight": 1}]
+    assert gateway.write_stats() == {"svc-1": {"writes": 1, "skipped": 2, "conflicts": 2, "failures": 0}}
+
+
+def test_safe_dump_renders_multiline_strings_without_touching_the_global_dumper():
+    representers = dict(yaml.SafeDumper.yaml_representers)
+    text = safe_dump([{"id": "svc", "script": "line1\nline2"}])
+
+    assert "script: |-\n    line1\n    line2" in text
+    assert yaml.safe_load(text) == [{"id": "svc", "script": "line1\nline2"}]
+    assert yaml.SafeDumper.yaml_representers == representers
+    assert not hasattr(yaml.SafeDumper, "org_represent_str")
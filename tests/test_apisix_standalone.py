@@ -0,0 +1,90 @@
+import asyncio
+
+import yaml
+
+from app.model.config import Gateway as GatewayConfig
+from app.model.syncer_model import Instance
+from app.service.gateway.apisix_standalone import ApisixStandalone
+
+TARGET = {"id": "0-apisix_standalone-nacos", "config": {}}
+
+ORIGIN = {"routes": [{"id": "r1", "uri": "/a", "upstream_id": "svc-a"}],
+          "upstreams": [{"id": "svc-a", "name": "svc-a", "type": "roundrobin",
+                         "nodes": [{"host": "10.0.0.1", "port": 80, "weight": 1}]}]}
+
+
+def make_gateway(tmp_path, debounce: float = 60) -> ApisixStandalone:
+    file = tmp_path / "conf" / "apisix.yaml"
+    file.parent.mkdir()
+    file.write_text(yaml.safe_dump(ORIGIN) + "#END\n", encoding="utf-8")
+    return ApisixStandalone(GatewayConfig(**{"type": "apisix_standalone", "config": {
+        "file": str(file), "version": "v3", "debounce-sec": debounce}}))
+
+
+def nodes(*addrs: str):
+    return [Instance(ip=addr.split(":")[0], port=addr.split(":")[1], weight=1, enabled=True) for addr in addrs]
+
+
+def read(gateway: ApisixStandalone) -> dict:
+    with open(gateway.file, encoding="utf-8") as f:
+        return yaml.safe_load(f)
+
+
+def test_sync_renders_only_upstreams_and_keeps_the_rest(tmp_path):
+    gateway = make_gateway(tmp_path)
+    assert [o.action for o in gateway.sync_instances(TARGET, "svc-a", nodes("10.0.0.1:80"), nodes("10.0.0.1:80"))] \
+           == ["skip"]
+    assert [o.action for o in gateway.sync_instances(TARGET, "svc-a", nodes("10.0.0.2:80"),
+                                                     nodes("10.0.0.1:80", "10.0.0.2:80"))] == ["update"]
+    assert [o.action for o in gateway.sync_instances(TARGET, "svc-b", nodes("10.0.1.1:80"), nodes("10.0.1.1:80"))] \
+           == ["create"]
+    # 写入前查询的是等待写入的内容
+    assert len(gateway.get_service_all_instances(TARGET, "svc-a")) == 2
+    gateway.close()
+
+    doc = read(gateway)
+    assert doc["routes"] == ORIGIN["routes"]
+    upstreams = {item["id"]: item for item in doc["upstreams"]}
+    assert [item["id"] for item in doc["upstreams"]] == ["svc-a", "svc-b"]
+    assert upstreams["svc-a"]["type"] == "roundrobin"
+    assert [node["host"] for node in upstreams["svc-a"]["nodes"]] == ["10.0.0.1", "10.0.0.2"]
+    assert [node["host"] for node in upstreams["svc-b"]["nodes"]] == ["10.0.1.1"]
+    # 先写临时文件再 rename，不会留下临时文件
+    assert [path.name for path in (tmp_path / "conf").iterdir()] == ["apisix.yaml"]
+
+
+def test_changes_within_the_debounce_window_are_written_once(tmp_path, monkeypatch):
+    gateway = make_gateway(tmp_path, debounce=0.1)
+    writes = []
+    origin_write = gateway.write
+    monkeypatch.setattr(gateway, "write", lambda content: (writes.append(content), origin_write(content)))
+    for i in range(5):
+        gateway.sync_instances(TARGET, f"svc-{i}", nodes(f"10.0.{i}.1:80"), nodes(f"10.0.{i}.1:80"))
+    gateway._timer.join(5)
+
+    assert len(writes) == 1
+    assert len(read(gateway)["upstreams"]) == 6
+
+
+def test_external_edits_are_reloaded_before_writing(tmp_path):
+    gateway = make_gateway(tmp_path)
+    gateway.sync_instances(TARGET, "svc-b", nodes("10.0.1.1:80"), nodes("10.0.1.1:80"))
+    edited = dict(ORIGIN, routes=ORIGIN["routes"] + [{"id": "r2", "uri": "/b", "upstream_id": "svc-b"}])
+    with open(gateway.file, "w", encoding="utf-8") as f:
+        f.write(yaml.safe_dump(edited) + "#END\n")
+    gateway.close()
+
+    doc = read(gateway)
+    assert [item["id"] for item in doc["routes"]] == ["r1", "r2"]
+    assert [item["id"] for item in doc["upstreams"]] == ["svc-a", "svc-b"]
+
+
+def test_restore_replaces_the_file_and_drops_pending_changes(tmp_path):
+    gateway = make_gateway(tmp_path)
+    gateway.sync_instances(TARGET, "svc-b", nodes("10.0.1.1:80"), nodes("10.0.1.1:80"))
+    body = yaml.safe_dump({"routes": [], "upstreams": [{"id": "svc-c", "name": "svc-c", "nodes": []}]}) + "#END\n"
+    asyncio.run(gateway.restore_gateway(body))
+    gateway.close()
+
+    assert read(gateway) == {"routes": [], "upstreams": [{"id": "svc-c", "name": "svc-c", "nodes": []}]}
+    assert gateway.get_service_all_instances(TARGET, "svc-b") == []
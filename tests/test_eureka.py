@@ -0,0 +1,57 @@
+from app.model.config import Discovery as DiscoveryConfig
+from app.service.discovery import eureka as eureka_module
+from app.service.discovery.eureka import Eureka
+
+
+class FakeEureka(Eureka):
+    def __init__(self, config):
+        super().__init__(config)
+        self.registry = []
+        self.calls = []
+
+    def eureka_execute(self, method="GET", uri=None, params=None, data=None) -> dict:
+        self.calls.append(uri)
+        instances = [{"instanceId": ip, "ipAddr": ip, "port": {"$": 8080}, "status": "UP",
+                      "metadata": {}} for ip in self.registry]
+        if uri == "/delta":
+            # 错过了增量窗口，delta 里已经没有这次替换，hashcode 和本地一致
+            return {"applications": {"apps__hashcode": f"UP_{len(instances)}_", "application": []}}
+        return {"applications": {"application": [{"name": "SVC", "instance": instances}]}}
+
+
+def make_client(**config) -> FakeEureka:
+    return FakeEureka(DiscoveryConfig(**{"type": "eureka", "host": "http://eureka", "prefix": "/eureka/",
+                                         "config": config}))
+
+
+def ips(client: FakeEureka):
+    return [instance.ip for service in client.get_all_service({}) for instance in service.instances]
+
+
+def test_full_fetch_after_delta_retention(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(eureka_module.time, "monotonic", lambda: now[0])
+    client = make_client()
+    client.registry = ["10.0.0.1"]
+    assert ips(client) == ["10.0.0.1"]
+    client.registry = ["10.0.0.2"]
+    now[0] += 10
+    # 增量窗口内只能拿到 delta，hashcode 相同
+    assert ips(client) == ["10.0.0.1"]
+    now[0] += 181
+    assert ips(client) == ["10.0.0.2"]
+    assert client.calls == ["/", "/delta", "/"]
+
+
+def test_periodic_full_fetch(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(eureka_module.time, "monotonic", lambda: now[0])
+    client = make_client(**{"full-fetch-interval-sec": 60})
+    client.registry = ["10.0.0.1"]
+    ips(client)
+    client.registry = ["10.0.0.2"]
+    for _ in range(6):
+        now[0] += 10
+        ips(client)
+    assert client.calls == ["/"] + ["/delta"] * 5 + ["/"]
+    assert ips(client) == ["10.0.0.2"]
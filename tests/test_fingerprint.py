@@ -0,0 +1,38 @@
+from app.model.syncer_model import Instance
+from app.service.fingerprint import FingerprintStore
+
+TARGET = "0-apisix-nacos"
+
+
+def test_restart_skips_services_with_persisted_fingerprints(tmp_path):
+    file_name = str(tmp_path / "fingerprints.json")
+    fingerprint = FingerprintStore.fingerprint([Instance(ip="10.0.0.1", port=8080, enabled=True)])
+    before = FingerprintStore()
+    assert before.next_cycle(TARGET, 10)
+    before.put(TARGET, "svc", fingerprint)
+    before.dump(file_name)
+
+    # 重启: 新进程清空后从文件加载
+    after = FingerprintStore()
+    after.clear()
+    after.load(file_name)
+
+    # 和 sync_service 的判断一致: 不是全量校验且指纹没变时跳过网关
+    full_verify = after.next_cycle(TARGET, 10)
+    assert not full_verify
+    assert after.get(TARGET, "svc") == fingerprint
+    # 全量校验的间隔从加载时继续计算
+    assert [after.next_cycle(TARGET, 10) for _ in range(9)] == [False] * 8 + [True]
+
+
+def test_targets_without_persisted_fingerprints_still_verify_first(tmp_path):
+    file_name = str(tmp_path / "fingerprints.json")
+    before = FingerprintStore()
+    before.put(TARGET, "svc", "sha1")
+    before.dump(file_name)
+
+    after = FingerprintStore()
+    after.load(file_name)
+
+    assert after.next_cycle("1-apisix-nacos", 10)
+    assert after.next_cycle(TARGET, 1)
@@ -0,0 +1,53 @@
+import itertools
+from datetime import datetime
+from types import SimpleNamespace
+
+import pytest
+
+from app.service.health import events as events_module
+from app.service.health.events import HealthEvents
+
+
+@pytest.fixture(autouse=True)
+def clock(monkeypatch):
+    # 每个事件的时间都不同，按时间倒序的结果是确定的
+    ticks = itertools.count(1_700_000_000)
+    monkeypatch.setattr(events_module, "time", SimpleNamespace(time=lambda: float(next(ticks))))
+
+
+def record(events: HealthEvents, target_id: str, size: int, kind: str = "probe"):
+    for i in range(size):
+        events.record(target_id, kind, "svc", f"10.0.0.{i}:80", "failures", "unknown")
+
+
+def test_each_target_keeps_only_its_latest_events():
+    events = HealthEvents(size=3)
+    record(events, "a", 5)
+    record(events, "b", 1)
+
+    # 最新的在前，超过 size 时丢弃最早的
+    assert [item["instance"] for item in events.query("a")] == ["10.0.0.4:80", "10.0.0.3:80", "10.0.0.2:80"]
+    assert [item["target_id"] for item in events.query("b")] == ["b"]
+    assert len(events.query()) == 4
+
+
+def test_query_filters_and_limits():
+    events = HealthEvents()
+    record(events, "a", 5)
+    events.record("a", "transition", "other", "10.0.0.1:80", "unknown", "unhealthy")
+
+    assert [item["status"] for item in events.query(kind="transition")] == ["unhealthy"]
+    assert [item["instance"] for item in events.query(service="svc", instance="10.0.0.1:80")] == ["10.0.0.1:80"]
+    assert len(events.query("a", limit=2)) == 2
+    assert events.query(since=datetime(2999, 1, 1)) == []
+    assert len(events.query(until=datetime(2999, 1, 1))) == 6
+    datetime.strptime(events.query(limit=1)[0]["time"], "%Y-%m-%d %H:%M:%S.%f")
+
+
+def test_resize_keeps_the_latest_events():
+    events = HealthEvents(size=5)
+    record(events, "a", 5)
+    events.resize(2)
+    assert [item["instance"] for item in events.query("a")] == ["10.0.0.4:80", "10.0.0.3:80"]
+    record(events, "a", 1)
+    assert [item["instance"] for item in events.query("a")] == ["10.0.0.0:80", "10.0.0.4:80"]
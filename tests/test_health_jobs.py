@@ -0,0 +1,43 @@
+import pytest
+
+from app.model.syncer_model import DiscoveryInstance
+from app.service.health.scheduler import ProbeScheduler
+
+
+@pytest.fixture()
+def task_syncer():
+    # 导入 funboost 需要连接 redis
+    try:
+        from app.tasks import task_syncer
+    except Exception as e:
+        pytest.skip(f"task_syncer 无法导入: {e}")
+    return task_syncer
+
+
+def make_instance(target_id: str) -> DiscoveryInstance:
+    return DiscoveryInstance({"id": target_id, "target_id": target_id, "service": "svc", "instance": "10.0.0.1:80"})
+
+
+def test_targets_sharing_an_instance_probe_it_at_the_same_offset():
+    scheduler = ProbeScheduler()
+    [(_, delay_a)] = scheduler.plan({"id": "a", "healthcheck": {}}, [make_instance("a")], 60)
+    [(_, delay_b)] = scheduler.plan({"id": "b", "healthcheck": {}}, [make_instance("b")], 60)
+    # 偏移只和实例有关，多个作业在同一时刻探测，可以合并成一次
+    assert delay_a == delay_b
+
+
+@pytest.mark.parametrize("expression, seconds", [("@every 10s", 10), ("@every 2m", 120), ("*/5 * * * * *", 5),
+                                                 ("@hourly", 3600), ("@reboot", 0)])
+def test_interval_seconds(task_syncer, expression, seconds):
+    assert task_syncer.interval_seconds(expression) == seconds
+
+
+def test_health_check_spreads_probes_over_its_own_interval(task_syncer, monkeypatch):
+    calls = []
+    monkeypatch.setattr(task_syncer.health_store, "instances", lambda target_id: [make_instance(target_id)])
+    monkeypatch.setattr(task_syncer.prober, "run", lambda target, instances, interval: calls.append(interval) or [])
+    healthcheck = {"type": "tcp", "interval": "@every 30s"}
+    task_syncer.health_check({"id": "a", "fetch_interval": "@every 10s", "healthcheck": healthcheck})
+    # 没有配置 interval 时和同步间隔相同
+    task_syncer.health_check({"id": "b", "fetch_interval": "@every 10s", "healthcheck": {"type": "tcp"}})
+    assert calls == [30, 10]
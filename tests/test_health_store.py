@@ -0,0 +1,95 @@
+from datetime import datetime
+
+import pytest
+from db_libs.sqla_lib import SqlaReflectHelper
+from sqlalchemy import create_engine
+
+from app.model.syncer_model import DiscoveryInstance, Instance, migrate_schema
+from app.service.health.store import HealthStore
+
+TARGET = "0-apisix-nacos"
+
+
+@pytest.fixture()
+def sqla_helper(tmp_path):
+    helper = SqlaReflectHelper(create_engine(f"sqlite+pysqlite:///{tmp_path / 'syncer-jobs.db'}"))
+    migrate_schema(helper)
+    return helper
+
+
+def probe(store: HealthStore, healthcheck: dict, result: dict):
+    store.apply([item.next_counts(healthcheck, result) for item in store.instances(TARGET)])
+
+
+def test_reload_restores_counts_from_the_database(sqla_helper):
+    healthcheck = {"unhealthy": {"failures": 3}}
+    before = HealthStore()
+    before.start(60, sqla_helper)
+    before.save_or_update(TARGET, "svc", [Instance(ip="10.0.0.1", port=8080, enabled=True)])
+    probe(before, healthcheck, {"failures": 1})
+    probe(before, healthcheck, {"failures": 1})
+    # reload: 停止时写入还没写入的变化，再清空内存
+    before.stop()
+    before.clear()
+
+    after = HealthStore()
+    after.load(TARGET, sqla_helper)
+    [item] = after.service_instances(TARGET, "svc")
+    assert (item.instance, item.failures, item.status) == ("10.0.0.1:8080", 2, "unknown")
+    # 第三次失败达到阈值，计数是接着重启前的
+    probe(after, healthcheck, {"failures": 1})
+    assert after.service_instances(TARGET, "svc")[0].status == "unhealthy"
+
+
+def test_load_keeps_the_latest_duplicate_and_prunes_removed_targets(sqla_helper):
+    rows = [{"id": f"id-{i}", "target_id": target_id, "service": "svc", "instance": "10.0.0.1:8080",
+             "successes": i, "failures": 0, "timeouts": 0, "status": "healthy", "create_time": None,
+             "last_time": datetime(2026, 1, 1, 0, 0, i)} for i, target_id in enumerate([TARGET, TARGET, "9-kong-nacos"])]
+    DiscoveryInstance.flush(rows, [], sqla_helper)
+
+    store = HealthStore()
+    store.load(TARGET, sqla_helper)
+    assert [item.id for item in store.service_instances(TARGET, "svc")] == ["id-1"]
+    store.flush(sqla_helper)
+    DiscoveryInstance.delete_other_targets([TARGET], sqla_helper)
+
+    assert [item.id for item in DiscoveryInstance.query_by_target(TARGET, sqla_helper)] == ["id-1"]
+    assert DiscoveryInstance.query_by_target("9-kong-nacos", sqla_helper) == []
+
+
+def test_flush_writes_dirty_rows_once_and_retries_after_a_failure(sqla_helper, monkeypatch):
+    store = HealthStore()
+    store.save_or_update(TARGET, "svc", [Instance(ip="10.0.0.1", port=8080, enabled=True),
+                                         Instance(ip="10.0.0.2", port=8080, enabled=True)])
+    origin_flush, calls = DiscoveryInstance.flush, []
+
+    def failing_flush(rows, deleted, helper):
+        calls.append((len(rows), len(deleted)))
+        raise RuntimeError("database is locked")
+
+    monkeypatch.setattr(DiscoveryInstance, "flush", staticmethod(failing_flush))
+    store.flush(sqla_helper)
+    # 写入失败的变化保留到下一次
+    monkeypatch.setattr(DiscoveryInstance, "flush", staticmethod(
+        lambda rows, deleted, helper: (calls.append((len(rows), len(deleted))), origin_flush(rows, deleted, helper))))
+    store.flush(sqla_helper)
+    store.flush(sqla_helper)
+    assert calls == [(2, 0), (2, 0)]
+
+    store.delete_by_instances(["10.0.0.1:8080"])
+    store.flush(sqla_helper)
+    assert calls[-1] == (0, 1)
+    assert [item.instance for item in DiscoveryInstance.query_by_target(TARGET, sqla_helper)] == ["10.0.0.2:8080"]
+
+
+def test_service_instances_are_sorted_by_health():
+    store = HealthStore()
+    store.save_or_update(TARGET, "svc", [Instance(ip=f"10.0.0.{i}", port=8080, enabled=True) for i in range(1, 4)])
+    counts = {"10.0.0.1:8080": {"failures": 1, "status": "unknown"}, "10.0.0.2:8080": {"status": "unhealthy"},
+              "10.0.0.3:8080": {"successes": 2, "status": "healthy"}}
+    store.apply([{"id": item.id, "successes": 0, "failures": 0, "timeouts": 0, **counts[item.instance]}
+                 for item in store.instances(TARGET)])
+
+    assert [item.instance for item in store.service_instances(TARGET, "svc")] == [
+        "10.0.0.3:8080", "10.0.0.1:8080", "10.0.0.2:8080"]
+    assert [item.instance for item in store.service_instances(TARGET, "svc", skip=2)] == ["10.0.0.2:8080"]
@@ -0,0 +1,150 @@
+import json
+
+import httpx
+import yaml
+
+from app.model.config import Gateway as GatewayConfig
+from app.model.syncer_model import Instance
+from app.service.gateway.kong import SYNCER_TAG, Kong
+
+TARGET = {"id": "0-kong-nacos", "config": {}}
+
+
+class FakeKong(Kong):
+    def __init__(self, **config):
+        super().__init__(GatewayConfig(**{"type": "kong", "admin-url": "http://kong", "prefix": "/",
+                                          "config": {"page-size": 2, "bulk-fetch": True, **config}}))
+        self.upstreams = {f"id-{i}": f"svc-{i}" for i in range(3)}
+        self.targets = {"id-0": ["10.0.0.1:8080", "10.0.0.2:8080", "10.0.0.3:8080"], "id-1": ["10.0.1.1:8080"],
+                        "id-2": []}
+        self.calls = []
+        self.config = None
+
+    def kong_execute(self, method, uri, params, data=None):
+        self.calls.append((method, uri, dict(params)))
+        if method != "GET":
+            return self.write(method, uri, data)
+        if uri == "config":
+            return httpx.Response(200, json={"config": yaml.safe_dump(self.config)})
+        if uri == "upstreams":
+            assert params.get("tags") == SYNCER_TAG
+            items = [{"id": key, "name": name} for key, name in self.upstreams.items()]
+        elif uri.startswith("upstreams/") and uri.endswith("/targets"):
+            key = uri.split("/")[1]
+            if key not in self.targets:
+                return httpx.Response(404, json={"message": "Not found"})
+            items = [{"target": addr, "weight": 100, "upstream": {"id": key}} for addr in self.targets[key]]
+        else:
+            return httpx.Response(404, json={"message": "Not found"})
+        # 和 kong 一样按 offset 翻页，最后一页没有 offset
+        start = int(params.get("offset", 0))
+        end = start + params["size"]
+        body = {"data": items[start:end]}
+        if end < len(items):
+            body["offset"] = str(end)
+        return httpx.Response(200, json=body)
+
+    def write(self, method, uri, data):
+        if uri == "config":
+            self.config = json.loads(data)
+            return httpx.Response(201, json={})
+        parts = uri.split("/")
+        if uri == "upstreams" or parts[0] != "upstreams" or len(parts) < 3:
+            return httpx.Response(200, json={})
+        targets = self.targets.setdefault(parts[1], [])
+        if method == "POST":
+            addr = json.loads(data)["target"]
+            if addr in targets:
+                return httpx.Response(409, json={"message": "unique constraint violation"})
+            targets.append(addr)
+            return httpx.Response(201, json={})
+        if method == "DELETE":
+            if parts[3] not in targets:
+                return httpx.Response(404, json={"message": "Not found"})
+            targets.remove(parts[3])
+            return httpx.Response(204)
+        return httpx.Response(200, json={})
+
+
+def test_iter_pages_follows_offset_until_the_last_page():
+    kong = FakeKong()
+    items = kong.iter_pages("upstreams/id-0/targets")
+
+    assert [item["target"] for item in items] == kong.targets["id-0"]
+    assert [call[2].get("offset") for call in kong.calls] == [None, "2"]
+    assert kong.iter_pages("upstreams/missing/targets") is None
+
+
+def test_bulk_fetch_lists_tagged_upstreams_then_their_targets():
+    kong = FakeKong()
+    kong.begin_cycle(TARGET)
+
+    uris = [call[1] for call in kong.calls]
+    assert "targets" not in uris
+    assert uris.count("upstreams") == 2
+    assert sorted(set(uris) - {"upstreams"}) == ["upstreams/id-0/targets", "upstreams/id-1/targets",
+                                                 "upstreams/id-2/targets"]
+    assert {name: [f"{i.ip}:{i.port}" for i in items] for name, items in kong.upstream_index.items()} == {
+        "svc-0": kong.targets["id-0"], "svc-1": kong.targets["id-1"], "svc-2": []}
+
+    # 本轮内快照里有的服务不再请求网关
+    kong.calls.clear()
+    assert len(kong.get_service_all_instances(TARGET, "svc-0")) == 3
+    assert kong.calls == []
+
+
+def test_bulk_fetch_treats_upstreams_deleted_meanwhile_as_empty():
+    kong = FakeKong()
+    del kong.targets["id-1"]
+    kong.begin_cycle(TARGET)
+
+    assert kong.upstream_index["svc-1"] == []
+    assert len(kong.upstream_index["svc-0"]) == 3
+
+
+def instance(addr: str, enabled: bool, weight: float = 100) -> Instance:
+    ip, port = addr.split(":")
+    return Instance(ip=ip, port=port, weight=weight, enabled=enabled, change=True)
+
+
+def test_sync_instances_creates_before_deleting_and_reports_each_target():
+    kong = FakeKong(**{"bulk-fetch": False})
+    diff = [instance("10.0.0.1:8080", False), instance("10.0.0.9:8080", True), instance("10.0.0.2:8080", True),
+            instance("10.0.0.8:8080", False)]
+    outcomes = kong.sync_instances(TARGET, "id-0", diff, [])
+
+    writes = [(method, uri) for method, uri, _ in kong.calls]
+    # 新增全部完成后才删除，滚动发布时 upstream 不会短暂没有节点
+    creates = [i for i, (method, uri) in enumerate(writes) if method in ("POST", "PUT") and uri != "upstreams"]
+    assert writes[0] == ("PUT", "upstreams")
+    assert max(creates) < min(i for i, (method, _) in enumerate(writes) if method == "DELETE")
+    assert ("PUT", "upstreams/id-0/targets/10.0.0.2:8080") in writes
+    assert {(o.target, o.action, o.success, o.status_code) for o in outcomes} == {
+        ("10.0.0.9:8080", "create", True, 201), ("10.0.0.2:8080", "update", True, 200),
+        ("10.0.0.1:8080", "delete", True, 204), ("10.0.0.8:8080", "delete", True, 404)}
+    assert kong.targets["id-0"] == ["10.0.0.2:8080", "10.0.0.3:8080", "10.0.0.9:8080"]
+
+
+def test_dbless_pushes_one_declarative_config_per_cycle():
+    kong = FakeKong(**{"bulk-fetch": False, "dbless": True})
+    kong.config = {"_format_version": "3.0", "upstreams": [{"name": "svc-0", "id": "u0"}, {"name": "other"}],
+                   "targets": [{"target": "10.0.0.1:8080", "upstream": {"id": "u0"}},
+                               {"target": "10.9.9.9:8080", "upstream": "other"}]}
+    assert kong.sync_instances(TARGET, "svc-0", [instance("10.0.0.5:8080", True)],
+                               [instance("10.0.0.5:8080", True), instance("10.0.0.6:8080", False)]) == []
+    assert kong.sync_instances(TARGET, "svc-new", [instance("10.0.1.5:8080", True, 5)],
+                               [instance("10.0.1.5:8080", True, 5)]) == []
+    assert not [call for call in kong.calls if call[0] != "GET"]
+
+    outcomes = kong.end_cycle(TARGET)
+
+    assert [call[:2] for call in kong.calls] == [("GET", "config"), ("POST", "config")]
+    assert {(o.upstream, o.action, o.success) for o in outcomes} == {("svc-0", "replace", True),
+                                                                     ("svc-new", "replace", True)}
+    upstreams = {item["name"]: item for item in kong.config["upstreams"]}
+    assert [t["target"] for t in upstreams["svc-0"]["targets"]] == ["10.0.0.5:8080"]
+    assert [(t["target"], t["weight"]) for t in upstreams["svc-new"]["targets"]] == [("10.0.1.5:8080", 5)]
+    assert "targets" not in upstreams["other"]
+    # 没有变更的 upstream 的顶层 target 原样保留
+    assert kong.config["targets"] == [{"target": "10.9.9.9:8080", "upstream": "other"}]
+    assert kong.end_cycle(TARGET) == []
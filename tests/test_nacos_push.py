@@ -0,0 +1,60 @@
+import threading
+import time
+from types import SimpleNamespace
+
+from app.service.discovery.nacos_push import NacosSubscriber, POLL_INTERVAL_SEC, UDP_INTERVAL_SEC
+
+
+class FakeNacos(object):
+    def __init__(self, **config):
+        self._config = SimpleNamespace(config=config)
+        self.calls = []
+        self.hosts = {}
+        self.queried = threading.Event()
+
+    def nacos_execute(self, uri=None, params=None) -> dict:
+        self.calls.append((time.monotonic(), params.get("serviceName")))
+        self.queried.set()
+        return {"hosts": self.hosts.get(params.get("serviceName"), [])}
+
+
+TARGET = {"id": "0-apisix-nacos", "config": {}}
+
+
+def test_default_interval_depends_on_mode():
+    assert NacosSubscriber(FakeNacos()).interval == POLL_INTERVAL_SEC
+    assert NacosSubscriber(FakeNacos(**{"subscribe-mode": "udp"})).interval == UDP_INTERVAL_SEC
+    assert NacosSubscriber(FakeNacos(**{"poll-interval-sec": 2})).interval == 2
+
+
+def test_poll_spreads_queries_over_the_interval():
+    nacos = FakeNacos(**{"poll-interval-sec": 0.6})
+    subscriber = NacosSubscriber(nacos)
+    subscriber.watch(TARGET, ["a", "b", "c"], lambda target, name: None)
+    # 另一个作业订阅同一个服务，只查询一次
+    subscriber.watch(dict(TARGET, id="1-apisix-nacos"), ["a"], lambda target, name: None)
+    time.sleep(0.5)
+    subscriber.close()
+
+    first = nacos.calls[:3]
+    assert sorted(name for _, name in first) == ["a", "b", "c"]
+    # 3 个服务分散在 0.6 秒内，相邻两次查询间隔 0.2 秒左右
+    gaps = [b[0] - a[0] for a, b in zip(first, first[1:])]
+    assert all(gap >= 0.15 for gap in gaps)
+
+
+def test_changed_service_calls_back_watching_targets_only():
+    nacos = FakeNacos(**{"poll-interval-sec": 0.05})
+    subscriber = NacosSubscriber(nacos)
+    changed = []
+    subscriber.watch(TARGET, ["a"], lambda target, name: changed.append((target.get("id"), name)))
+    assert nacos.queried.wait(1)
+    nacos.hosts["a"] = [{"ip": "10.0.0.1", "port": 8080}]
+    nacos.hosts["b"] = [{"ip": "10.0.0.2", "port": 8080}]
+    deadline = time.monotonic() + 1
+    while not changed and time.monotonic() < deadline:
+        time.sleep(0.01)
+    subscriber.close()
+
+    assert changed[:1] == [(TARGET["id"], "a")]
+    assert {name for _, name in nacos.calls} == {"a"}
@@ -0,0 +1,74 @@
+import http.server
+import threading
+
+import pytest
+
+from app.model.syncer_model import DiscoveryInstance
+from app.service.health.prober import HealthProber
+
+
+class FailingHandler(http.server.BaseHTTPRequestHandler):
+    hits = 0
+
+    def do_GET(self):
+        FailingHandler.hits += 1
+        self.send_response(500)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture()
+def server():
+    FailingHandler.hits = 0
+    srv = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FailingHandler)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    yield srv
+    srv.shutdown()
+
+
+def make_target(target_id: str) -> dict:
+    return {"id": target_id, "healthcheck": {"type": "http", "uri": "/", "jitter": False, "timeout-sec": 2,
+                                             "healthy": {"successes": 2, "http_statuses": [200]},
+                                             "unhealthy": {"failures": 3, "http_statuses": [500]}}}
+
+
+def make_instance(target_id: str, port: int) -> DiscoveryInstance:
+    return DiscoveryInstance({"id": f"{target_id}-1", "target_id": target_id, "service": "svc",
+                              "instance": f"127.0.0.1:{port}", "status": "unknown"})
+
+
+def test_target_never_reads_back_its_own_result(server):
+    prober = HealthProber(cache_ttl=3600)
+    port = server.server_address[1]
+    a, b = make_target("a"), make_target("b")
+    try:
+        for cycle in range(2):
+            results_a = prober.run(a, [make_instance("a", port)])
+            results_b = prober.run(b, [make_instance("b", port)])
+            assert [result["failures"] for _, result in results_a] == [1]
+            assert [result["failures"] for _, result in results_b] == [1]
+        # 每个周期只有第一个作业真正探测，第二个作业复用，下一个周期重新探测
+        assert FailingHandler.hits == 2
+        assert prober.cache.hits == 2
+    finally:
+        prober.reset()
+
+
+def test_targets_with_different_verdict_rules_do_not_share_results(server):
+    prober = HealthProber(cache_ttl=3600)
+    port = server.server_address[1]
+    a, b = make_target("a"), make_target("b")
+    # b 认为 500 是健康的，不能复用 a 判定的失败
+    b["healthcheck"]["healthy"] = {"successes": 2, "http_statuses": [200, 500]}
+    b["healthcheck"]["unhealthy"] = {"failures": 3, "http_statuses": [503]}
+    try:
+        results_a = prober.run(a, [make_instance("a", port)])
+        results_b = prober.run(b, [make_instance("b", port)])
+        assert [result["failures"] for _, result in results_a] == [1]
+        assert [result["successes"] for _, result in results_b] == [1]
+        assert FailingHandler.hits == 2
+        assert prober.cache.hits == 0
+    finally:
+        prober.reset()
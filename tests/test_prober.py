@@ -0,0 +1,70 @@
+import http.server
+import threading
+import time
+
+import pytest
+
+from app.model.syncer_model import DiscoveryInstance
+from app.service.health.prober import HealthProber
+
+
+class SlowHandler(http.server.BaseHTTPRequestHandler):
+    lock = threading.Lock()
+    inflight = 0
+    max_inflight = 0
+
+    def do_GET(self):
+        with SlowHandler.lock:
+            SlowHandler.inflight += 1
+            SlowHandler.max_inflight = max(SlowHandler.max_inflight, SlowHandler.inflight)
+        time.sleep(0.1)
+        with SlowHandler.lock:
+            SlowHandler.inflight -= 1
+        # /ok 返回 200，/teapot 返回两边都没有配置的状态码
+        self.send_response(200 if self.path == "/ok" else 418)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture()
+def server():
+    SlowHandler.inflight, SlowHandler.max_inflight = 0, 0
+    # 监听全部地址，127.0.0.x 都可以访问
+    srv = http.server.ThreadingHTTPServer(("", 0), SlowHandler)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    yield srv
+    srv.shutdown()
+
+
+def make_target(uri: str, concurrency: int) -> dict:
+    return {"id": "t", "healthcheck": {"type": "http", "uri": uri, "jitter": False, "timeout-sec": 5,
+                                       "concurrency": concurrency, "healthy": {"http_statuses": [200]},
+                                       "unhealthy": {"http_statuses": [500]}}}
+
+
+def make_instances(port: int, size: int):
+    # 同一个端口，不同的主机名，每个实例是一次独立的探测
+    return [DiscoveryInstance({"id": str(i), "target_id": "t", "service": "svc", "instance": f"127.0.0.{i + 1}:{port}"})
+            for i in range(size)]
+
+
+def test_run_probes_every_instance_within_the_target_concurrency(server):
+    prober = HealthProber(concurrency=50)
+    try:
+        results = prober.run(make_target("/ok", 3), make_instances(server.server_address[1], 9))
+    finally:
+        prober.reset()
+    assert len(results) == 9
+    assert all(result == {"successes": 1, "failures": 0, "timeouts": 0} for _, result in results)
+    assert SlowHandler.max_inflight == 3
+
+
+def test_status_outside_both_lists_counts_as_nothing(server):
+    prober = HealthProber()
+    try:
+        results = prober.run(make_target("/teapot", 20), make_instances(server.server_address[1], 2))
+    finally:
+        prober.reset()
+    assert [result for _, result in results] == [{"successes": 0, "failures": 0, "timeouts": 0}] * 2
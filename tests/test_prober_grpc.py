@@ -0,0 +1,76 @@
+import asyncio
+import builtins
+
+import pytest
+
+from app.model import config as config_module
+from app.model.config import Targets
+from app.model.syncer_model import DiscoveryInstance
+from app.service.health.prober import HealthProber, encode_health_request, decode_health_response, GRPC_SERVING
+
+TARGET = {"discovery": "nacos1", "gateway": "apisix1", "healthcheck": {"type": "grpc", "interval": "*/10 * * * * *"}}
+
+
+@pytest.fixture()
+def without_grpc(monkeypatch):
+    origin_find_spec, origin_import = config_module.importlib.util.find_spec, builtins.__import__
+    monkeypatch.setattr(config_module.importlib.util, "find_spec",
+                        lambda name, *args: None if name == "grpc" else origin_find_spec(name, *args))
+
+    def fake_import(name, *args, **kwargs):
+        if name == "grpc":
+            raise ImportError("No module named 'grpc'")
+        return origin_import(name, *args, **kwargs)
+
+    monkeypatch.setattr(builtins, "__import__", fake_import)
+
+
+def test_reject_grpc_healthcheck_without_grpcio(without_grpc):
+    with pytest.raises(ValueError, match="grpcio"):
+        Targets(**TARGET)
+
+
+def test_missing_grpcio_is_not_an_instance_failure(without_grpc):
+    instance = DiscoveryInstance({"id": "1", "target_id": "t", "service": "svc", "instance": "127.0.0.1:50051"})
+    result = asyncio.run(HealthProber().probe(instance, {"type": "grpc", "timeout-sec": 1}))
+    assert result == {"successes": 0, "failures": 0, "timeouts": 0}
+
+
+def test_health_messages():
+    assert encode_health_request("") == b""
+    assert encode_health_request("svc") == b"\x0a\x03svc"
+    assert encode_health_request("s" * 200)[:3] == b"\x0a\xc8\x01"
+    assert decode_health_response(b"\x08\x01") == GRPC_SERVING
+    # NOT_SERVING(2)，status 为 0(UNKNOWN) 时整个字段被省略
+    assert decode_health_response(b"\x08\x02") != GRPC_SERVING
+    assert decode_health_response(b"") == 0
+
+
+def test_probe_grpc_server():
+    grpc = pytest.importorskip("grpc")
+
+    async def run():
+        statuses = {"": b"\x08\x01", "down": b"\x08\x02"}
+
+        def check(request, context):
+            service = request[2:].decode("utf-8") if request else ""
+            return statuses[service]
+
+        server = grpc.aio.server()
+        server.add_generic_rpc_handlers([grpc.method_handlers_generic_handler(
+            "grpc.health.v1.Health", {"Check": grpc.unary_unary_rpc_method_handler(check)})])
+        port = server.add_insecure_port("127.0.0.1:0")
+        await server.start()
+        try:
+            instance = DiscoveryInstance({"id": "1", "target_id": "t", "service": "svc",
+                                          "instance": f"127.0.0.1:{port}"})
+            prober = HealthProber()
+            up = await prober.probe(instance, {"type": "grpc", "timeout-sec": 2})
+            down = await prober.probe(instance, {"type": "grpc", "timeout-sec": 2, "grpc-service": "down"})
+        finally:
+            await server.stop(None)
+        return up, down
+
+    up, down = asyncio.run(run())
+    assert up["successes"] == 1
+    assert down["failures"] == 1
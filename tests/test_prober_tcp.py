@@ -0,0 +1,48 @@
+import asyncio
+import socket
+
+import pytest
+
+from app.model.syncer_model import DiscoveryInstance
+from app.service.health.prober import HealthProber
+
+
+def make_instance(port: int) -> DiscoveryInstance:
+    return DiscoveryInstance({"id": "1", "target_id": "t", "service": "svc", "instance": f"127.0.0.1:{port}"})
+
+
+def probe(port: int, timeout: float = 1) -> dict:
+    return asyncio.run(HealthProber().probe(make_instance(port), {"type": "tcp", "timeout-sec": timeout}))
+
+
+@pytest.fixture()
+def listener():
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    yield server
+    server.close()
+
+
+def test_tcp_probe_succeeds_when_the_port_accepts(listener):
+    listener.listen(8)
+    assert probe(listener.getsockname()[1]) == {"successes": 1, "failures": 0, "timeouts": 0}
+
+
+def test_tcp_probe_fails_when_the_connection_is_refused(listener):
+    # 只绑定不监听，连接会被拒绝
+    assert probe(listener.getsockname()[1]) == {"successes": 0, "failures": 1, "timeouts": 0}
+
+
+def test_tcp_probe_times_out_when_the_handshake_never_completes(listener):
+    # 不 accept 的监听端口，握手队列满之后新的连接收不到响应
+    listener.listen(0)
+    clients = []
+    try:
+        for _ in range(8):
+            client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            client.setblocking(False)
+            client.connect_ex(listener.getsockname())
+            clients.append(client)
+        assert probe(listener.getsockname()[1], 0.5) == {"successes": 0, "failures": 0, "timeouts": 1}
+    finally:
+        [client.close() for client in clients]
@@ -0,0 +1,36 @@
+from app.model.syncer_model import Instance
+from app.service.reconcile import instance_key, partition, reconcile
+
+
+def make(addr: str, weight: float = 1) -> Instance:
+    ip, port = addr.split(":")
+    return Instance(ip=ip, port=port, weight=weight)
+
+
+def test_reconcile_splits_adds_removes_and_weight_changes():
+    discovery = [make("10.0.0.1:80"), make("10.0.0.2:80", 5), make("10.0.0.3:80")]
+    gateway = [make("10.0.0.2:80", 1), make("10.0.0.3:80", 1.0), make("10.0.0.4:80")]
+    result = reconcile(discovery, gateway)
+
+    assert [instance_key(i) for i in result.adds] == ["10.0.0.1:80"]
+    assert [(instance_key(i), i.weight) for i in result.weight_changes] == [("10.0.0.2:80", 5)]
+    assert [instance_key(i) for i in result.unchanged] == ["10.0.0.3:80"]
+    assert [instance_key(i) for i in result.removes] == ["10.0.0.4:80"]
+    assert [(i.change, i.enabled) for i in result.changes] == [(True, True), (True, True), (True, False)]
+    assert result
+    # 返回的是副本，传入的实例不变
+    assert not any(i.change or i.enabled for i in discovery + gateway)
+
+
+def test_reconcile_without_changes_is_falsy():
+    assert not reconcile([make("10.0.0.1:80", 2)], [make("10.0.0.1:80", 2.0)])
+    assert not reconcile(None, [])
+
+
+def test_partition_keeps_order_and_splits_by_key():
+    instances = [make("10.0.0.1:80"), make("10.0.0.2:80"), make("10.0.0.3:80"), make("10.0.0.2:81")]
+    kept, matched = partition(instances, {"10.0.0.2:80", "10.0.0.3:80", "10.0.0.9:80"})
+
+    assert [instance_key(i) for i in kept] == ["10.0.0.1:80", "10.0.0.2:81"]
+    assert [instance_key(i) for i in matched] == ["10.0.0.2:80", "10.0.0.3:80"]
+    assert partition(None, {"10.0.0.1:80"}) == ([], [])
@@ -0,0 +1,66 @@
+import threading
+import time
+
+import httpx
+
+from app.service.gateway.restore import RateLimiter, RestoreExecutor, RestoreTask
+
+
+class Recorder(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = []
+
+    def task(self, order: int, kind: str, id: str, responses=None):
+        responses = list(responses or [200])
+
+        def request():
+            time.sleep(0.01)
+            with self.lock:
+                self.events.append((order, kind, id))
+                status = responses.pop(0) if len(responses) > 1 else responses[0]
+            if isinstance(status, Exception):
+                raise status
+            return httpx.Response(status, text=f"status {status}")
+
+        return RestoreTask(order, kind, id, request)
+
+
+def test_batches_run_in_order_with_a_barrier_between_them():
+    recorder = Recorder()
+    tasks = [recorder.task(2, "routes", f"r{i}") for i in range(4)] + \
+            [recorder.task(1, "upstreams", f"u{i}") for i in range(6)] + [recorder.task(3, "plugins", "p0")]
+    summary = RestoreExecutor(workers=4, backoff=0).run(tasks)
+
+    orders = [order for order, _, _ in recorder.events]
+    # 上一批全部完成后才开始下一批
+    assert orders == sorted(orders)
+    assert summary["total"] == summary["succeeded"] == 11
+    assert summary["kinds"] == {"upstreams": {"total": 6, "succeeded": 6, "failed": 0},
+                                "routes": {"total": 4, "succeeded": 4, "failed": 0},
+                                "plugins": {"total": 1, "succeeded": 1, "failed": 0}}
+
+
+def test_transient_errors_are_retried_and_data_errors_are_not():
+    recorder = Recorder()
+    tasks = [recorder.task(1, "upstreams", "flaky", [503, httpx.ConnectError("refused"), 200]),
+             recorder.task(1, "upstreams", "bad", [400]),
+             recorder.task(1, "upstreams", "down", [502])]
+    summary = RestoreExecutor(workers=2, retries=2, backoff=0).run(tasks)
+
+    attempts = {id: sum(1 for _, _, item in recorder.events if item == id) for id in ("flaky", "bad", "down")}
+    assert attempts == {"flaky": 3, "bad": 1, "down": 3}
+    assert (summary["succeeded"], summary["failed"], summary["retried"]) == (1, 2, 2)
+    assert {item["id"]: (item["status_code"], item["attempts"]) for item in summary["failures"]} == {
+        "bad": (400, 1), "down": (502, 3)}
+
+
+def test_rate_limiter_spaces_requests_across_threads():
+    limiter = RateLimiter(50)
+    start = time.monotonic()
+    threads = [threading.Thread(target=limiter.acquire) for _ in range(11)]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    # 第一个立即通过，之后每个间隔 1/50 秒
+    assert time.monotonic() - start >= 10 / 50 * 0.9
+    RateLimiter(0).acquire()
@@ -0,0 +1,38 @@
+from app.model.syncer_model import DiscoveryInstance
+from app.service.health.scheduler import ProbeScheduler, MAX_SPREAD_SEC, SPREAD_RATIO
+
+# app.tasks.common.FunboostCommonConfig.function_timeout，导入 funboost 需要 redis
+FUNCTION_TIMEOUT = 600
+
+
+def make_instances(size: int):
+    return [DiscoveryInstance({"id": str(i), "target_id": "t", "service": "svc", "instance": f"10.0.0.{i}:80"})
+            for i in range(size)]
+
+
+def test_spread_stays_below_function_timeout():
+    plans = ProbeScheduler().plan({"id": "t", "healthcheck": {}}, make_instances(200), 3600)
+    assert len(plans) == 200
+    assert max(delay for _, delay in plans) < MAX_SPREAD_SEC < FUNCTION_TIMEOUT
+
+
+def test_short_interval_spreads_over_interval():
+    plans = ProbeScheduler().plan({"id": "t", "healthcheck": {}}, make_instances(200), 10)
+    assert max(delay for _, delay in plans) < 10 * SPREAD_RATIO
+    assert max(delay for _, delay in plans) > 10 * SPREAD_RATIO / 2
+
+
+def test_only_stable_healthy_instances_back_off():
+    scheduler = ProbeScheduler()
+    target = {"id": "t", "healthcheck": {"stable-cycles": 1, "max-backoff": 4}}
+    instances = make_instances(50)
+    for instance in instances:
+        instance.status = "healthy"
+    counts = [len(scheduler.plan(target, instances, 0)) for _ in range(8)]
+    # 第一个周期全部探测，稳定后按偏移错开，每个周期只探测一部分
+    assert counts[0] == 50
+    assert sum(counts[4:]) == 50
+
+    unknown = make_instances(10)
+    assert all(len(scheduler.plan({"id": "u", "healthcheck": target["healthcheck"]}, unknown, 0)) == 10
+               for _ in range(8))
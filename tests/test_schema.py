@@ -0,0 +1,19 @@
+from db_libs.sqla_lib import SqlaReflectHelper
+from sqlalchemy import create_engine
+
+from app.model.syncer_model import SCHEMA_VERSION, migrate_schema
+
+
+def test_migrate_creates_the_restore_index(tmp_path):
+    engine = create_engine(f"sqlite+pysqlite:///{tmp_path / 'syncer-jobs.db'}")
+    migrate_schema(SqlaReflectHelper(engine))
+    # 再执行一次不会重建
+    migrate_schema(SqlaReflectHelper(engine))
+
+    with engine.connect() as conn:
+        assert conn.exec_driver_sql("PRAGMA user_version").scalar() == SCHEMA_VERSION
+        indexes = {row[0] for row in conn.exec_driver_sql(
+            "select name from sqlite_master where type = 'index' and tbl_name = 'instances' and sql is not null")}
+        assert indexes == {"ix_instances_target"}
+        plan = conn.exec_driver_sql("explain query plan select * from instances where target_id = '0'").all()
+        assert "USING INDEX ix_instances_target" in plan[0][-1]
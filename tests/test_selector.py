@@ -0,0 +1,40 @@
+import pytest
+
+from app.model.config import Targets
+from app.service.selector import ServiceSelector
+
+
+def test_global_inline_flags():
+    selector = ServiceSelector(include=["(?i)order-.*", "pay-.*"], exclude=["(?i).*-CANARY"])
+    assert selector.match_name("ORDER-service")
+    assert selector.match_name("pay-service")
+    assert not selector.match_name("Pay-service")
+    assert not selector.match_name("order-service-canary")
+
+
+def test_target_accepts_global_inline_flags():
+    target = Targets(**{"discovery": "nacos1", "gateway": "apisix1", "exclude-service": ["(?i)^test-.*"]})
+    selector = ServiceSelector.from_target(target.model_dump())
+    assert not selector.match_name("TEST-service")
+    assert selector.match_name("order-service")
+
+
+def test_patterns_with_groups_are_not_merged():
+    # 合并后 \1 会指向第一个正则的分组，同名分组会编译失败
+    selector = ServiceSelector(include=["(a)-x", r"(b)-\1", "(?P<env>dev)-.*", "(?P<env>prod)-.*", "plain-.*"])
+    assert selector.match_name("b-b")
+    assert not selector.match_name("b-a")
+    assert selector.match_name("dev-order")
+    assert selector.match_name("prod-order")
+    assert selector.match_name("plain-order")
+    assert not selector.match_name("test-order")
+
+
+def test_target_accepts_backreferences_and_repeated_group_names():
+    Targets(**{"discovery": "nacos1", "gateway": "apisix1",
+               "include-service": [r"(?P<env>dev)-.*", r"(?P<env>prod)-(\w)\2"]})
+
+
+def test_target_rejects_invalid_regex():
+    with pytest.raises(ValueError):
+        Targets(**{"discovery": "nacos1", "gateway": "apisix1", "include-service": ["order-("]})
@@ -0,0 +1,79 @@
+import socket
+import threading
+import time
+
+import pytest
+
+from app.model.syncer_model import Instance
+from app.service.health import checker
+from app.service.health.events import health_events
+from app.service.health.prober import prober
+from app.service.health.store import health_store
+
+TARGET_ID = "0-apisix-nacos"
+
+
+@pytest.fixture()
+def ports():
+    # 一个监听的端口(探测成功)和一个只绑定不监听的端口(连接被拒绝)
+    listening, closed = socket.socket(), socket.socket()
+    listening.bind(("127.0.0.1", 0))
+    listening.listen(8)
+    closed.bind(("127.0.0.1", 0))
+    yield listening.getsockname()[1], closed.getsockname()[1]
+    listening.close()
+    closed.close()
+    health_store.clear()
+    health_events.clear()
+    prober.reset()
+
+
+def make_target(**healthcheck) -> dict:
+    return {"id": TARGET_ID, "healthcheck": {"type": "tcp", "timeout-sec": 1, "warmup": True,
+                                             "warmup-interval-sec": 0.05, **healthcheck}}
+
+
+def start(target: dict, port: int) -> threading.Event:
+    health_store.save_or_update(TARGET_ID, "svc", [Instance(ip="127.0.0.1", port=port, enabled=True)])
+    healthy = threading.Event()
+    checker.warmup(target, "svc", [f"127.0.0.1:{port}"], healthy.set)
+    return healthy
+
+
+def wait_done(timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while checker._warming and time.monotonic() < deadline:
+        time.sleep(0.02)
+    assert not checker._warming
+
+
+def test_warmup_probes_until_healthy_then_calls_back(ports):
+    healthy = start(make_target(healthy={"successes": 2}), ports[0])
+
+    assert healthy.wait(5)
+    wait_done()
+    [item] = health_store.service_instances(TARGET_ID, "svc")
+    assert (item.status, item.successes) == ("healthy", 2)
+    assert [event["status"] for event in health_events.query(TARGET_ID, kind="transition")] == ["healthy"]
+
+
+def test_warmup_gives_up_after_the_configured_attempts(ports):
+    healthy = start(make_target(**{"warmup-attempts": 3, "unhealthy": {"failures": 100}}), ports[1])
+
+    wait_done()
+    assert not healthy.is_set()
+    [item] = health_store.service_instances(TARGET_ID, "svc")
+    assert (item.status, item.failures) == ("unknown", 3)
+
+
+def test_instances_already_warming_are_not_submitted_again(ports, monkeypatch):
+    submitted = []
+    monkeypatch.setattr(checker.prober, "submit", lambda coro: (submitted.append(coro), coro.close()))
+    target = make_target()
+    checker.warmup(target, "svc", ["10.0.0.1:80", "10.0.0.2:80"], lambda: None)
+    checker.warmup(target, "svc", ["10.0.0.2:80", "10.0.0.3:80"], lambda: None)
+    checker.warmup(target, "svc", ["10.0.0.1:80"], lambda: None)
+
+    assert len(submitted) == 2
+    assert checker._warming == {(TARGET_ID, "10.0.0.1:80"), (TARGET_ID, "10.0.0.2:80"), (TARGET_ID, "10.0.0.3:80")}
+    checker._warming.clear()